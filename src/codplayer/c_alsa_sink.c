@@ -27,6 +27,8 @@
 #include <stdio.h>
 #include <pthread.h>
 #include <sched.h>
+#include <sys/mman.h>
+#include <time.h>
 
 
 /* Will run on approx 10Hz for PCM */
@@ -36,6 +38,9 @@
 #define BUFFER_SECONDS 5
 #define MAX_PERIODS_PER_SECOND 40
 
+/* Log jitter statistics approximately once a minute */
+#define JITTER_LOG_PERIODS 600
+
 /* States in which add_packet() should try to put stuff into the
  * buffer has this bit set.
  */
@@ -109,9 +114,13 @@ typedef struct {
     int rate;
     int big_endian;
 
+    /* If true, try to use mmap access to the device buffer */
+    int use_mmap;
+
     /* Actual hardware settings, set by thread_set_format() */
     int period_frames;
     int swap_bytes;
+    int mmap_access;
 
     const char *device_error;  /* Current error, or NULL */
 
@@ -148,9 +157,20 @@ typedef struct {
     PyObject *prev_playing_packet;
     const char *prev_device_error;
 
+    /* If true, lock the buffer and packet array into RAM */
+    int lock_memory;
+
     /* Performanace logging */
     FILE *thread_perf_log;
 
+    /* Period write jitter statistics, only used by the playing thread */
+    int log_performance;
+    struct timespec last_write;
+    long jitter_count;
+    long jitter_max_us;
+    long long jitter_sum_us;
+    char jitter_stats[160];
+
 } alsa_thread_t;
 
 
@@ -172,11 +192,18 @@ static void copy_and_swap(unsigned char *dest, int pos,
                           const unsigned char *src, int length);
 static int thread_open_device(alsa_thread_t *self);
 static int thread_set_format(alsa_thread_t *self, snd_pcm_t *handle);
+static snd_pcm_sframes_t thread_mmap_write(snd_pcm_t *handle,
+                                           const unsigned char *data,
+                                           snd_pcm_uframes_t frames,
+                                           int frame_bytes);
 static void* thread_main(void *arg);
 static void thread_loop(alsa_thread_t *self);
 static void thread_play_once(alsa_thread_t *self);
 static void thread_pause(alsa_thread_t *self);
 static void thread_resume(alsa_thread_t *self);
+static void thread_update_jitter(alsa_thread_t *self,
+                                 const struct timespec *now);
+static void thread_reset_jitter(alsa_thread_t *self);
 
 
 /* Translate a card id to a ALSA cardname 
@@ -332,25 +359,100 @@ static void set_log_message(alsa_thread_t *self, const char *message, const char
 }
 
 
+/* Translate a scheduling policy name into a policy constant, or -1
+ * if unknown.
+ */
+static int translate_sched_policy(const char *name)
+{
+    if (!name || !strcmp(name, "rr"))
+        return SCHED_RR;
+
+    if (!strcmp(name, "fifo"))
+        return SCHED_FIFO;
+
+    if (!strcmp(name, "normal"))
+        return SCHED_OTHER;
+
+    return -1;
+}
+
+
 /*
  * Object constructor
  */
 static PyObject *
 alsa_thread_new(PyTypeObject *type, PyObject *args, PyObject *kwds) 
 {
+    static char *kwlist[] = {
+        "parent", "cardname", "start_without_device", "log_performance",
+        "use_mmap", "sched_policy", "sched_priority", "cpus", "lock_memory",
+        NULL
+    };
+
     int res;
     alsa_thread_t *self;
     PyObject *parent = NULL;
     char *cardname = NULL;
     int start_without_device = 0;
     int log_performance = 0;
+    int use_mmap = 0;
+    char *sched_policy = NULL;
+    int sched_priority = 0;
+    PyObject *cpus = NULL;
+    int lock_memory = 0;
+    int policy;
+    int min_priority, max_priority;
+    cpu_set_t cpu_set;
+    int use_cpu_set = 0;
     snd_pcm_t *handle = NULL;
     pthread_attr_t thread_attr;
     struct sched_param sched;
     
-    if (!PyArg_ParseTuple(args, "Osii:CAlsaSink",
-                          &parent, &cardname, &start_without_device, &log_performance))
+    if (!PyArg_ParseTupleAndKeywords(args, kwds, "Osii|iziOi:CAlsaSink", kwlist,
+                                     &parent, &cardname, &start_without_device, &log_performance,
+                                     &use_mmap, &sched_policy, &sched_priority, &cpus,
+                                     &lock_memory))
         return NULL;
+
+    policy = translate_sched_policy(sched_policy);
+    if (policy < 0)
+    {
+        return PyErr_Format(CAlsaSinkError,
+                            "unknown scheduling policy: %s (expected rr, fifo or normal)",
+                            sched_policy);
+    }
+
+    CPU_ZERO(&cpu_set);
+    if (cpus != NULL && cpus != Py_None)
+    {
+        PyObject *seq;
+        Py_ssize_t i;
+
+        seq = PySequence_Fast(cpus, "cpus must be a sequence of CPU numbers");
+        if (seq == NULL)
+            return NULL;
+
+        for (i = 0; i < PySequence_Fast_GET_SIZE(seq); i++)
+        {
+            long cpu = PyLong_AsLong(PySequence_Fast_GET_ITEM(seq, i));
+            if (cpu == -1 && PyErr_Occurred())
+            {
+                Py_DECREF(seq);
+                return NULL;
+            }
+
+            if (cpu < 0 || cpu >= CPU_SETSIZE)
+            {
+                Py_DECREF(seq);
+                return PyErr_Format(CAlsaSinkError, "invalid CPU number: %ld", cpu);
+            }
+
+            CPU_SET(cpu, &cpu_set);
+            use_cpu_set = 1;
+        }
+
+        Py_DECREF(seq);
+    }
     
 
     if (!(self = (alsa_thread_t *)PyObject_New(alsa_thread_t, &CAlsaSinkType)))
@@ -376,6 +478,10 @@ alsa_thread_new(PyTypeObject *type, PyObject *args, PyObject *kwds)
         self->thread_perf_log = NULL;
     }
 
+    self->log_performance = log_performance;
+    self->lock_memory = lock_memory;
+    thread_reset_jitter(self);
+
 
     self->thread = 0;
     
@@ -388,8 +494,10 @@ alsa_thread_new(PyTypeObject *type, PyObject *args, PyObject *kwds)
     self->channels = 0;
     self->rate = 0;
     self->big_endian = 0;
+    self->use_mmap = use_mmap;
     self->period_frames = 0;
     self->swap_bytes = 0;
+    self->mmap_access = 0;
 
     self->device_error = NULL;
     self->log_message = NULL;
@@ -408,6 +516,16 @@ alsa_thread_new(PyTypeObject *type, PyObject *args, PyObject *kwds)
     if (self->packets == NULL)
         return PyErr_NoMemory();
 
+    if (self->lock_memory)
+    {
+        /* Keep going without locked memory if we lack the privileges */
+        if (mlock(self->packets, sizeof(PyObject*) * BUFFER_SECONDS * MAX_PERIODS_PER_SECOND) < 0)
+        {
+            alsa_log2(self, "couldn't lock packet array in memory", strerror(errno));
+            self->lock_memory = 0;
+        }
+    }
+
     self->prev_playing_packet = NULL;
     self->prev_device_error = NULL;
 
@@ -444,51 +562,91 @@ alsa_thread_new(PyTypeObject *type, PyObject *args, PyObject *kwds)
 
     /* Ready to kick off thread */
 
-    /* Try to start with elevated priority (without going to extremes) */
-    if (pthread_attr_init(&thread_attr) != 0)
-        return PyErr_Format(CAlsaSinkError, "pthread_attr_init: %s",
-                            strerror(errno));
+    if (policy == SCHED_OTHER)
+    {
+        alsa_debug1(self, "starting thread with normal priority as configured");
 
-    if (pthread_attr_setinheritsched(&thread_attr,
-                                     PTHREAD_EXPLICIT_SCHED) != 0)
-        return PyErr_Format(CAlsaSinkError, "pthread_attr_setinheritsched: %s",
-                            strerror(errno));
-        
-    if (pthread_attr_setschedpolicy(&thread_attr, SCHED_RR) != 0)
-        return PyErr_Format(CAlsaSinkError, "pthread_attr_setschedpolicy: %s",
-                            strerror(errno));
-        
-    sched.sched_priority = sched_get_priority_min(SCHED_RR);
-    if (pthread_attr_setschedparam(&thread_attr, &sched) != 0)
-        return PyErr_Format(CAlsaSinkError, "pthread_attr_setschedparam: %s",
-                            strerror(errno));
-    
-    if (pthread_create(&self->thread, &thread_attr, thread_main, self) != 0)
+        res = pthread_create(&self->thread, NULL, thread_main, self);
+        if (res != 0)
+        {
+            PyErr_Format(CAlsaSinkError, "couldn't start thread: %s",
+                         strerror(res));
+            return NULL;
+        }
+    }
+    else
     {
-        if (errno == EPERM)
+        /* Try to start with elevated priority.  By default the
+         * minimum realtime priority is used, to not go to extremes.
+         */
+        min_priority = sched_get_priority_min(policy);
+        max_priority = sched_get_priority_max(policy);
+
+        sched.sched_priority = sched_priority;
+        if (sched.sched_priority < min_priority)
+            sched.sched_priority = min_priority;
+        if (sched.sched_priority > max_priority)
+            sched.sched_priority = max_priority;
+
+        if ((res = pthread_attr_init(&thread_attr)) != 0)
+            return PyErr_Format(CAlsaSinkError, "pthread_attr_init: %s",
+                                strerror(res));
+
+        if ((res = pthread_attr_setinheritsched(&thread_attr,
+                                                PTHREAD_EXPLICIT_SCHED)) != 0)
+            return PyErr_Format(CAlsaSinkError, "pthread_attr_setinheritsched: %s",
+                                strerror(res));
+
+        if ((res = pthread_attr_setschedpolicy(&thread_attr, policy)) != 0)
+            return PyErr_Format(CAlsaSinkError, "pthread_attr_setschedpolicy: %s",
+                                strerror(res));
+
+        if ((res = pthread_attr_setschedparam(&thread_attr, &sched)) != 0)
+            return PyErr_Format(CAlsaSinkError, "pthread_attr_setschedparam: %s",
+                                strerror(res));
+
+        alsa_debugi(self, "starting realtime thread with priority", sched.sched_priority);
+
+        /* pthread_create() returns the error rather than setting errno */
+        res = pthread_create(&self->thread, &thread_attr, thread_main, self);
+        if (res != 0)
         {
-            alsa_log1(self, "couldn't start realtime thread, falling back on a normal thread");
-            
-            if (pthread_create(&self->thread, NULL, thread_main, self) != 0)
+            if (res == EPERM)
+            {
+                alsa_log1(self, "couldn't start realtime thread, falling back on a normal thread");
+            }
+            else
+            {
+                alsa_log2(self, "couldn't start realtime thread, falling back on a normal thread",
+                          strerror(res));
+            }
+
+            res = pthread_create(&self->thread, NULL, thread_main, self);
+            if (res != 0)
             {
                 PyErr_Format(CAlsaSinkError, "couldn't start thread (try 2): %s",
-                             strerror(errno));
+                             strerror(res));
                 return NULL;
             }
         }
+
+        pthread_attr_destroy(&thread_attr);
+    }
+
+    if (use_cpu_set)
+    {
+        res = pthread_setaffinity_np(self->thread, sizeof(cpu_set), &cpu_set);
+        if (res != 0)
+        {
+            alsa_log2(self, "couldn't set thread CPU affinity, running on any CPU",
+                      strerror(res));
+        }
         else
         {
-            if (pthread_create(&self->thread, NULL, thread_main, self) != 0)
-            {
-                PyErr_Format(CAlsaSinkError, "couldn't start thread: %s",
-                             strerror(errno));
-                return NULL;
-            }
-        }            
+            alsa_debugi(self, "thread CPU affinity set, number of CPUs", CPU_COUNT(&cpu_set));
+        }
     }
 
-    pthread_attr_destroy(&thread_attr);
-
     return (PyObject *)self;
 }
 
@@ -1231,14 +1389,26 @@ static void thread_play_once(alsa_thread_t *self)
     {
         unsigned char *data;
         int res;
+        struct timespec now;
 
         data = self->buffer + self->play_pos;
 
         { /* UNLOCKED CONTEXT */
             END_LOCK(self);
 
-            /* Suddenly the size argument is frames, not bytes... */
-            res = snd_pcm_writei(self->handle, data, self->period_frames);
+            if (self->mmap_access)
+            {
+                /* Copy straight from our ring into the device buffer */
+                res = thread_mmap_write(self->handle, data, self->period_frames,
+                                        self->period_size / self->period_frames);
+            }
+            else
+            {
+                /* Suddenly the size argument is frames, not bytes... */
+                res = snd_pcm_writei(self->handle, data, self->period_frames);
+            }
+
+            clock_gettime(CLOCK_MONOTONIC, &now);
             BEGIN_LOCK(self);
         }
 
@@ -1258,13 +1428,28 @@ static void thread_play_once(alsa_thread_t *self)
         {
             self->play_pos = (self->play_pos + self->period_size) % self->buffer_size;
             self->data_size -= self->period_size;
+            thread_update_jitter(self, &now);
             NOTIFY(self);
         }
         else if (res < 0)
         {
             snd_pcm_close(self->handle);
             self->handle = NULL;
-            self->log_message = "error writing to device";
+
+            if (self->mmap_access)
+            {
+                /* Don't trust mmap on this device anymore, and let
+                 * the reopened device use plain writes instead.
+                 */
+                self->use_mmap = 0;
+                self->mmap_access = 0;
+                self->log_message = "error writing to device with mmap, falling back to writei";
+            }
+            else
+            {
+                self->log_message = "error writing to device";
+            }
+
             self->log_param = snd_strerror(res);
             self->device_error = snd_strerror(res);
             NOTIFY(self);
@@ -1273,6 +1458,180 @@ static void thread_play_once(alsa_thread_t *self)
 }
 
 
+/* Write FRAMES frames from DATA to the device using mmap access.
+ * This copies the data directly into the device buffer, instead of
+ * having snd_pcm_writei() copy it into the kernel for us.
+ *
+ * Returns the number of frames written, or a negative error code
+ * that can be passed to snd_pcm_recover().
+ *
+ * This function is called in the playing thread without the mutex
+ * locked, so it can't use any Python stuff or touch self.
+ */
+static snd_pcm_sframes_t thread_mmap_write(snd_pcm_t *handle,
+                                           const unsigned char *data,
+                                           snd_pcm_uframes_t frames,
+                                           int frame_bytes)
+{
+    snd_pcm_uframes_t written = 0;
+
+    while (written < frames)
+    {
+        const snd_pcm_channel_area_t *areas;
+        snd_pcm_uframes_t offset;
+        snd_pcm_uframes_t size;
+        snd_pcm_sframes_t avail;
+        snd_pcm_sframes_t committed;
+        unsigned char *dest;
+        int res;
+
+        avail = snd_pcm_avail_update(handle);
+        if (avail < 0)
+        {
+            return avail;
+        }
+
+        if (avail == 0)
+        {
+            /* The device buffer is full.  Unlike snd_pcm_writei(),
+             * committing mmap frames doesn't start the stream, so do
+             * that ourselves the first time the buffer fills up.
+             */
+            if (snd_pcm_state(handle) == SND_PCM_STATE_PREPARED)
+            {
+                res = snd_pcm_start(handle);
+                if (res < 0)
+                {
+                    return res;
+                }
+            }
+
+            /* Block until there's room, just like writei would */
+            res = snd_pcm_wait(handle, 1000);
+            if (res < 0)
+            {
+                return res;
+            }
+
+            continue;
+        }
+
+        size = frames - written;
+        res = snd_pcm_mmap_begin(handle, &areas, &offset, &size);
+        if (res < 0)
+        {
+            return res;
+        }
+
+        /* Interleaved access, so all channels are in the first area */
+        dest = ((unsigned char *) areas[0].addr
+                + areas[0].first / 8
+                + offset * (areas[0].step / 8));
+
+        memcpy(dest, data + written * frame_bytes, size * frame_bytes);
+
+        committed = snd_pcm_mmap_commit(handle, offset, size);
+        if (committed < 0)
+        {
+            return committed;
+        }
+
+        if ((snd_pcm_uframes_t) committed != size)
+        {
+            return -EPIPE;
+        }
+
+        written += committed;
+    }
+
+    return written;
+}
+
+
+static void thread_reset_jitter(alsa_thread_t *self)
+{
+    /* LOCK SCOPE: only to be called while mutex is locked, or before
+     * the thread is started.
+     */
+
+    self->last_write.tv_sec = 0;
+    self->last_write.tv_nsec = 0;
+    self->jitter_count = 0;
+    self->jitter_max_us = 0;
+    self->jitter_sum_us = 0;
+}
+
+
+static void thread_update_jitter(alsa_thread_t *self,
+                                 const struct timespec *now)
+{
+    /* LOCK SCOPE: self->mutex is already locked when this function is
+     * called.
+     *
+     * Track how much the time between period writes deviates from
+     * the period length.  A blocking write returns when there's room
+     * for another period, so in a well-behaving thread this should be
+     * close to the period length.
+     */
+
+    long interval_us, period_us, jitter_us;
+
+    if (!self->log_performance)
+        return;
+
+    if (self->last_write.tv_sec == 0 && self->last_write.tv_nsec == 0)
+    {
+        /* First write after opening the device or resuming */
+        self->last_write = *now;
+        return;
+    }
+
+    if (self->thread_perf_log)
+    {
+        fprintf(self->thread_perf_log, "%ld.%06ld %ld.%06ld write\n",
+                (long) self->last_write.tv_sec, self->last_write.tv_nsec / 1000,
+                (long) now->tv_sec, now->tv_nsec / 1000);
+    }
+
+    interval_us = ((now->tv_sec - self->last_write.tv_sec) * 1000000L
+                   + (now->tv_nsec - self->last_write.tv_nsec) / 1000);
+    self->last_write = *now;
+
+    period_us = (long) ((self->period_frames * 1000000LL) / self->rate);
+    jitter_us = interval_us - period_us;
+    if (jitter_us < 0)
+        jitter_us = -jitter_us;
+
+    self->jitter_count++;
+    self->jitter_sum_us += jitter_us;
+    if (jitter_us > self->jitter_max_us)
+        self->jitter_max_us = jitter_us;
+
+    if (self->jitter_count >= JITTER_LOG_PERIODS)
+    {
+        /* Best-effort logging: the log helper thread may see the
+         * string being overwritten by the next round, but that's
+         * a minute away.
+         */
+        snprintf(self->jitter_stats, sizeof(self->jitter_stats),
+                 "periods %ld, period %ld us, mean %ld us, max %ld us",
+                 self->jitter_count, period_us,
+                 (long) (self->jitter_sum_us / self->jitter_count),
+                 self->jitter_max_us);
+
+        if (self->log_message == NULL)
+        {
+            self->log_message = "period write jitter";
+            self->log_param = self->jitter_stats;
+        }
+
+        self->jitter_count = 0;
+        self->jitter_max_us = 0;
+        self->jitter_sum_us = 0;
+    }
+}
+
+
 static void thread_pause(alsa_thread_t *self)
 {
     /* LOCK SCOPE: self->mutex is already locked when this function is
@@ -1308,6 +1667,10 @@ static void thread_pause(alsa_thread_t *self)
         self->device_error = "error pausing device, closed it";
     }
 
+    /* Don't count the pause as jitter when resuming */
+    self->last_write.tv_sec = 0;
+    self->last_write.tv_nsec = 0;
+
     /* Even if pausing fails, go into PAUSED since the music will stop
      * at this point anyway.
      */
@@ -1382,14 +1745,24 @@ static int thread_open_device(alsa_thread_t *self)
         {
             self->handle = handle;
             self->device_error = NULL;
+            thread_reset_jitter(self);
 
             if (self->log_message == NULL)
             {
                 self->log_message =
                     (self->state == SINK_STARTING ?
                      "opened device" : "reopened device");
-                self->log_param = (self->swap_bytes ?
-                                   "swapping bytes" : "not swapping bytes");
+                if (self->mmap_access)
+                {
+                    self->log_param = (self->swap_bytes ?
+                                       "swapping bytes, mmap access" :
+                                       "not swapping bytes, mmap access");
+                }
+                else
+                {
+                    self->log_param = (self->swap_bytes ?
+                                       "swapping bytes" : "not swapping bytes");
+                }
             }
 
             if (self->state == SINK_STARTING)
@@ -1441,6 +1814,7 @@ static int thread_open_device(alsa_thread_t *self)
 static int thread_set_format(alsa_thread_t *self, snd_pcm_t *handle)
 {
     int res,dir;
+    int mmap_access;
     unsigned int set_channels;
     unsigned int set_rate;
     snd_pcm_uframes_t set_period_size;
@@ -1450,6 +1824,8 @@ static int thread_set_format(alsa_thread_t *self, snd_pcm_t *handle)
         
         
     self->swap_bytes = 0;
+    self->mmap_access = 0;
+    mmap_access = self->use_mmap;
     sample_format = self->big_endian ? SND_PCM_FORMAT_S16_BE : SND_PCM_FORMAT_S16_LE;
     periods = 4;
 
@@ -1466,8 +1842,24 @@ static int thread_set_format(alsa_thread_t *self, snd_pcm_t *handle)
             return 0;
         }
 
-        snd_pcm_hw_params_set_access(handle, hwparams, 
-                                     SND_PCM_ACCESS_RW_INTERLEAVED);
+        if (mmap_access)
+        {
+            /* Fall back on regular writes if the device refuses mmap */
+            if (snd_pcm_hw_params_set_access(handle, hwparams,
+                                             SND_PCM_ACCESS_MMAP_INTERLEAVED) < 0)
+            {
+                mmap_access = 0;
+                self->log_message = "device refused mmap access, using writei";
+                self->log_param = NULL;
+                NOTIFY(self);
+            }
+        }
+
+        if (!mmap_access)
+        {
+            snd_pcm_hw_params_set_access(handle, hwparams,
+                                         SND_PCM_ACCESS_RW_INTERLEAVED);
+        }
         snd_pcm_hw_params_set_format(handle, hwparams, sample_format);
         snd_pcm_hw_params_set_channels(handle, hwparams, self->channels);
 
@@ -1539,6 +1931,8 @@ static int thread_set_format(alsa_thread_t *self, snd_pcm_t *handle)
         }
     }
 
+    self->mmap_access = mmap_access;
+
     /* Just use the period size determined by card.  Now we know it,
      * we can allocate the buffer, or just use an existing one with
      * the right parameters.
@@ -1564,6 +1958,9 @@ static int thread_set_format(alsa_thread_t *self, snd_pcm_t *handle)
             /* It's OK to discard anything in the buffer, since that
              * is anyway now the wrong format.
              */
+            if (self->lock_memory)
+                munlock(self->buffer, self->buffer_size);
+
             free(self->buffer);
             self->buffer = NULL;
         }
@@ -1578,6 +1975,20 @@ static int thread_set_format(alsa_thread_t *self, snd_pcm_t *handle)
             return 0;
         }
 
+        if (self->lock_memory)
+        {
+            /* Keep page faults and writeback stalls out of the
+             * playing thread.  Not fatal if it fails, just slower.
+             */
+            if (mlock(self->buffer, buffer_size) < 0)
+            {
+                self->log_message = "couldn't lock buffer in memory";
+                self->log_param = strerror(errno);
+                self->lock_memory = 0;
+                NOTIFY(self);
+            }
+        }
+
         self->buffer_size = buffer_size;
         self->period_size = self->period_frames * self->channels * 2;
         self->play_pos = 0;
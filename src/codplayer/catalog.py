@@ -0,0 +1,607 @@
+# codplayer - catalog index of the disc database
+#
+# Copyright 2018 Peter Liljenberg <peter.liljenberg@gmail.com>
+#
+# Distributed under an MIT license, please see LICENSE in the top dir.
+
+"""
+An SQLite index of the discs in the database, so that listing all
+discs doesn't require reading every disc info file.
+
+The disc info files are still the master copy of the data.  The
+catalog can always be rebuilt from them with Database.reindex(), and
+until it has been built the discs are listed by reading the files.
+
+The catalog also holds an inverted index of the words in the disc and
+track titles and artists, and the disc catalog number and barcode,
+used to search for discs.
+
+Finally, changes to discs are recorded in a journal with an
+increasing sequence number, so clients can ask for the discs changed
+since they last looked.  Only the latest changes are kept, clients
+that are further behind must list all discs again.
+
+The tables are only created when the catalog is written to, so a
+catalog built by another user can be read without write access.
+"""
+
+import os
+import re
+import time
+import uuid
+import collections
+import threading
+import unicodedata
+import sqlite3
+
+from . import model
+
+
+class CatalogError(Exception):
+    pass
+
+
+# Identifies the state of the catalog.  catalog_id is unique for each
+# catalog file, so sequence numbers from a deleted catalog aren't
+# mistaken for the current ones.  timestamp is the time of the
+# latest change, or None if there haven't been any.
+Version = collections.namedtuple('Version', ('catalog_id', 'seq', 'timestamp'))
+
+
+class Catalog(object):
+    """Access the catalog SQLite file at PATH.
+
+    The connection is opened on first use, and reopened if the process
+    has forked since then.  A single connection is shared between
+    threads, serialised by a lock.
+    """
+
+    SCHEMA_VERSION = 3
+
+    # Wait this many seconds for other processes to finish writing
+    BUSY_TIMEOUT = 30
+
+    # Keep this many of the latest changes in the journal
+    CHANGES_WINDOW = 10000
+
+    # Write this many discs at a time when rebuilding the catalog
+    REBUILD_BATCH = 100
+
+    # The DiscOverview attributes stored in the catalog, all but
+    # disc_id and tracks are optional text
+    OVERVIEW_COLUMNS = (
+        'disc_id',
+        'mb_id',
+        'cover_mb_id',
+        'tracks',
+        'catalog',
+        'title',
+        'artist',
+        'barcode',
+        'date',
+        'link_type',
+        'linked_disc_id',
+        )
+
+    # Search ranking weight of words in different attributes.  A
+    # disc matches a query word with the highest weight of the disc
+    # words the query word is a prefix of.
+    DISC_WORD_WEIGHTS = (
+        ('artist', 4),
+        ('title', 4),
+        ('catalog', 2),
+        ('barcode', 2),
+        )
+
+    TRACK_WORD_WEIGHTS = (
+        ('artist', 1),
+        ('title', 1),
+        )
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.RLock()
+        self._conn = None
+        self._pid = None
+        self._has_schema = False
+
+
+    def close(self):
+        with self._lock:
+            if self._conn:
+                self._conn.close()
+                self._conn = None
+
+
+    def is_complete(self):
+        """Return True if the catalog has been built from all the discs
+        in the database, and not just updated with changed discs.
+        """
+        with self._lock:
+            if not os.path.exists(self.path):
+                return False
+
+            try:
+                meta = dict(self._connect().execute(
+                    "SELECT key, value FROM meta WHERE key IN ('version', 'complete')"))
+            except sqlite3.OperationalError:
+                # No tables yet
+                return False
+            except sqlite3.Error, e:
+                raise CatalogError('{0}: {1}'.format(self.path, e))
+
+            return (meta.get('version') == str(self.SCHEMA_VERSION)
+                    and meta.get('complete') == '1')
+
+
+    def update_disc(self, db_id, disc, event = 'update'):
+        """Add or replace the entry for DISC, recording the change in
+        the journal as EVENT ('create' or 'update').
+
+        Returns the sequence number of the journal entry.
+        """
+        return self.update_discs([(db_id, disc, event)])[0]
+
+
+    def update_discs(self, updates):
+        """Add or replace several discs in a single transaction.
+        UPDATES is a list of (db_id, disc, event) tuples.
+
+        Returns a list of the journal sequence numbers of the updates.
+        """
+        seqs = []
+        with self._transaction(write = True) as conn:
+            for db_id, disc, event in updates:
+                seqs.append(self._add_change(conn, db_id, event))
+                self._insert_overview(conn, db_id, model.DiscOverview(disc))
+                conn.execute('DELETE FROM words WHERE db_id = ?', (db_id, ))
+                self._insert_words(conn, db_id, disc)
+
+            if seqs:
+                self._prune_changes(conn, seqs[-1])
+
+        return seqs
+
+
+    def remove_disc(self, db_id):
+        with self._transaction(write = True) as conn:
+            seq = self._add_change(conn, db_id, 'remove')
+            conn.execute('DELETE FROM discs WHERE db_id = ?', (db_id, ))
+            conn.execute('DELETE FROM words WHERE db_id = ?', (db_id, ))
+            self._prune_changes(conn, seq)
+
+
+    def get_overviews(self):
+        """Return a list of DiscOverview objects for all discs, in db_id order."""
+
+        with self._lock:
+            cursor = self._execute('SELECT {0} FROM discs ORDER BY db_id'.format(
+                ', '.join(self.OVERVIEW_COLUMNS)))
+            try:
+                rows = cursor.fetchall()
+            except sqlite3.Error, e:
+                raise CatalogError('{0}: {1}'.format(self.path, e))
+
+        return [self._row_to_overview(row) for row in rows]
+
+
+    def get_links(self):
+        """Return a list of (disc_id, link_type, linked_disc_id) for all
+        discs that are linked to another disc.
+        """
+
+        with self._lock:
+            cursor = self._execute('SELECT disc_id, link_type, linked_disc_id FROM discs '
+                                   'WHERE link_type IS NOT NULL')
+            try:
+                rows = cursor.fetchall()
+            except sqlite3.Error, e:
+                raise CatalogError('{0}: {1}'.format(self.path, e))
+
+        return [(str(disc_id), str(link_type), linked_disc_id and str(linked_disc_id))
+                for disc_id, link_type, linked_disc_id in rows]
+
+
+    def get_version(self):
+        """Return a Version for the current state of the catalog."""
+        with self._lock:
+            return self._get_version(self._connect())
+
+
+    def get_changes(self, since):
+        """Return a tuple (version, discs), where discs is a list of
+        DiscOverview objects for the discs changed after the journal
+        sequence number SINCE, in db_id order.
+
+        If SINCE isn't a sequence number in the current journal, e.g.
+        because the catalog has been rebuilt since then or the changes
+        have been pruned from the journal, discs is None and the
+        client must list all discs again.  Discs that have
+        been removed are not included.
+        """
+
+        with self._transaction() as conn:
+            version = self._get_version(conn)
+
+            row = conn.execute("SELECT value FROM meta WHERE key = 'reset_seq'").fetchone()
+            reset_seq = int(row[0]) if row else 0
+
+            if since < reset_seq or since > version.seq:
+                return version, None
+
+            rows = conn.execute(
+                'SELECT {0} FROM discs WHERE db_id IN '
+                '(SELECT db_id FROM changes WHERE seq > ?) '
+                'ORDER BY db_id'.format(', '.join(self.OVERVIEW_COLUMNS)),
+                (since, )).fetchall()
+
+        return version, [self._row_to_overview(row) for row in rows]
+
+
+    def search(self, query, offset = 0, limit = None):
+        """Return a list of DiscOverview objects for the discs
+        matching all words in QUERY, best matches first.  Each query
+        word matches disc words it is a prefix of.
+
+        OFFSET and LIMIT select a part of the result list.
+        """
+
+        words = sorted(set(split_words(query)))
+        if not words:
+            return []
+
+        # One (db_id, weight) row for each disc matching each word
+        matches = ' UNION ALL '.join(
+            ['SELECT db_id, MAX(weight) AS weight FROM words '
+             'WHERE word >= ? AND word < ? GROUP BY db_id'] * len(words))
+
+        args = []
+        for w in words:
+            args.append(w)
+            args.append(w + u'\uffff')
+
+        args.append(len(words))
+        args.append(-1 if limit is None else limit)
+        args.append(offset)
+
+        sql = ('SELECT {0} FROM discs JOIN ({1}) AS matches USING (db_id) '
+               'GROUP BY db_id HAVING COUNT(*) = ? '
+               'ORDER BY SUM(matches.weight) DESC, artist, title, db_id '
+               'LIMIT ? OFFSET ?').format(
+                   ', '.join('discs.' + c for c in self.OVERVIEW_COLUMNS), matches)
+
+        with self._lock:
+            cursor = self._execute(sql, args)
+            try:
+                rows = cursor.fetchall()
+            except sqlite3.Error, e:
+                raise CatalogError('{0}: {1}'.format(self.path, e))
+
+        return [self._row_to_overview(row) for row in rows]
+
+
+    @classmethod
+    def search_discs(cls, query, discs, offset = 0, limit = None):
+        """Search DISCS, an iterator of (db_id, DbDisc) tuples, like
+        search() does the catalog.  This is used to search the disc
+        files when the catalog hasn't been built.
+        """
+
+        words = sorted(set(split_words(query)))
+        if not words:
+            return []
+
+        matches = []
+        for db_id, disc in discs:
+            disc_words = cls.get_disc_words(disc)
+            score = 0
+            for w in words:
+                weight = max([weight for word, weight in disc_words.iteritems()
+                              if word.startswith(w)] or [0])
+                if weight == 0:
+                    break
+                score += weight
+            else:
+                matches.append((-score, disc.artist, disc.title, db_id, disc))
+
+        matches.sort()
+        end = None if limit is None else offset + limit
+        return [model.DiscOverview(m[-1]) for m in matches[offset:end]]
+
+
+    @classmethod
+    def get_disc_words(cls, disc):
+        """Return a dict mapping the search words in DISC to their
+        ranking weight.
+        """
+
+        weights = {}
+
+        def add(text, weight):
+            for word in split_words(text):
+                weights[word] = max(weight, weights.get(word, 0))
+
+        for attr, weight in cls.DISC_WORD_WEIGHTS:
+            add(getattr(disc, attr), weight)
+
+        for track in disc.tracks:
+            for attr, weight in cls.TRACK_WORD_WEIGHTS:
+                add(getattr(track, attr), weight)
+
+        return weights
+
+
+    def rebuild(self, discs):
+        """Replace the catalog contents with DISCS, an iterator of
+        (db_id, DbDisc) tuples.  The catalog is then marked as
+        complete.
+
+        The discs are written in batches to temporary tables, so other
+        threads and processes can use the catalog while the discs are
+        read.  The tables are then copied into the catalog in a single
+        transaction, keeping the current entries of discs that were
+        changed by someone else in the meantime.
+
+        Since the changes to the discs aren't known, this resets the
+        journal and clients must list all discs again.
+        """
+        with self._transaction(write = True) as conn:
+            start_seq = self._get_version(conn).seq
+
+        with self._transaction() as conn:
+            for table in ('discs', 'words'):
+                conn.execute('DROP TABLE IF EXISTS temp.rebuild_{0}'.format(table))
+                conn.execute('CREATE TEMP TABLE rebuild_{0} AS '
+                             'SELECT * FROM main.{0} WHERE 0'.format(table))
+
+        batch = []
+        for db_id, disc in discs:
+            batch.append((db_id, disc))
+            if len(batch) >= self.REBUILD_BATCH:
+                self._rebuild_batch(batch)
+                batch = []
+
+        self._rebuild_batch(batch)
+
+        with self._transaction(write = True) as conn:
+            for table in ('discs', 'words'):
+                # Discs updated or removed since the rebuild started
+                # are already current in the catalog
+                changed = 'SELECT db_id FROM changes WHERE seq > ?'
+                conn.execute('DELETE FROM temp.rebuild_{0} WHERE db_id IN ({1})'.format(
+                    table, changed), (start_seq, ))
+                conn.execute('INSERT INTO temp.rebuild_{0} '
+                             'SELECT * FROM main.{0} WHERE db_id IN ({1})'.format(
+                                 table, changed), (start_seq, ))
+
+                conn.execute('DELETE FROM main.{0}'.format(table))
+                conn.execute('INSERT INTO main.{0} SELECT * FROM temp.rebuild_{0}'.format(table))
+
+            seq = self._add_change(conn, None, 'rebuild')
+            conn.execute('DELETE FROM changes WHERE seq < ?', (seq, ))
+            conn.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('reset_seq', ?)",
+                         (str(seq), ))
+            conn.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('complete', '1')")
+
+        with self._transaction() as conn:
+            conn.execute('DROP TABLE temp.rebuild_discs')
+            conn.execute('DROP TABLE temp.rebuild_words')
+
+
+    #
+    # Internal methods
+    #
+
+    def _connect(self):
+        if self._conn is not None and self._pid == os.getpid():
+            return self._conn
+
+        # Don't touch a connection inherited over fork, just drop it
+        self._conn = None
+
+        try:
+            conn = sqlite3.connect(self.path, timeout = self.BUSY_TIMEOUT,
+                                   check_same_thread = False)
+        except sqlite3.Error, e:
+            raise CatalogError('{0}: {1}'.format(self.path, e))
+
+        self._conn = conn
+        self._pid = os.getpid()
+        self._has_schema = False
+        return conn
+
+
+    def _create_schema(self, conn):
+        # Must be called before writing to the catalog, in a transaction
+        if self._has_schema:
+            return
+
+        conn.execute('CREATE TABLE IF NOT EXISTS meta ('
+                     'key TEXT PRIMARY KEY, value TEXT)')
+
+        row = conn.execute("SELECT value FROM meta WHERE key = 'version'").fetchone()
+        if row is not None and row[0] != str(self.SCHEMA_VERSION):
+            # The catalog only holds data copied from the disc
+            # files, so just start over with the current schema
+            conn.execute('DROP TABLE IF EXISTS discs')
+            conn.execute('DROP TABLE IF EXISTS words')
+            conn.execute('DROP TABLE IF EXISTS changes')
+            conn.execute('DELETE FROM meta')
+            row = None
+
+        conn.execute('CREATE TABLE IF NOT EXISTS discs ('
+                     'db_id TEXT PRIMARY KEY, '
+                     'disc_id TEXT NOT NULL, '
+                     'mb_id TEXT, '
+                     'cover_mb_id TEXT, '
+                     'tracks INTEGER NOT NULL, '
+                     'catalog TEXT, '
+                     'title TEXT, '
+                     'artist TEXT, '
+                     'barcode TEXT, '
+                     'date TEXT, '
+                     'link_type TEXT, '
+                     'linked_disc_id TEXT)')
+        conn.execute('CREATE TABLE IF NOT EXISTS words ('
+                     'word TEXT NOT NULL, '
+                     'db_id TEXT NOT NULL, '
+                     'weight INTEGER NOT NULL)')
+        conn.execute('CREATE INDEX IF NOT EXISTS words_word ON words (word)')
+        conn.execute('CREATE INDEX IF NOT EXISTS words_db_id ON words (db_id)')
+        conn.execute('CREATE TABLE IF NOT EXISTS changes ('
+                     'seq INTEGER PRIMARY KEY AUTOINCREMENT, '
+                     'db_id TEXT, '
+                     'event TEXT NOT NULL, '
+                     'timestamp REAL NOT NULL)')
+
+        if row is None:
+            conn.execute("INSERT INTO meta (key, value) VALUES ('version', ?)",
+                         (str(self.SCHEMA_VERSION), ))
+            conn.execute("INSERT INTO meta (key, value) VALUES ('id', ?)",
+                         (uuid.uuid4().hex, ))
+
+        self._has_schema = True
+
+
+    def _execute(self, sql, args = ()):
+        try:
+            return self._connect().execute(sql, args)
+        except sqlite3.Error, e:
+            raise CatalogError('{0}: {1}'.format(self.path, e))
+
+
+    def _transaction(self, write = False):
+        return _Transaction(self, write)
+
+
+    def _rebuild_batch(self, batch):
+        # The temporary tables are private to the connection, so
+        # writing them doesn't lock the catalog file
+        with self._transaction() as conn:
+            for db_id, disc in batch:
+                self._insert_overview(conn, db_id, model.DiscOverview(disc),
+                                      'temp.rebuild_discs')
+                self._insert_words(conn, db_id, disc, 'temp.rebuild_words')
+
+
+    def _insert_overview(self, conn, db_id, overview, table = 'discs'):
+        conn.execute(
+            'INSERT OR REPLACE INTO {0} (db_id, {1}) VALUES (?, {2})'.format(
+                table, ', '.join(self.OVERVIEW_COLUMNS),
+                ', '.join('?' * len(self.OVERVIEW_COLUMNS))),
+            [db_id] + [getattr(overview, c) for c in self.OVERVIEW_COLUMNS])
+
+
+    def _add_change(self, conn, db_id, event):
+        cursor = conn.execute(
+            'INSERT INTO changes (db_id, event, timestamp) VALUES (?, ?, ?)',
+            (db_id, event, time.time()))
+        return cursor.lastrowid
+
+
+    def _prune_changes(self, conn, seq):
+        # Drop changes outside the window, and make get_changes()
+        # return None for sequence numbers before it
+        cutoff = seq - self.CHANGES_WINDOW
+        cursor = conn.execute('DELETE FROM changes WHERE seq <= ?', (cutoff, ))
+        if cursor.rowcount > 0:
+            row = conn.execute("SELECT value FROM meta WHERE key = 'reset_seq'").fetchone()
+            if row is None or int(row[0]) < cutoff:
+                conn.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('reset_seq', ?)",
+                             (str(cutoff), ))
+
+
+    def _get_version(self, conn):
+        try:
+            catalog_id = conn.execute("SELECT value FROM meta WHERE key = 'id'").fetchone()[0]
+            row = conn.execute(
+                'SELECT seq, timestamp FROM changes ORDER BY seq DESC LIMIT 1').fetchone()
+        except sqlite3.Error, e:
+            raise CatalogError('{0}: {1}'.format(self.path, e))
+
+        if row is None:
+            return Version(str(catalog_id), 0, None)
+        else:
+            return Version(str(catalog_id), row[0], row[1])
+
+
+    def _insert_words(self, conn, db_id, disc, table = 'words'):
+        conn.executemany(
+            'INSERT INTO {0} (word, db_id, weight) VALUES (?, ?, ?)'.format(table),
+            [(word, db_id, weight) for word, weight in self.get_disc_words(disc).iteritems()])
+
+
+    def _row_to_overview(self, row):
+        overview = model.DiscOverview()
+        for column, value in zip(self.OVERVIEW_COLUMNS, row):
+            # The Disc attributes that are str in the JSON files
+            if column in ('disc_id', 'mb_id', 'cover_mb_id', 'link_type', 'linked_disc_id') \
+               and value is not None:
+                value = str(value)
+            setattr(overview, column, value)
+        return overview
+
+
+class _Transaction(object):
+    """Context manager running a block in a catalog transaction,
+    holding the catalog lock.
+    """
+
+    def __init__(self, catalog, write):
+        self._catalog = catalog
+        self._write = write
+
+    def __enter__(self):
+        self._catalog._lock.acquire()
+        try:
+            conn = self._catalog._connect()
+            if self._write:
+                self._catalog._create_schema(conn)
+            return conn
+        except sqlite3.Error, e:
+            self._catalog._has_schema = False
+            self._catalog._conn.rollback()
+            self._catalog._lock.release()
+            raise CatalogError('{0}: {1}'.format(self._catalog.path, e))
+        except:
+            self._catalog._lock.release()
+            raise
+
+    def __exit__(self, exc_type, exc_value, tb):
+        try:
+            conn = self._catalog._conn
+            if exc_type is None:
+                conn.commit()
+            else:
+                # The schema may have been rolled back too
+                self._catalog._has_schema = False
+                conn.rollback()
+
+        except sqlite3.Error, e:
+            raise CatalogError('{0}: {1}'.format(self._catalog.path, e))
+
+        finally:
+            self._catalog._lock.release()
+
+        if isinstance(exc_value, sqlite3.Error):
+            raise CatalogError('{0}: {1}'.format(self._catalog.path, exc_value))
+
+        return False
+
+
+_word_re = re.compile(r'\w+', re.UNICODE)
+
+def split_words(text):
+    """Return a list of the words in TEXT, in lower case and without
+    any accents so that they can be searched for without typing them.
+    """
+
+    if not text:
+        return []
+
+    if not isinstance(text, unicode):
+        text = text.decode('utf-8', 'replace')
+
+    text = unicodedata.normalize('NFKD', text.lower())
+    text = u''.join(c for c in text if not unicodedata.combining(c))
+    return _word_re.findall(text)
@@ -0,0 +1,592 @@
+# codplayer - losslessly compressed CD audio files
+#
+# Copyright 2018 Peter Liljenberg <peter.liljenberg@gmail.com>
+#
+# Distributed under an MIT license, please see LICENSE in the top dir.
+
+"""
+Store disc audio losslessly compressed, in blocks that can be decoded
+independently of each other.  A seek table in the header gives the
+file offset of each block, so any position can be read by decoding a
+single block.
+
+Each channel in a block is encoded like in FLAC with a fixed
+polynomial predictor of order 0-2, and the residuals are Rice coded.
+To let numpy encode and decode a whole block at once, the unary
+quotients and the binary remainders of the Rice codes are kept in two
+separate bit streams.
+
+Format, all integers in network byte order:
+
+  header:  magic 'CODZ', format version, frames per block, total
+           number of frames, number of blocks
+  table:   file offset of each block, and of the end of the last block
+  blocks:  mode byte, then for a raw block the big-endian samples, or
+           for a Rice block for each channel: predictor order, Rice
+           parameter, length of the quotient stream, quotient stream,
+           remainder stream
+
+This requires numpy, which is an optional dependency.
+"""
+
+import os
+import time
+import struct
+import threading
+import tempfile
+import zlib
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+from . import db
+from . import model
+from . import serialize
+from . import workpool
+
+
+class CDZError(Exception):
+    pass
+
+
+MAGIC = 'CODZ'
+VERSION = 1
+
+HEADER = struct.Struct('!4sBIQI')
+OFFSET = struct.Struct('!Q')
+CHANNEL = struct.Struct('!BBI')
+
+MODE_RAW = 0
+MODE_RICE = 1
+
+# One second of audio per block
+BLOCK_FRAMES = model.PCM.rate
+
+CHANNELS = model.PCM.channels
+BYTES_PER_FRAME = model.PCM.bytes_per_frame
+
+MAX_ORDER = 2
+
+
+def _check_numpy():
+    if numpy is None:
+        raise CDZError('numpy is required for compressed audio files')
+
+
+#
+# Block coding
+#
+
+def encode_block(data):
+    """Return a string with the big-endian PCM DATA compressed.
+    """
+
+    _check_numpy()
+
+    frames = numpy.frombuffer(data, dtype = '>i2').reshape(-1, CHANNELS)
+    parts = [chr(MODE_RICE)]
+
+    for c in range(CHANNELS):
+        _encode_channel(parts, frames[:, c].astype(numpy.int32))
+
+    block = ''.join(parts)
+    if len(block) >= len(data) + 1:
+        # Incompressible, e.g. noise
+        return chr(MODE_RAW) + data
+    return block
+
+
+def _encode_channel(parts, samples):
+    # Pick the predictor order with the smallest residuals
+    residuals = samples
+    best = None
+    for order in range(MAX_ORDER + 1):
+        total = int(numpy.abs(residuals).sum())
+        if best is None or total < best[0]:
+            best = (total, order, residuals)
+        residuals = numpy.diff(residuals, prepend = 0)
+
+    total, order, residuals = best
+
+    # Zigzag encode to unsigned
+    z = ((residuals << 1) ^ (residuals >> 31)).astype(numpy.uint32)
+
+    # Rice parameter from the mean value
+    mean = total * 2 // max(len(z), 1)
+    k = max(mean.bit_length() - 1, 0) if mean else 0
+
+    # Unary quotients: q ones followed by a zero
+    q = z >> k
+    bits = numpy.ones(int(q.sum()) + len(q), dtype = numpy.uint8)
+    bits[numpy.cumsum(q + 1) - 1] = 0
+    quotients = numpy.packbits(bits).tostring()
+
+    # Remainders: k bits each
+    if k:
+        shifts = numpy.arange(k - 1, -1, -1, dtype = numpy.uint32)
+        rbits = ((z[:, numpy.newaxis] >> shifts) & 1).astype(numpy.uint8)
+        remainders = numpy.packbits(rbits).tostring()
+    else:
+        remainders = ''
+
+    parts.append(CHANNEL.pack(order, k, len(quotients)))
+    parts.append(quotients)
+    parts.append(remainders)
+
+
+def decode_block(block, num_frames):
+    """Return the big-endian PCM data of NUM_FRAMES frames decoded
+    from the string BLOCK.
+    """
+
+    _check_numpy()
+
+    mode = ord(block[0])
+    if mode == MODE_RAW:
+        data = block[1:]
+        if len(data) != num_frames * BYTES_PER_FRAME:
+            raise CDZError('bad raw block length')
+        return data
+
+    if mode != MODE_RICE:
+        raise CDZError('unknown block mode: {0}'.format(mode))
+
+    frames = numpy.empty((num_frames, CHANNELS), dtype = '>i2')
+    pos = 1
+    try:
+        for c in range(CHANNELS):
+            order, k, qlen = CHANNEL.unpack_from(block, pos)
+            pos += CHANNEL.size
+
+            if order > MAX_ORDER:
+                raise CDZError('bad predictor order: {0}'.format(order))
+
+            bits = numpy.unpackbits(numpy.frombuffer(block, numpy.uint8, qlen, pos))
+            pos += qlen
+
+            ends = numpy.flatnonzero(bits == 0)[:num_frames]
+            if len(ends) != num_frames:
+                raise CDZError('truncated block')
+            q = numpy.diff(ends, prepend = -1) - 1
+            z = q.astype(numpy.uint32) << k
+
+            if k:
+                rlen = (num_frames * k + 7) // 8
+                rbits = numpy.unpackbits(numpy.frombuffer(block, numpy.uint8, rlen, pos))
+                pos += rlen
+                rbits = rbits[:num_frames * k].reshape(num_frames, k).astype(numpy.uint32)
+                z |= rbits.dot(numpy.uint32(1) << numpy.arange(k - 1, -1, -1, dtype = numpy.uint32))
+
+            samples = (z >> 1).astype(numpy.int32) ^ -(z & 1).astype(numpy.int32)
+            for i in range(order):
+                samples = numpy.cumsum(samples, dtype = numpy.int32)
+
+            frames[:, c] = samples
+
+    except (struct.error, ValueError), e:
+        raise CDZError('corrupt block: {0}'.format(e))
+
+    if pos != len(block):
+        raise CDZError('trailing data in block')
+
+    return frames.tostring()
+
+
+#
+# Files
+#
+
+class Header(object):
+    def __init__(self, block_frames, total_frames):
+        self.block_frames = block_frames
+        self.total_frames = total_frames
+        self.num_blocks = (total_frames + block_frames - 1) // block_frames
+        self.offsets = None
+
+    @property
+    def table_size(self):
+        return OFFSET.size * (self.num_blocks + 1)
+
+    @property
+    def data_start(self):
+        return HEADER.size + self.table_size
+
+    def block_length(self, block):
+        """Return the number of frames in BLOCK."""
+        return min(self.block_frames, self.total_frames - block * self.block_frames)
+
+    def pack(self):
+        return (HEADER.pack(MAGIC, VERSION, self.block_frames,
+                            self.total_frames, self.num_blocks)
+                + ''.join(OFFSET.pack(o) for o in self.offsets))
+
+    @classmethod
+    def read(cls, f):
+        data = f.read(HEADER.size)
+        try:
+            magic, version, block_frames, total_frames, num_blocks = HEADER.unpack(data)
+        except struct.error:
+            raise CDZError('truncated header')
+
+        if magic != MAGIC or version != VERSION:
+            raise CDZError('not a compressed audio file')
+
+        if block_frames == 0:
+            raise CDZError('bad header')
+
+        header = cls(block_frames, total_frames)
+        if header.num_blocks != num_blocks:
+            raise CDZError('bad header')
+
+        data = f.read(header.table_size)
+        if len(data) != header.table_size:
+            raise CDZError('truncated seek table')
+
+        header.offsets = [OFFSET.unpack_from(data, i * OFFSET.size)[0]
+                          for i in xrange(num_blocks + 1)]
+        return header
+
+
+def compress_file(src_path, dest_path, block_frames = BLOCK_FRAMES, progress = None):
+    """Compress the raw big-endian PCM file SRC_PATH into DEST_PATH.
+    The file is written to a temporary file that is renamed when
+    complete.
+
+    PROGRESS is called with (frames_done, total_frames) after each
+    block.
+
+    Returns the CRC32 of the raw audio.
+    """
+
+    _check_numpy()
+
+    size = os.stat(src_path).st_size
+    if size % BYTES_PER_FRAME:
+        raise CDZError('{0}: not a whole number of frames'.format(src_path))
+
+    header = Header(block_frames, size // BYTES_PER_FRAME)
+    header.offsets = [0] * (header.num_blocks + 1)
+
+    dir, base = os.path.split(dest_path)
+    fd, temp_path = tempfile.mkstemp(dir = dir, prefix = '.' + base + '.')
+    crc = 0
+
+    try:
+        with os.fdopen(fd, 'wb') as out, open(src_path, 'rb') as f:
+            # Leave room for the seek table
+            out.write('\0' * header.data_start)
+            offset = header.data_start
+
+            for block in xrange(header.num_blocks):
+                data = f.read(header.block_length(block) * BYTES_PER_FRAME)
+                if len(data) != header.block_length(block) * BYTES_PER_FRAME:
+                    raise CDZError('{0}: file changed while compressing'.format(src_path))
+
+                crc = zlib.crc32(data, crc)
+                encoded = encode_block(data)
+                header.offsets[block] = offset
+                out.write(encoded)
+                offset += len(encoded)
+
+                if progress:
+                    progress((block + 1) * block_frames, header.total_frames)
+
+            header.offsets[-1] = offset
+            out.seek(0)
+            out.write(header.pack())
+            out.flush()
+            os.fsync(out.fileno())
+
+        os.chmod(temp_path, serialize.SAVE_PERMISSIONS)
+        os.rename(temp_path, dest_path)
+
+    except:
+        if os.path.exists(temp_path):
+            os.unlink(temp_path)
+        raise
+
+    return crc & 0xffffffff
+
+
+class CDZFile(object):
+    """Read a compressed audio file as if it was the raw PCM file,
+    with seek() and read() on the decoded data.
+
+    If READ_AHEAD is more than zero, a thread decodes that many blocks
+    after the last one read, so sequential reads rarely have to wait
+    for decoding.
+    """
+
+    def __init__(self, path, read_ahead = 0):
+        _check_numpy()
+
+        self.path = path
+        self._file = open(path, 'rb')
+        try:
+            self.header = Header.read(self._file)
+        except:
+            self._file.close()
+            raise
+
+        self.size = self.header.total_frames * BYTES_PER_FRAME
+        self._block_bytes = self.header.block_frames * BYTES_PER_FRAME
+        self._pos = 0
+
+        # Decoded blocks by number
+        self._cache = {}
+        self._cond = threading.Condition()
+        self._read_ahead = read_ahead
+        self._next_block = 0
+        self._closed = False
+        self._thread = None
+
+        if read_ahead > 0:
+            self._thread = threading.Thread(target = self._decode_ahead,
+                                            name = 'CDZFile decoder')
+            self._thread.daemon = True
+            self._thread.start()
+
+
+    def close(self):
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+
+        if self._thread:
+            self._thread.join()
+            self._thread = None
+
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+    def seek(self, pos):
+        self._pos = pos
+
+    def tell(self):
+        return self._pos
+
+    def read(self, length):
+        parts = []
+        while length > 0 and self._pos < self.size:
+            block, offset = divmod(self._pos, self._block_bytes)
+            data = self._get_block(block)[offset : offset + length]
+            parts.append(data)
+            self._pos += len(data)
+            length -= len(data)
+
+        return ''.join(parts)
+
+
+    def _read_block(self, f, block):
+        start = self.header.offsets[block]
+        end = self.header.offsets[block + 1]
+        f.seek(start)
+        data = f.read(end - start)
+        if len(data) != end - start:
+            raise CDZError('{0}: truncated file'.format(self.path))
+
+        try:
+            return decode_block(data, self.header.block_length(block))
+        except CDZError, e:
+            raise CDZError('{0}: block {1}: {2}'.format(self.path, block, e))
+
+
+    def _get_block(self, block):
+        with self._cond:
+            # Tell the decoding thread where we are
+            self._next_block = block + 1
+            self._cond.notify_all()
+
+            data = self._cache.get(block)
+            if data is not None:
+                return data
+
+        data = self._read_block(self._file, block)
+
+        with self._cond:
+            self._cache[block] = data
+            self._evict()
+
+        return data
+
+
+    def _evict(self):
+        # Keep the last block read and the ones decoded ahead
+        first = self._next_block - 1
+        for b in self._cache.keys():
+            if b < first or b > first + self._read_ahead:
+                del self._cache[b]
+
+
+    def _decode_ahead(self):
+        # Use a separate file object to not interfere with reads
+        with open(self.path, 'rb') as f:
+            while True:
+                with self._cond:
+                    while True:
+                        if self._closed:
+                            return
+
+                        wanted = [b for b in xrange(self._next_block,
+                                                    min(self._next_block + self._read_ahead,
+                                                        self.header.num_blocks))
+                                  if b not in self._cache]
+                        if wanted:
+                            block = wanted[0]
+                            break
+
+                        self._cond.wait()
+
+                try:
+                    data = self._read_block(f, block)
+                except (CDZError, IOError):
+                    # Leave it to the reader to report
+                    data = None
+
+                with self._cond:
+                    if data is None:
+                        # Don't retry until the reader has moved on
+                        while self._next_block <= block and not self._closed:
+                            self._cond.wait()
+                    elif block >= self._next_block:
+                        self._cache[block] = data
+                        self._evict()
+
+
+def open_audio(path, data_file_format, read_ahead = 0):
+    """Open the disc audio file PATH, returning a file-like object
+    with the raw PCM data whatever the DATA_FILE_FORMAT.
+    """
+    if data_file_format is model.COMPRESSED_CD:
+        return CDZFile(path, read_ahead)
+    else:
+        return open(path, 'rb')
+
+
+def get_audio_size(path, data_file_format):
+    """Return the size of the raw PCM data in the disc audio file PATH.
+    """
+    if data_file_format is model.COMPRESSED_CD:
+        with open(path, 'rb') as f:
+            return Header.read(f).total_frames * BYTES_PER_FRAME
+    else:
+        return os.stat(path).st_size
+
+
+#
+# Compressing discs in the database
+#
+
+class CompressResult(object):
+    """The outcome of compressing a disc.  If it was compressed,
+    raw_size and compressed_size are the file sizes in bytes.
+    Otherwise skipped or error is a string saying why not.
+    """
+
+    def __init__(self, db_id, raw_size = 0, compressed_size = 0,
+                 skipped = None, error = None):
+        self.db_id = db_id
+        self.raw_size = raw_size
+        self.compressed_size = compressed_size
+        self.skipped = skipped
+        self.error = error
+
+
+def compress_disc(database, db_id):
+    """Replace the raw audio file of disc DB_ID in DATABASE with a
+    compressed file, returning a CompressResult.
+
+    The compressed file is decoded and checked against the raw file
+    before the disc info is updated to use it, and the raw file is
+    only removed after that.  Discs that are not fully ripped or were
+    changed recently are skipped.
+    """
+
+    try:
+        disc = database.get_disc_by_db_id(db_id)
+        if disc is None:
+            return CompressResult(db_id, error = 'missing disc info file')
+
+        if disc.data_file_format is model.COMPRESSED_CD:
+            return CompressResult(db_id, skipped = 'already compressed')
+
+        if not disc.rip:
+            return CompressResult(db_id, skipped = 'not fully ripped')
+
+        raw_path = database.get_audio_path(db_id)
+        before = os.stat(raw_path)
+
+        if before.st_mtime > time.time() - database.MOVE_QUIET_SECS:
+            return CompressResult(db_id, skipped = 'changed recently')
+
+        if before.st_size != disc.get_disc_file_size_bytes():
+            return CompressResult(db_id, error = 'audio file is {0} bytes, expected {1}'.format(
+                before.st_size, disc.get_disc_file_size_bytes()))
+
+        path = database.get_compressed_audio_path(db_id)
+        crc = compress_file(raw_path, path)
+
+        try:
+            decoded_crc = 0
+            with CDZFile(path) as f:
+                while True:
+                    data = f.read(BLOCK_FRAMES * BYTES_PER_FRAME)
+                    if not data:
+                        break
+                    decoded_crc = zlib.crc32(data, decoded_crc)
+
+            if decoded_crc & 0xffffffff != crc:
+                raise CDZError('compressed file does not match the raw file')
+
+            after = os.stat(raw_path)
+            if (after.st_size, after.st_mtime) != (before.st_size, before.st_mtime):
+                raise CDZError('audio file changed while compressing')
+
+            # Reload, in case the disc info changed meanwhile
+            disc = database.get_disc_by_db_id(db_id)
+            disc.data_file_name = database.get_compressed_audio_file(db_id)
+            disc.data_file_format = model.COMPRESSED_CD
+            database.save_disc_info(disc)
+
+        except:
+            os.unlink(path)
+            raise
+
+        # A player reading the raw file keeps it open until it stops,
+        # and then opens the file in the updated disc info
+        os.unlink(raw_path)
+
+        return CompressResult(db_id, before.st_size, os.stat(path).st_size)
+
+    except (CDZError, db.DatabaseError, IOError, OSError), e:
+        return CompressResult(db_id, error = str(e))
+
+
+def compress_database(database, db_ids = None, processes = 1, niceness = 10,
+                      progress = None):
+    """Compress the discs DB_IDS (default all discs) in DATABASE, in a
+    pool of PROCESSES processes running at a lower priority by
+    NICENESS, so the player isn't disturbed.
+
+    PROGRESS is called with (count, total, CompressResult) as each
+    disc is done, in the order they finish.
+
+    Returns a list of CompressResult objects.
+    """
+
+    _check_numpy()
+
+    if db_ids is None:
+        db_ids = list(database.iterdiscs_db_ids())
+
+    return workpool.run_jobs(database, compress_disc, [(db_id, ) for db_id in db_ids],
+                             processes = processes, niceness = niceness,
+                             progress = progress)
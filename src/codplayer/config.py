@@ -75,6 +75,7 @@ class MQConfig(Config):
         serialize.Attr('input', zerohub.Topic),
         serialize.Attr('player_rpc', zerohub.RPC),
         serialize.Attr('player_commands', zerohub.Queue),
+        serialize.Attr('db', zerohub.Topic, optional = True),
         )
 
 
@@ -91,14 +92,26 @@ class PlayerConfig(DaemonConfig):
         serialize.Attr('eject_command', str),
         serialize.Attr('audio_device_type', str),
         serialize.Attr('start_without_device', bool),
+        serialize.Attr('audio_output_rate', int, optional = True),
         serialize.Attr('log_performance', bool),
         serialize.Attr('radio_stations', list_type=radio.Station, optional=True),
+        serialize.Attr('radio_decoder_process', bool, optional = True, default = False),
+        serialize.Attr('radio_standby', bool, optional = True, default = False),
+        serialize.Attr('radio_buffer_min_secs', (int, float), optional = True, default = 1),
+        serialize.Attr('radio_buffer_max_secs', (int, float), optional = True, default = 10),
+        serialize.Attr('radio_timeshift_file', str, optional = True),
+        serialize.Attr('radio_timeshift_size_mb', int, optional = True, default = 100),
 
         # File device options
         serialize.Attr('file_play_speed', int),
 
         # Alsa device options
         serialize.Attr('alsa_card', str),
+        serialize.Attr('alsa_use_mmap', bool, optional = True, default = False),
+        serialize.Attr('alsa_thread_policy', str, optional = True, default = 'rr'),
+        serialize.Attr('alsa_thread_priority', int, optional = True, default = 0),
+        serialize.Attr('alsa_thread_cpus', list_type = int, optional = True),
+        serialize.Attr('alsa_lock_memory', bool, optional = True, default = False),
 
         )
 
@@ -0,0 +1,209 @@
+# codplayer - sample rate and format conversion
+#
+# Copyright 2018 Peter Liljenberg <peter.liljenberg@gmail.com>
+#
+# Distributed under an MIT license, please see LICENSE in the top dir.
+
+"""
+Convert audio packets to a single output format, so that all sources
+can share one device configuration.
+
+This requires numpy, which is an optional dependency.  The conversion
+is only enabled if audio_output_rate is set in codplayer.conf.
+"""
+
+import sys
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+from . import model
+
+
+class ConvertError(Exception):
+    pass
+
+
+class FormatConverter(object):
+    """Convert audio packets to 16-bit samples in native byte order
+    with a fixed rate and number of channels, so all packets have the
+    same format.
+
+    Packets already in the output rate and number of channels are
+    only byte swapped if necessary.
+
+    The resampling is a linear interpolation between frames.  When
+    downsampling, a windowed-sinc low-pass filter is first applied to
+    avoid aliasing.  With FILTER_TAPS taps it has a fairly wide
+    transition band, so some of the top octave below the output
+    Nyquist frequency is attenuated too.
+
+    The converter keeps the last frames of the previous packet, so
+    the packets of a stream must be passed in order.  Call reset()
+    when starting on a new stream.
+    """
+
+    # Length of the anti-aliasing filter
+    FILTER_TAPS = 31
+
+    # Filter cutoff, as a fraction of the output Nyquist frequency
+    FILTER_CUTOFF = 0.9
+
+    def __init__(self, rate, channels = 2):
+        if numpy is None:
+            raise ConvertError('numpy is required for audio format conversion')
+
+        self.format = model.Format(channels = channels,
+                                   bytes_per_sample = 2,
+                                   rate = rate,
+                                   big_endian = (sys.byteorder != 'little'))
+        self._out_dtype = numpy.dtype('=i2')
+        self.reset()
+
+
+    def reset(self):
+        """Forget the state of the current stream."""
+        self._in_format = None
+        self._in_dtype = None
+        self._step = None
+        self._pos = 0.0
+        self._prev = None
+        self._taps = None
+        self._history = None
+
+
+    def needs_conversion(self, format):
+        return (format.rate != self.format.rate
+                or format.channels != self.format.channels
+                or format.bytes_per_sample != self.format.bytes_per_sample)
+
+
+    def convert(self, packet):
+        """Convert the data in PACKET to the output format, updating
+        packet.data and packet.format in place.
+
+        Returns the packet.
+        """
+
+        format = packet.format
+        if not self.needs_conversion(format):
+            if format.big_endian != self.format.big_endian:
+                samples = numpy.frombuffer(packet.data, dtype = self._out_dtype)
+                packet.data = samples.byteswap().tostring()
+                packet.format = self.format
+            return packet
+
+        if not self._same_input_format(format):
+            self._set_input_format(format)
+
+        frames = numpy.frombuffer(packet.data, dtype = self._in_dtype)
+        frames = frames[:len(frames) - len(frames) % format.channels]
+        frames = self._map_channels(frames.reshape(-1, format.channels))
+
+        if format.rate != self.format.rate:
+            frames = self._resample(frames)
+
+        packet.data = frames.astype(self._out_dtype).tostring()
+        packet.format = self.format
+        return packet
+
+
+    def _same_input_format(self, format):
+        f = self._in_format
+        return (f is not None
+                and f.rate == format.rate
+                and f.channels == format.channels
+                and f.bytes_per_sample == format.bytes_per_sample
+                and f.big_endian == format.big_endian)
+
+
+    def _set_input_format(self, format):
+        if format.bytes_per_sample != 2:
+            raise ConvertError('unsupported bytes per sample: {}'.format(
+                format.bytes_per_sample))
+
+        self.reset()
+        self._in_format = format
+        self._in_dtype = numpy.dtype('>i2' if format.big_endian else '<i2')
+        self._step = float(format.rate) / self.format.rate
+
+        if self._step > 1:
+            self._taps = lowpass_filter(self.FILTER_CUTOFF * 0.5 / self._step,
+                                        self.FILTER_TAPS)
+
+
+    def _map_channels(self, frames):
+        in_channels = frames.shape[1]
+        out_channels = self.format.channels
+
+        if in_channels == out_channels:
+            return frames
+
+        if in_channels == 1:
+            # Mono to anything: copy the channel
+            return numpy.repeat(frames, out_channels, axis = 1)
+
+        if out_channels == 1:
+            # Downmix to mono
+            return frames.mean(axis = 1, keepdims = True)
+
+        # Otherwise just keep the first channels
+        return frames[:, :out_channels]
+
+
+    def _filter(self, frames):
+        # Continue the filter from the end of the previous packet
+        if self._history is None:
+            self._history = numpy.zeros((len(self._taps) - 1, frames.shape[1]),
+                                        dtype = numpy.float32)
+
+        data = numpy.concatenate((self._history, frames))
+        self._history = data[len(frames):]
+
+        out = numpy.empty_like(frames)
+        for ch in range(frames.shape[1]):
+            out[:, ch] = numpy.convolve(data[:, ch], self._taps, mode = 'valid')
+        return out
+
+
+    def _resample(self, frames):
+        frames = frames.astype(numpy.float32)
+
+        if self._taps is not None:
+            frames = self._filter(frames)
+
+        if self._prev is not None:
+            frames = numpy.concatenate((self._prev, frames))
+
+        last = len(frames) - 1
+        if last < 1:
+            # Not enough to interpolate between, wait for more
+            self._prev = frames
+            return numpy.zeros((0, frames.shape[1]), dtype = numpy.float32)
+
+        # Interpolate at these positions, continuing from the
+        # position left over from the previous packet
+        count = max(0, int(numpy.ceil((last - self._pos) / self._step)))
+        pos = self._pos + numpy.arange(count) * self._step
+
+        index = pos.astype(numpy.intp)
+        frac = (pos - index).astype(numpy.float32)[:, numpy.newaxis]
+
+        out = frames[index] * (1 - frac) + frames[index + 1] * frac
+
+        # The last frame is the first one to interpolate from next time
+        self._pos = self._pos + count * self._step - last
+        self._prev = frames[last:]
+
+        return numpy.clip(numpy.rint(out), -32768, 32767)
+
+
+def lowpass_filter(cutoff, taps):
+    """Return the taps of a Hamming-windowed sinc low-pass filter,
+    with CUTOFF given as a fraction of the sample rate.
+    """
+    n = numpy.arange(taps) - (taps - 1) / 2.0
+    h = numpy.sinc(2 * cutoff * n) * numpy.hamming(taps)
+    return (h / h.sum()).astype(numpy.float32)
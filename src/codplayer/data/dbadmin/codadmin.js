@@ -65,8 +65,18 @@ $(function(){
 
         url: 'discs',
 
+        initialize: function() {
+            this.listenTo(Backbone, 'disc-changed', this.onDiscChanged);
+        },
+
         comparator: function(m) {
             return m.sortKey;
+        },
+
+        onDiscChanged: function(change) {
+            // Fetch the new disc info, adding discs that have just been ripped
+            var disc = this.get(change.disc_id) || this.add({ disc_id: change.disc_id });
+            disc.fetch();
         }
     });
 
@@ -105,6 +115,11 @@ $(function(){
 
             this.stateClient = new SockJS(url);
             this.stateClient.onmessage = function(e) {
+                if (e.data.db) {
+                    Backbone.trigger('disc-changed', e.data.db);
+                    return;
+                }
+
                 var player = self.get(e.data.id);
                 if (player) {
                     if (e.data.state) {
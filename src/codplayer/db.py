@@ -13,9 +13,19 @@ import string
 import base64
 import re
 import types
+import copy
+import threading
+import collections
+import multiprocessing.pool
+import shutil
+import tempfile
+import time
 
 from . import model
 from . import serialize
+from . import catalog
+from . import discpack
+from . import links
 
 
 class DatabaseError(Exception):
@@ -35,6 +45,101 @@ class DatabaseError(Exception):
         super(DatabaseError, self).__init__(m)
 
 
+class DiscChange(serialize.Serializable):
+    """Notification that a disc has been created or updated in the
+    database.  event is 'create', 'update' or 'move' (to another
+    storage root), seq is the catalog
+    sequence number of the change, and sender identifies the process
+    that made it, if known.
+    """
+
+    MAPPING = (
+        serialize.Attr('disc_id', str),
+        serialize.Attr('event', str),
+        serialize.Attr('seq', int),
+        serialize.Attr('sender', str, optional = True),
+        )
+
+    def __init__(self, disc_id = None, event = None, seq = None, sender = None):
+        self.disc_id = disc_id
+        self.event = event
+        self.seq = seq
+        self.sender = sender
+
+    def __str__(self):
+        return '{0.event} {0.disc_id} (seq {0.seq})'.format(self)
+
+
+class IOStats(object):
+    """Counters for the disc I/O to a storage root made by this process.
+    Times are in seconds.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.disc_loads = 0
+        self.disc_load_secs = 0.0
+        self.disc_saves = 0
+        self.audio_reads = 0
+        self.audio_read_bytes = 0
+        self.audio_read_secs = 0.0
+        self.moved_bytes = 0
+
+    def add_disc_load(self, secs):
+        with self._lock:
+            self.disc_loads += 1
+            self.disc_load_secs += secs
+
+    def add_disc_save(self):
+        with self._lock:
+            self.disc_saves += 1
+
+    def add_audio_read(self, nbytes, secs):
+        with self._lock:
+            self.audio_reads += 1
+            self.audio_read_bytes += nbytes
+            self.audio_read_secs += secs
+
+    def add_moved(self, nbytes):
+        with self._lock:
+            self.moved_bytes += nbytes
+
+
+class RootInfo(serialize.Serializable):
+    """Disc count, disk space in bytes and IOStats counters for a
+    storage root.
+    """
+
+    MAPPING = (
+        serialize.Attr('path', str),
+        serialize.Attr('discs', int),
+        serialize.Attr('free_bytes', int),
+        serialize.Attr('total_bytes', int),
+        serialize.Attr('disc_loads', int),
+        serialize.Attr('disc_load_secs', float),
+        serialize.Attr('disc_saves', int),
+        serialize.Attr('audio_reads', int),
+        serialize.Attr('audio_read_bytes', int),
+        serialize.Attr('audio_read_secs', float),
+        serialize.Attr('moved_bytes', int),
+        )
+
+    def __init__(self, path = None, discs = 0, stats = None):
+        self.path = path
+        self.discs = discs
+        self.free_bytes = None
+        self.total_bytes = None
+
+        if path:
+            self.free_bytes = get_free_space(path)
+            self.total_bytes = get_total_space(path)
+
+        stats = stats or IOStats()
+        with stats._lock:
+            for attr in self.MAPPING[4:]:
+                setattr(self, attr.name, getattr(stats, attr.name))
+
+
 class Database(object):
     """Access the filesystem database of ripped discs.
 
@@ -44,6 +149,21 @@ class Database(object):
       Identifies that this is a database directory.  Contains a single
       number that is the version of the database format.
 
+    DB_DIR/catalog.sqlite
+      Index of the discs in the database, see catalog.Catalog.
+      Created when needed.
+
+    DB_DIR/roots
+      Optional list of additional storage roots, e.g. on other disks,
+      with one absolute path per line.  Each root has its own
+      .codplayerdb file and discs/ bucket tree below, and each disc
+      directory is in one of the roots.  DB_DIR is always the first
+      root, and the only one with a catalog.
+
+    DB_DIR/verify.json
+      Checksums of the audio files, written by codadmin verify.  See
+      the verify module.
+
     DB_DIR/discs/
       Contains all ripped discs by a hex version of the Musicbrainz
       disc ID.
@@ -70,25 +190,50 @@ class Database(object):
     DISC_DIR/b8ffac79.cdr
       Raw audio data (PCM samples) from the disc.
 
+    DISC_DIR/b8ffac79.cdz
+      The audio data losslessly compressed, replacing the .cdr file
+      after codadmin compress.  See the cdz module.
+
     DISC_DIR/b8ffac79.toc
       TOC read by cdrdao from the disc.
 
     DISC_DIR/b8ffac79.cod
       A serialized model.DbDisc recording the current state and
       information about the disc.
+
+    DISC_DIR/b8ffac79.codp
+      A binary copy of the .cod file, see discpack.  It is only used
+      if the .cod file hasn't been changed since it was written, and
+      is rewritten whenever the disc is saved or the database is
+      reindexed.
     """
 
     VERSION = 1
 
     VERSION_FILE = '.codplayerdb'
+    CATALOG_FILE = 'catalog.sqlite'
+    ROOTS_FILE = 'roots'
     DISC_DIR = 'discs'
 
     DISC_BUCKETS = tuple('0123456789abcdef')
     
     DISC_ID_SUFFIX = '.id'
-    AUDIO_SUFFIX = '.cdr'
+    AUDIO_SUFFIX = model.RAW_CD.file_suffix
+    COMPRESSED_AUDIO_SUFFIX = model.COMPRESSED_CD.file_suffix
     ORIG_TOC_SUFFIX = '.toc'
     DISC_INFO_SUFFIX = '.cod'
+    DISC_PACK_SUFFIX = '.codp'
+
+    # Default number of parsed discs to keep in memory
+    DISC_CACHE_SIZE = 1000
+
+    # Default number of threads reading disc info files in
+    # iterdiscs_parallel()
+    LOAD_THREADS = 8
+
+    # Discs with files modified this recently, e.g. because they are
+    # being ripped, are not moved between roots
+    MOVE_QUIET_SECS = 60
 
     #
     # Helper class methods
@@ -167,30 +312,27 @@ class Database(object):
 
         # translate into a DatabaseError
         except (IOError, OSError), e:
-            raise DatabaseError(self.db_dir, exc = e)
+            raise DatabaseError(db_dir, exc = e)
 
     
-    def __init__(self, db_dir):
-        """Create an object accessing a database directory.
-
-        @param db_dir: database top directory.
+    @classmethod
+    def _check_root(cls, root):
+        """Check that ROOT is a database directory or storage root.
 
         @raise DatabaseError: if the directory structure is invalid
         """
 
-        self.db_dir = db_dir
-
         try:
             # Must be a directory
-            if not os.path.isdir(self.db_dir):
-                raise DatabaseError(self.db_dir, 'no such directory')
+            if not os.path.isdir(root):
+                raise DatabaseError(root, 'no such directory')
 
-            version_path = os.path.join(self.db_dir, self.VERSION_FILE)
+            version_path = os.path.join(root, cls.VERSION_FILE)
 
             # Must have signature file
             if not os.path.isfile(version_path):
-                raise DatabaseError(self.db_dir, 'missing version file',
-                                    entry = self.VERSION_FILE)
+                raise DatabaseError(root, 'missing version file',
+                                    entry = cls.VERSION_FILE)
 
             # Read first line to determine DB version
             f = open(version_path, 'rt')
@@ -198,51 +340,356 @@ class Database(object):
                 raw_version = f.readline()
                 version = int(raw_version)
             except ValueError:
-                raise DatabaseError(self.db_dir,
+                raise DatabaseError(root,
                                     'invalid version: %r' % raw_version,
-                                    entry = self.VERSION_FILE)
+                                    entry = cls.VERSION_FILE)
                                     
 
             # Check that it is the expected version
             # (In the future: handle backward compatibility)
 
-            if version != self.VERSION:
-                raise DatabaseError(self.db_dir,
+            if version != cls.VERSION:
+                raise DatabaseError(root,
                                     'incompatible version: %d' % version,
-                                    entry = self.VERSION_FILE)
+                                    entry = cls.VERSION_FILE)
                 
 
             # Must have disc top dir
 
-            disc_top_dir = os.path.join(self.db_dir, self.DISC_DIR)
+            disc_top_dir = os.path.join(root, cls.DISC_DIR)
 
             if not os.path.isdir(disc_top_dir):
-                raise DatabaseError(self.db_dir, 'missing disc dir')
+                raise DatabaseError(root, 'missing disc dir')
 
 
             # Must have all bucket dirs
-            for b in self.DISC_BUCKETS:
+            for b in cls.DISC_BUCKETS:
                 d = os.path.join(disc_top_dir, b)
 
                 if not os.path.isdir(d):
-                    raise DatabaseError(self.db_dir, 'missing bucket dir',
+                    raise DatabaseError(root, 'missing bucket dir',
                                         entry = b)
 
 
         # translate into a DatabaseError
         except (IOError, OSError), e:
-            raise DatabaseError(self.db_dir, exc = e)
+            raise DatabaseError(root, exc = e)
+
+
+
+    def __init__(self, db_dir, cache_size = DISC_CACHE_SIZE):
+        """Create an object accessing a database directory.
+
+        @param db_dir: database top directory.
+
+        @param cache_size: number of parsed discs to keep in memory.
+
+        @raise DatabaseError: if the directory structure is invalid
+        """
+
+        self.db_dir = db_dir
+
+        # LRU cache of db_id -> (file stat key, DbDisc)
+        self._disc_cache = collections.OrderedDict()
+        self._disc_cache_size = cache_size
+        self._disc_cache_lock = threading.Lock()
+
+        self._check_root(self.db_dir)
+
+        # db_id -> root, for the discs found so far
+        self._root_map = {}
+        self._root_map_lock = threading.Lock()
+
+        # root -> IOStats
+        self._io_stats = {}
+
+        self.roots = [self.db_dir]
+        self._roots_mtime = None
+        self._load_roots()
+
+        self.catalog = catalog.Catalog(os.path.join(self.db_dir, self.CATALOG_FILE))
+
+        self._change_listeners = []
+
+        # links.LinkGraph, loaded from the catalog when first needed
+        # and reloaded if another process changes the catalog.
+        # _link_graph_version is the catalog.Version it reflects.
+        self._link_graph = None
+        self._link_graph_version = None
+        self._link_graph_lock = threading.RLock()
 
 
     def get_disc_dir(self, db_id):
         """@return the path to the directory for a disc, identified by
         the db_id."""
         
-        return os.path.join(self.db_dir,
+        return self._get_disc_dir_in_root(self.get_disc_root(db_id), db_id)
+
+
+    def _get_disc_dir_in_root(self, root, db_id):
+        return os.path.join(root,
                             self.DISC_DIR,
                             self.bucket_for_db_id(db_id),
                             db_id)
 
+
+    def get_disc_root(self, db_id):
+        """@return the storage root holding the disc db_id.  Discs that
+        aren't in any root belong in the database directory.
+        """
+
+        if len(self.roots) == 1:
+            return self.db_dir
+
+        with self._root_map_lock:
+            root = self._root_map.get(db_id)
+            if root is not None:
+                return root
+
+        for root in self.roots:
+            if os.path.isdir(self._get_disc_dir_in_root(root, db_id)):
+                self._set_disc_root(db_id, root)
+                return root
+
+        return self.db_dir
+
+
+    def _set_disc_root(self, db_id, root):
+        with self._root_map_lock:
+            self._root_map[db_id] = root
+
+
+    def _forget_disc_root(self, db_id):
+        """Drop db_id from the root map, since another process may
+        have moved it.  Returns True if it was in the map.
+        """
+        with self._root_map_lock:
+            return self._root_map.pop(db_id, None) is not None
+
+
+    #
+    # Storage roots
+    #
+
+    def _load_roots(self):
+        """Read the additional storage roots from ROOTS_FILE, if it has
+        changed since it was last read.  Returns True if it was.
+        """
+
+        roots_path = os.path.join(self.db_dir, self.ROOTS_FILE)
+        try:
+            mtime = os.stat(roots_path).st_mtime
+        except OSError:
+            # No extra roots
+            mtime = None
+
+        if mtime == self._roots_mtime:
+            return False
+
+        roots = [self.db_dir]
+        if mtime is not None:
+            try:
+                with open(roots_path, 'rt') as f:
+                    for line in f:
+                        line = line.strip()
+                        if line and not line.startswith('#'):
+                            roots.append(line)
+            except IOError, e:
+                raise DatabaseError(self.db_dir, exc = e, entry = self.ROOTS_FILE)
+
+        for root in roots[1:]:
+            self._check_root(root)
+
+        with self._root_map_lock:
+            for root in roots:
+                self._io_stats.setdefault(root, IOStats())
+
+            self.roots = roots
+            self._roots_mtime = mtime
+            self._root_map.clear()
+
+        return True
+
+
+    def add_root(self, root):
+        """Initialise the empty directory ROOT as an additional storage
+        root for the database.  Other processes with the database
+        open start using it when they fail to find a disc in the
+        roots they know about.
+        """
+
+        root = os.path.abspath(root)
+        if root in self.roots:
+            raise DatabaseError(root, 'already a root of the database {0}'.format(self.db_dir))
+
+        self.init_db(root)
+
+        try:
+            with open(os.path.join(self.db_dir, self.ROOTS_FILE), 'at') as f:
+                f.write(root + '\n')
+        except IOError, e:
+            raise DatabaseError(self.db_dir, exc = e, entry = self.ROOTS_FILE)
+
+        self._load_roots()
+
+
+    def get_io_stats(self, db_id):
+        """@return the IOStats object for the root holding disc db_id."""
+        root = self.get_disc_root(db_id)
+        with self._root_map_lock:
+            return self._io_stats.setdefault(root, IOStats())
+
+
+    def get_root_info(self):
+        """@return a list of RootInfo objects for all storage roots."""
+
+        counts = collections.Counter(self.get_disc_root(db_id)
+                                     for db_id in self.iterdiscs_db_ids())
+
+        try:
+            return [RootInfo(root, counts[root], self._io_stats.get(root))
+                    for root in self.roots]
+        except OSError, e:
+            raise DatabaseError(self.db_dir, exc = e)
+
+
+    def move_disc(self, db_id, root):
+        """Move the disc db_id to the storage root ROOT.
+
+        This can be done while other processes are using the
+        database.  The files are copied into place in the new root
+        before the old disc directory is removed, and other processes
+        look for the disc again when it's gone from the old root.
+
+        @raise DatabaseError: if the disc has been changed recently
+        (e.g. is being ripped), is changed while being copied, or on
+        file errors
+        """
+
+        if root not in self.roots:
+            raise ValueError('not a root of the database: {0}'.format(root))
+
+        src_root = self.get_disc_root(db_id)
+        if src_root == root:
+            return
+
+        src = self._get_disc_dir_in_root(src_root, db_id)
+        dest = self._get_disc_dir_in_root(root, db_id)
+
+        if os.path.exists(dest):
+            raise DatabaseError(root, 'disc dir already exists', entry = db_id)
+
+        try:
+            before = _snapshot_dir(src)
+        except OSError, e:
+            raise DatabaseError(src_root, exc = e, entry = db_id)
+
+        if before and max(mtime for size, mtime in before.itervalues()) > time.time() - self.MOVE_QUIET_SECS:
+            raise DatabaseError(src_root, 'disc changed recently, not moving it', entry = db_id)
+
+        temp_dir = None
+        try:
+            # Not a valid db_id, so ignored by other processes until
+            # it's renamed into place
+            temp_dir = tempfile.mkdtemp(dir = os.path.dirname(dest), prefix = '.' + db_id + '.')
+
+            for name in before:
+                _copy_file(os.path.join(src, name), os.path.join(temp_dir, name))
+
+            if _snapshot_dir(src) != before:
+                raise DatabaseError(src_root, 'disc changed while being moved', entry = db_id)
+
+            os.rename(temp_dir, dest)
+            temp_dir = None
+
+        except (IOError, OSError), e:
+            raise DatabaseError(root, exc = e, entry = db_id)
+
+        finally:
+            if temp_dir:
+                shutil.rmtree(temp_dir, ignore_errors = True)
+
+        self._set_disc_root(db_id, root)
+        self._uncache_disc(db_id)
+
+        size = sum(size for size, mtime in before.itervalues())
+        self._io_stats[src_root].add_moved(size)
+        self._io_stats[root].add_moved(size)
+
+        # The old copy must go, or it might be found first
+        try:
+            shutil.rmtree(src)
+        except OSError, e:
+            raise DatabaseError(src_root, 'disc moved but old dir not removed: {0}'.format(e),
+                                entry = db_id)
+
+        # Let other processes know, if anyone is listening
+        disc = self.get_disc_by_db_id(db_id)
+        if disc:
+            self._update_catalog([(db_id, disc, 'move')])
+
+
+    def rebalance(self, dry_run = False):
+        """Move discs from the roots with the least free space to the
+        roots with the most, until no move would even out the free
+        space further.
+
+        If DRY_RUN is true, just return the moves that would be made.
+
+        @return a tuple (moves, errors), where moves is a list of
+        (db_id, from_root, to_root, bytes) and errors a list of
+        (db_id, exception) for discs that couldn't be moved.
+        """
+
+        moves = []
+        errors = []
+
+        if len(self.roots) < 2:
+            return moves, errors
+
+        sizes = dict((root, {}) for root in self.roots)
+        for db_id in self.iterdiscs_db_ids():
+            root = self.get_disc_root(db_id)
+            try:
+                sizes[root][db_id] = sum(
+                    size for size, mtime in _snapshot_dir(self._get_disc_dir_in_root(root, db_id)).itervalues())
+            except OSError, e:
+                errors.append((db_id, e))
+
+        try:
+            free = dict((root, get_free_space(root)) for root in self.roots)
+        except OSError, e:
+            raise DatabaseError(self.db_dir, exc = e)
+
+        while True:
+            src = min(self.roots, key = free.get)
+            dest = max(self.roots, key = free.get)
+
+            # Moving a disc larger than half the difference would just
+            # make dest the fuller root instead
+            gap = free[dest] - free[src]
+            candidates = [(size, db_id) for db_id, size in sizes[src].iteritems()
+                          if 0 < size <= gap / 2]
+            if not candidates:
+                break
+
+            size, db_id = max(candidates)
+            del sizes[src][db_id]
+
+            if not dry_run:
+                try:
+                    self.move_disc(db_id, dest)
+                except DatabaseError, e:
+                    errors.append((db_id, e))
+                    continue
+
+            sizes[dest][db_id] = size
+            free[src] += size
+            free[dest] -= size
+            moves.append((db_id, src, dest, size))
+
+        return moves, errors
+
     def get_id_file(self, db_id):
         return self.filename_base(db_id) + self.DISC_ID_SUFFIX
 
@@ -250,12 +697,18 @@ class Database(object):
     def get_audio_file(self, db_id):
         return self.filename_base(db_id) + self.AUDIO_SUFFIX
 
+    def get_compressed_audio_file(self, db_id):
+        return self.filename_base(db_id) + self.COMPRESSED_AUDIO_SUFFIX
+
     def get_orig_toc_file(self, db_id):
         return self.filename_base(db_id) + self.ORIG_TOC_SUFFIX
 
     def get_disc_info_file(self, db_id):
         return self.filename_base(db_id) + self.DISC_INFO_SUFFIX
 
+    def get_disc_pack_file(self, db_id):
+        return self.filename_base(db_id) + self.DISC_PACK_SUFFIX
+
     def get_id_path(self, db_id):
         return os.path.join(self.get_disc_dir(db_id),
                             self.get_id_file(db_id))
@@ -265,6 +718,19 @@ class Database(object):
         return os.path.join(self.get_disc_dir(db_id),
                             self.get_audio_file(db_id))
 
+    def get_compressed_audio_path(self, db_id):
+        return os.path.join(self.get_disc_dir(db_id),
+                            self.get_compressed_audio_file(db_id))
+
+    def get_disc_audio_path(self, db_id, disc):
+        """Return the path to the audio file of DISC, which depends on
+        its data_file_format.
+        """
+        if disc.data_file_format is model.COMPRESSED_CD:
+            return self.get_compressed_audio_path(db_id)
+        else:
+            return self.get_audio_path(db_id)
+
     def get_orig_toc_path(self, db_id):
         return os.path.join(self.get_disc_dir(db_id),
                             self.get_orig_toc_file(db_id))
@@ -272,6 +738,10 @@ class Database(object):
     def get_disc_info_path(self, db_id):
         return os.path.join(self.get_disc_dir(db_id),
                             self.get_disc_info_file(db_id))
+
+    def get_disc_pack_path(self, db_id):
+        return os.path.join(self.get_disc_dir(db_id),
+                            self.get_disc_pack_file(db_id))
         
 
     def iterdiscs_db_ids(self):
@@ -283,19 +753,292 @@ class Database(object):
         progress of being ripped.)
         """
 
-        disc_top_dir = os.path.join(self.db_dir, self.DISC_DIR)
-
         for b in self.DISC_BUCKETS:
-            d = os.path.join(disc_top_dir, b)
+            entries = self._list_bucket(b)
+            if isinstance(entries, OSError):
+                raise DatabaseError(self.db_dir, exc = entries, entry = b)
+
+            for f in entries:
+                yield f
+
+
+    def iterdiscs_parallel(self, threads = LOAD_THREADS):
+        """@return an iterator over (db_id, disc, error) for all discs
+        in the database, ordered by db_id.
+
+        The bucket directories are listed and the disc info files are
+        read by a pool of THREADS threads, so slow storage is kept
+        busy.  (Parsing still holds the interpreter lock, so on fast
+        storage this is no quicker than a serial scan.)  Results are
+        returned as soon as they are available.
+
+        If a disc can't be read, disc is None and error is the
+        DatabaseError, so one broken disc doesn't stop the listing.
+        Directories without any disc info file (e.g. discs that are
+        being ripped) are skipped.
+
+        @raise DatabaseError: if a bucket directory can't be listed
+        """
+
+        pool = multiprocessing.pool.ThreadPool(threads)
+        try:
+            buckets = pool.map(self._list_bucket, self.DISC_BUCKETS)
+
+            for b, entries in zip(self.DISC_BUCKETS, buckets):
+                if isinstance(entries, OSError):
+                    raise DatabaseError(self.db_dir, exc = entries, entry = b)
 
+            db_ids = (db_id for entries in buckets for db_id in entries)
+
+            for db_id, disc, error in pool.imap(self._load_disc_entry, db_ids, 8):
+                if disc is not None or error is not None:
+                    yield db_id, disc, error
+
+        finally:
+            pool.terminate()
+
+
+    def _list_bucket(self, b):
+        # Return the sorted db_ids in bucket B in all roots, noting
+        # which root each disc is in.  If a disc is in several roots
+        # (e.g. after an interrupted move) the first one is used.
+        found = {}
+        for root in reversed(self.roots):
+            d = os.path.join(root, self.DISC_DIR, b)
             try:
                 for f in os.listdir(d):
                     if self.is_valid_db_id(f) and self.bucket_for_db_id(f) == b:
-                        yield f
-
-            # translate into a DatabaseError
+                        found[f] = root
             except OSError, e:
-                raise DatabaseError(self.db_dir, exc = e, entry = b)
+                # Raised by the caller, to not tear down the pool
+                return e
+
+        if len(self.roots) > 1:
+            with self._root_map_lock:
+                self._root_map.update(found)
+
+        return sorted(found)
+
+
+    def _load_disc_entry(self, db_id):
+        try:
+            return db_id, self.get_disc_by_db_id(db_id), None
+        except DatabaseError, e:
+            return db_id, None, e
+
+
+    def iterdiscs_overviews(self):
+        """@return an iterator over model.DiscOverview objects for
+        all discs in the database, read from the catalog index.
+
+        If the catalog hasn't been built yet the disc info files are
+        read instead, leaving out any discs that can't be read.
+        """
+
+        try:
+            if not self.catalog.is_complete():
+                return (model.DiscOverview(disc) for db_id, disc in self._iterdiscs_readable())
+
+            return iter(self.catalog.get_overviews())
+
+        except catalog.CatalogError, e:
+            raise DatabaseError(self.db_dir, exc = e)
+
+
+    def get_catalog_version(self):
+        """@return a catalog.Version identifying the current state of
+        the disc list.  The sequence number increases each time a disc
+        is created or updated.
+
+        If the catalog hasn't been built yet, catalog_id is None and
+        the version doesn't identify the state of the discs.
+        """
+
+        try:
+            if not self.catalog.is_complete():
+                return catalog.Version(None, 0, None)
+
+            return self.catalog.get_version()
+
+        except catalog.CatalogError, e:
+            raise DatabaseError(self.db_dir, exc = e)
+
+
+    def get_changed_discs(self, since):
+        """@return a tuple (version, discs), where discs is a list of
+        model.DiscOverview objects for the discs that have been
+        created or updated after the catalog sequence number SINCE.
+
+        If the changes since then aren't known discs is None, and all
+        discs must be listed again with iterdiscs_overviews().  This
+        is always the case if the catalog hasn't been built yet.
+        """
+
+        try:
+            if not self.catalog.is_complete():
+                return catalog.Version(None, 0, None), None
+
+            return self.catalog.get_changes(since)
+
+        except catalog.CatalogError, e:
+            raise DatabaseError(self.db_dir, exc = e)
+
+
+    def search_discs(self, query, offset = 0, limit = None):
+        """@return a list of model.DiscOverview objects for the discs
+        matching all the words in QUERY, best matches first.
+
+        Each word in QUERY matches words starting with it in the
+        disc title, artist, catalog number or barcode, or in the track
+        titles or artists.  Case and accents are ignored.
+
+        @param offset: number of matching discs to skip
+
+        @param limit: return at most this many discs
+
+        If the catalog hasn't been built yet the disc info files are
+        searched instead, which is much slower.
+        """
+
+        try:
+            if not self.catalog.is_complete():
+                return catalog.Catalog.search_discs(
+                    query, self._iterdiscs_readable(), offset, limit)
+
+            return self.catalog.search(query, offset, limit)
+
+        except catalog.CatalogError, e:
+            raise DatabaseError(self.db_dir, exc = e)
+
+
+    def reindex(self):
+        """Rebuild the catalog index from the disc info files, and the
+        binary copies of disc info files that have been changed.
+
+        @return a list of (db_id, exception) for discs that could not
+        be read and thus are not included in the catalog.
+
+        The catalog can be used by other threads and processes while
+        it is rebuilt, but until it has been built the first time
+        they read the disc info files instead.
+        """
+
+        errors = []
+
+        def iterdiscs():
+            for db_id, disc, error in self.iterdiscs_parallel():
+                if error:
+                    errors.append((db_id, error))
+                else:
+                    self._refresh_disc_pack(db_id, disc)
+                    yield db_id, disc
+
+        try:
+            self.catalog.rebuild(iterdiscs())
+        except catalog.CatalogError, e:
+            raise DatabaseError(self.db_dir, exc = e)
+
+        return errors
+
+
+    def is_catalog_complete(self):
+        """@return True if the catalog index has been built from all
+        discs, and False if it must be built with reindex().
+        """
+        try:
+            return self.catalog.is_complete()
+        except catalog.CatalogError, e:
+            raise DatabaseError(self.db_dir, exc = e)
+
+
+    def _iterdiscs_readable(self):
+        for db_id, disc, error in self.iterdiscs_parallel():
+            if disc is not None:
+                yield db_id, disc
+
+
+    def get_disc_link(self, disc_id):
+        """@return a tuple (link_type, linked_disc_id) for the disc
+        DISC_ID, or None if it isn't linked to another disc.
+        """
+        with self._link_graph_lock:
+            return self._get_link_graph().get_link(disc_id)
+
+
+    def resolve_alias(self, disc_id):
+        """@return a tuple of the disc IDs reached by following alias
+        links from DISC_ID, ending with the disc that should be played
+        instead.  The tuple is empty if DISC_ID isn't an alias.
+
+        The link of DISC_ID itself is read from its disc info file, so
+        a link edited by hand is followed.  The rest of the chain is
+        looked up in the in-memory link graph, so the linked discs may
+        not actually exist in the database.
+        """
+
+        db_disc = self.get_disc_by_disc_id(disc_id)
+        if (db_disc is None or db_disc.link_type != 'alias'
+            or not db_disc.linked_disc_id):
+            return ()
+
+        linked_disc_id = db_disc.linked_disc_id
+
+        if self.is_catalog_complete():
+            with self._link_graph_lock:
+                chain = (linked_disc_id, ) + self._get_link_graph().resolve_alias(linked_disc_id)
+        else:
+            # Follow the links in the files instead of reading all
+            # discs to build the graph
+            chain = (linked_disc_id, )
+            linked = self.get_disc_by_disc_id(linked_disc_id)
+            while (linked is not None and linked.link_type == 'alias'
+                   and linked.linked_disc_id and linked.linked_disc_id not in chain):
+                chain += (linked.linked_disc_id, )
+                linked = self.get_disc_by_disc_id(linked.linked_disc_id)
+
+        # Stop before any loop back to DISC_ID
+        if disc_id in chain:
+            chain = chain[:chain.index(disc_id)]
+
+        return chain
+
+
+    def get_disc_set(self, disc_id):
+        """@return a list of the disc IDs in the set DISC_ID belongs
+        to, in the order they are linked by next links.
+        """
+        with self._link_graph_lock:
+            return self._get_link_graph().get_disc_set(disc_id)
+
+
+    def _get_link_graph(self):
+        # Must be called holding _link_graph_lock.  The graph is only
+        # built from the catalog, so links edited by hand in the disc
+        # info files aren't seen until the database is reindexed
+        # (except the first link by resolve_alias()).  Until the
+        # catalog has been built, the links are read from all the disc
+        # info files each time.
+        try:
+            if not self.catalog.is_complete():
+                self._link_graph = None
+                return links.LinkGraph(
+                    [(disc.disc_id, disc.link_type, disc.linked_disc_id)
+                     for db_id, disc in self._iterdiscs_readable()
+                     if disc.link_type is not None])
+
+            # Checking the version is a single indexed lookup, much
+            # cheaper than loading the discs in a link chain
+            version = self.catalog.get_version()
+            if (self._link_graph is None
+                or version.catalog_id != self._link_graph_version.catalog_id
+                or version.seq != self._link_graph_version.seq):
+                self._link_graph = links.LinkGraph(self.catalog.get_links())
+                self._link_graph_version = version
+
+        except catalog.CatalogError, e:
+            raise DatabaseError(self.db_dir, exc = e)
+
+        return self._link_graph
 
 
     def get_disc_by_disc_id(self, disc_id):
@@ -309,40 +1052,153 @@ class Database(object):
     def get_disc_by_db_id(self, db_id):
         """@return a Disc basted on a database ID, or None if not
         found in database.
+
+        Parsed discs are cached, but each call returns a new copy
+        that the caller is free to modify.
         """
 
         if not self.is_valid_db_id(db_id):
             raise ValueError('invalid DB ID: {0!r}'.format(db_id))
 
-        path = self.get_disc_dir(db_id)
+        disc_info_file, st = self._stat_disc_info(db_id)
+        if st is None:
+            # If no file, no disc
+            self._uncache_disc(db_id)
+            return None
 
-        disc_info_file = self.get_disc_info_path(db_id)
+        # Files are replaced when saved, so this catches changes made
+        # by other processes too
+        key = self._disc_version_key(st)
 
-        if not os.path.exists(disc_info_file):
-            # If no file, no disc
+        disc = self._get_cached_disc(db_id, key)
+        if disc is None:
+            start = time.time()
+            disc_pack_file = self.get_disc_pack_path(db_id)
+            try:
+                disc = discpack.load_disc(disc_pack_file, st)
+            except discpack.PackError:
+                # Just read the JSON file, the pack is only rewritten
+                # when saving or reindexing
+                try:
+                    disc = serialize.load_json(model.DbDisc, disc_info_file)
+                except serialize.LoadError, e:
+                    raise DatabaseError(self.db_dir, 'error reading disc info file: {0}'.format(e))
+
+            # 1.0 had a bug where the full data file path was saved, and
+            # not just the file name itself.  This breaks playback if the
+            # database path changes, so repair any incorrect paths here.
+            disc.data_file_name = os.path.basename(disc.data_file_name)
+
+            self.get_io_stats(db_id).add_disc_load(time.time() - start)
+            self._cache_disc(db_id, key, disc)
+
+        return copy_db_object(disc)
+
+
+    def get_disc_version(self, db_id):
+        """@return a tuple (mtime, size, inode) of the disc info file,
+        which changes each time the disc is saved, or None if the disc
+        isn't in the database.
+        """
+
+        disc_info_file, st = self._stat_disc_info(db_id)
+        if st is None:
             return None
 
+        return self._disc_version_key(st)
+
+
+    def _stat_disc_info(self, db_id, retry = True):
+        # Return (path, os.stat() result or None) for the disc info
+        # file, looking for the disc again if another process has
+        # moved it to a different root
+        disc_info_file = self.get_disc_info_path(db_id)
         try:
-            disc = serialize.load_json(model.DbDisc, disc_info_file)
-        except serialize.LoadError, e:
-            raise DatabaseError(self.db_dir, 'error reading disc info file: {0}'.format(e))
+            return disc_info_file, os.stat(disc_info_file)
+        except OSError:
+            # The roots might have changed too
+            if retry and (self._forget_disc_root(db_id) or self._load_roots()):
+                return self._stat_disc_info(db_id, retry = False)
+            return disc_info_file, None
 
-        # 1.0 had a bug where the full data file path was saved, and
-        # not just the file name itself.  This breaks playback if the
-        # database path changes, so repair any incorrect paths here.
-        disc.data_file_name = os.path.basename(disc.data_file_name)
 
-        return disc
+    @staticmethod
+    def _disc_version_key(st):
+        return (st.st_mtime, st.st_size, st.st_ino)
+
+
+    def _refresh_disc_pack(self, db_id, disc):
+        disc_info_file, st = self._stat_disc_info(db_id)
+        disc_pack_file = self.get_disc_pack_path(db_id)
+        if st is not None and not discpack.is_current(disc_pack_file, st):
+            self._save_disc_pack(disc, disc_pack_file, disc_info_file)
+
+
+    def _save_disc_pack(self, disc, path, disc_info_file):
+        # Just a cache, so it's fine if it can't be written
+        # (e.g. read-only access to the database)
+        try:
+            discpack.save_disc(disc, path, disc_info_file)
+        except discpack.PackError:
+            pass
+
+
+    def _get_cached_disc(self, db_id, key):
+        with self._disc_cache_lock:
+            entry = self._disc_cache.pop(db_id, None)
+            if entry is None or entry[0] != key:
+                return None
+
+            # Put it back as the most recently used
+            self._disc_cache[db_id] = entry
+            return entry[1]
+
+
+    def _cache_disc(self, db_id, key, disc):
+        if self._disc_cache_size <= 0:
+            return
+
+        with self._disc_cache_lock:
+            self._disc_cache.pop(db_id, None)
+            self._disc_cache[db_id] = (key, disc)
+
+            while len(self._disc_cache) > self._disc_cache_size:
+                self._disc_cache.popitem(last = False)
+
+
+    def _uncache_disc(self, db_id):
+        with self._disc_cache_lock:
+            self._disc_cache.pop(db_id, None)
 
 
     def create_disc_dir(self, db_id):
         """Create a directory for a new disc to be ripped into the
         database, identified by db_id.
 
+        New discs are placed in the root with the most free space.
+
         @return the path to the disc directory
         """
 
         path = self.get_disc_dir(db_id)
+
+        if len(self.roots) > 1 and not os.path.isdir(path):
+            # Skip roots that are missing, e.g. on an unmounted disk
+            free = []
+            errors = []
+            for root in self.roots:
+                try:
+                    free.append((get_free_space(root), root))
+                except OSError, e:
+                    errors.append(str(e))
+
+            if not free:
+                raise DatabaseError(self.db_dir, 'no usable storage root: {0}'.format(
+                    '; '.join(errors)))
+
+            root = max(free, key = lambda (space, root): space)[1]
+            self._set_disc_root(db_id, root)
+            path = self.get_disc_dir(db_id)
             
         # Be forgiving if the dir already exists, to allow aborted
         # rips to be restarted easily
@@ -373,11 +1229,24 @@ class Database(object):
     def save_disc_info(self, disc):
         """Save new disc info, overwriting anything existing.
         """
+        self._save_disc_info(disc, 'update')
+
+
+    def _save_disc_info(self, disc, event):
         db_id = self.disc_to_db_id(disc.disc_id)
+        disc_info_file = self.get_disc_info_path(db_id)
         try:
-            serialize.save_json(disc, self.get_disc_info_path(db_id))
+            serialize.save_json(disc, disc_info_file)
         except serialize.SaveError, e:
             raise DatabaseError(self.db_dir, str(e))
+        finally:
+            self._uncache_disc(db_id)
+
+        self.get_io_stats(db_id).add_disc_save()
+
+        self._save_disc_pack(disc, self.get_disc_pack_path(db_id), disc_info_file)
+
+        self._update_catalog([(db_id, disc, event)])
 
 
     def create_disc(self, disc):
@@ -385,7 +1254,7 @@ class Database(object):
         """
         db_id = self.disc_to_db_id(disc.disc_id)
         self.create_disc_dir(db_id)
-        self.save_disc_info(disc)
+        self._save_disc_info(disc, 'create')
 
 
     def update_disc(self, ext_disc):
@@ -404,6 +1273,58 @@ class Database(object):
         Returns the updated DbDisc object.
         """
 
+        return self.update_discs([ext_disc])[0]
+
+
+    def update_discs(self, ext_discs):
+        """Update several discs as update_disc() does, but with a single
+        wait for the disk for all of them.
+
+        All updates are checked before anything is saved, so if an
+        error is raised for an invalid update no disc is changed.
+
+        Returns a list of the updated DbDisc objects.
+        """
+
+        updates = [self._get_updated_disc(ext_disc) for ext_disc in ext_discs]
+
+        if len(set(db_id for db_id, db_disc in updates)) != len(updates):
+            raise ValueError('the same disc is updated more than once')
+
+        # Catch link loops now, rather than every time a disc is played
+        with self._link_graph_lock:
+            graph = self._get_link_graph().copy()
+
+        for db_id, db_disc in updates:
+            graph.set_link(db_disc.disc_id, db_disc.link_type, db_disc.linked_disc_id)
+
+        batch = serialize.SaveBatch()
+        try:
+            for db_id, db_disc in updates:
+                batch.add(db_disc, self.get_disc_info_path(db_id))
+
+            batch.commit()
+
+        except serialize.SaveError, e:
+            raise DatabaseError(self.db_dir, str(e))
+
+        finally:
+            for db_id, db_disc in updates:
+                self._uncache_disc(db_id)
+
+        for db_id, db_disc in updates:
+            self.get_io_stats(db_id).add_disc_save()
+
+        for db_id, db_disc in updates:
+            self._save_disc_pack(db_disc, self.get_disc_pack_path(db_id),
+                                 self.get_disc_info_path(db_id))
+
+        self._update_catalog([(db_id, db_disc, 'update') for db_id, db_disc in updates])
+
+        return [db_disc for db_id, db_disc in updates]
+
+
+    def _get_updated_disc(self, ext_disc):
         if not isinstance(ext_disc, model.ExtDisc):
             raise ValueError('update requires an ExtDisc object: {0!r}'.format(ext_disc))
 
@@ -436,14 +1357,114 @@ class Database(object):
 
                 # Track ok, update attribute
                 update_db_object(db_track, ext_track)
-            
 
-        # Save new record
-        serialize.save_json(db_disc, self.get_disc_info_path(db_id))
+        return db_id, db_disc
+
+
+    def add_change_listener(self, listener):
+        """Call LISTENER with a DiscChange object each time a disc is
+        created or updated through this object.  This is done in the
+        thread making the change.
+        """
+        self._change_listeners.append(listener)
+
+
+    def remove_change_listener(self, listener):
+        self._change_listeners.remove(listener)
+
+
+    def disc_changed(self, disc_id):
+        """Tell the database that DISC_ID has been changed by some other
+        process, dropping any cached copy of it.
+        """
+        if self.is_valid_disc_id(disc_id):
+            db_id = self.disc_to_db_id(disc_id)
+            self._uncache_disc(db_id)
+
+            # It might have been moved to another root
+            self._forget_disc_root(db_id)
+
+
+    def _update_catalog(self, updates):
+        """Update the catalog and tell listeners about UPDATES, a list
+        of (db_id, disc, event) tuples.
+        """
+        try:
+            seqs = self.catalog.update_discs(updates)
+        except catalog.CatalogError, e:
+            raise DatabaseError(self.db_dir, exc = e)
+
+        if seqs:
+            self._update_link_graph(updates, seqs)
+
+        for (db_id, disc, event), seq in zip(updates, seqs):
+            change = DiscChange(disc.disc_id, event, seq)
+            for listener in list(self._change_listeners):
+                listener(change)
+
+
+    def _update_link_graph(self, updates, seqs):
+        with self._link_graph_lock:
+            graph = self._link_graph
+            version = self._link_graph_version
+
+            # Keep the graph if these are the only changes since it
+            # was loaded, otherwise it is reloaded when next needed
+            if graph is not None and seqs == range(version.seq + 1, version.seq + 1 + len(seqs)):
+                for db_id, disc, event in updates:
+                    graph.set_link(disc.disc_id, disc.link_type, disc.linked_disc_id,
+                                   check = False)
+                self._link_graph_version = version._replace(seq = seqs[-1])
+            else:
+                self._link_graph = None
+
+
+def get_free_space(path):
+    """@return the number of bytes available to normal users in the
+    file system holding PATH.
+    """
+    st = os.statvfs(path)
+    return st.f_bavail * st.f_frsize
+
+
+def get_total_space(path):
+    st = os.statvfs(path)
+    return st.f_blocks * st.f_frsize
+
+
+def _snapshot_dir(path):
+    # Return a dict of file name -> (size, mtime) for the files in PATH
+    files = {}
+    for name in os.listdir(path):
+        st = os.stat(os.path.join(path, name))
+        files[name] = (st.st_size, st.st_mtime)
+    return files
+
+
+def _copy_file(src, dest):
+    # Copy the data to the disk, and the mtime too since that
+    # identifies the disc info file version
+    with open(src, 'rb') as fin:
+        with open(dest, 'wb') as fout:
+            shutil.copyfileobj(fin, fout, 1024 * 1024)
+            fout.flush()
+            os.fsync(fout.fileno())
+
+    shutil.copystat(src, dest)
+
+
+def copy_db_object(obj):
+    """Return a copy of OBJ that can be modified, including any lists
+    in it, without affecting OBJ.
+    """
+    c = copy.copy(obj)
+    for attr, value in obj.__dict__.iteritems():
+        if isinstance(value, list):
+            setattr(c, attr, [copy_db_object(v) if isinstance(v, serialize.Serializable) else v
+                              for v in value])
+    return c
 
-        return db_disc
 
-        
 def update_db_object(db_obj, ext_obj):
     for attr in db_obj.MUTABLE_ATTRS:
         value = getattr(ext_obj, attr)
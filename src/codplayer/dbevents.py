@@ -0,0 +1,89 @@
+# codplayer - publish and subscribe to database changes
+#
+# Copyright 2018 Peter Liljenberg <peter.liljenberg@gmail.com>
+#
+# Distributed under an MIT license, please see LICENSE in the top dir.
+
+"""
+Database changes are published on the db zerohub.Topic as 'disc'
+messages with a db.DiscChange JSON object, so that codplayerd and
+codrestd learn about the discs changed by each other.
+"""
+
+from . import db
+from . import serialize
+from . import zerohub
+
+
+class DatabaseEventError(Exception):
+    pass
+
+
+class DatabasePublisher(object):
+    """Publish all changes made through DATABASE on the CHANNEL topic,
+    as the sender NAME.
+    """
+
+    def __init__(self, database, channel, name, io_loop = None):
+        self._database = database
+        self._name = name
+        self._sender = zerohub.AsyncSender(channel, name = name, io_loop = io_loop)
+        database.add_change_listener(self._on_change)
+
+
+    def close(self):
+        self._database.remove_change_listener(self._on_change)
+        self._sender.close()
+
+
+    def _on_change(self, change):
+        # AsyncSender is safe to call from any thread
+        change = db.DiscChange(change.disc_id, change.event, change.seq, self._name)
+        self._sender.send_multipart(['disc', serialize.get_jsons(change)])
+
+
+class DatabaseClient(object):
+    """Subscribe to database changes published on the CHANNEL topic.
+
+    If DATABASE is provided, any cached copy of a changed disc is
+    dropped.  ON_CHANGE is then called with the db.DiscChange object.
+    Changes published by IGNORE_SENDER, typically this process, are
+    skipped.
+    """
+
+    def __init__(self, channel, database = None, io_loop = None,
+                 on_change = None, ignore_sender = None):
+        self._database = database
+        self._on_change = on_change
+        self._ignore_sender = ignore_sender
+        self._receiver = zerohub.Receiver(
+            channel, io_loop = io_loop, callbacks = { 'disc': self._on_message })
+
+
+    def close(self):
+        if self._receiver:
+            self._receiver.close()
+            self._receiver = None
+
+
+    def _on_message(self, receiver, msg):
+        change = parse_message(msg)
+
+        if self._ignore_sender and change.sender == self._ignore_sender:
+            return
+
+        if self._database:
+            self._database.disc_changed(change.disc_id)
+
+        if self._on_change:
+            self._on_change(change)
+
+
+def parse_message(msg):
+    if len(msg) < 2:
+        raise DatabaseEventError('zeromq: missing message parts: {0}'.format(msg))
+
+    try:
+        return serialize.load_jsons(db.DiscChange, msg[1])
+    except serialize.LoadError, e:
+        raise DatabaseEventError('zeromq: malformed message object: {0}'.format(msg))
@@ -0,0 +1,328 @@
+# codplayer - compact binary copies of disc info files
+#
+# Copyright 2018 Peter Liljenberg <peter.liljenberg@gmail.com>
+#
+# Distributed under an MIT license, please see LICENSE in the top dir.
+
+"""
+Pack DbDisc objects into a compact binary format, which is much faster
+to load than the JSON disc info files.
+
+The packed file is only a cache next to the JSON file, which is still
+the master copy.  The header records the size, modification time and
+inode of the JSON file it was made from, so a packed file is only used
+if the JSON file hasn't been changed or replaced since.
+
+Format, all integers in network byte order:
+
+  header:  magic 'CODP', format version, MAPPING signature, JSON file
+           size, mtime and inode, number of tracks
+  disc:    each DbDisc attribute except tracks, in MAPPING order
+  tracks:  each DbTrack attribute in MAPPING order, as a column with
+           the values for all tracks
+
+Numbers are packed with the array module, and strings are length
+prefixed UTF-8.
+"""
+
+import struct
+import array
+import sys
+import zlib
+import os
+import tempfile
+
+from . import model
+from . import serialize
+
+
+class PackError(Exception):
+    pass
+
+
+MAGIC = 'CODP'
+VERSION = 2
+
+HEADER = struct.Struct('!4sBIQdQI')
+LENGTH = struct.Struct('!i')
+
+# Integers are packed as 32 bits, which is plenty for frame counts on
+# a CD.  Larger values can't be packed, and the disc is then just
+# loaded from JSON.
+INT_TYPE = 'i'
+assert array.array(INT_TYPE).itemsize == 4
+
+# Represents None in integer columns
+NONE_INT = -2 ** 31
+
+# Bool values: False, True, None
+NONE_BOOL = 2
+
+
+def _attr_kind(attr):
+    if attr.enum:
+        return 'enum'
+    if attr.list_type is int:
+        return 'intlist'
+    if attr.value_type is int:
+        return 'int'
+    if attr.value_type is bool:
+        return 'bool'
+    if attr.value_type is str:
+        return 'str'
+    if attr.value_type is serialize.str_unicode:
+        return 'unicode'
+    raise TypeError('cannot pack attribute {0}'.format(attr.name))
+
+
+DISC_ATTRS = tuple((a, _attr_kind(a)) for a in model.DbDisc.MAPPING if a.name != 'tracks')
+TRACK_ATTRS = tuple((a, _attr_kind(a)) for a in model.DbTrack.MAPPING)
+
+# Changes whenever the mappings change, so old files are ignored
+SIGNATURE = zlib.crc32(repr([(a.name, k) for a, k in DISC_ATTRS + TRACK_ATTRS])) & 0xffffffff
+
+
+#
+# Packing
+#
+
+def pack_disc(disc, json_size, json_mtime, json_ino):
+    """Return a string with DISC packed, recording that it was made
+    from a JSON file of JSON_SIZE bytes modified at JSON_MTIME, with
+    inode number JSON_INO.
+    """
+
+    parts = [HEADER.pack(MAGIC, VERSION, SIGNATURE, json_size, json_mtime, json_ino,
+                         len(disc.tracks))]
+
+    for attr, kind in DISC_ATTRS:
+        _pack_values(parts, kind, [getattr(disc, attr.name)])
+
+    for attr, kind in TRACK_ATTRS:
+        _pack_values(parts, kind, [getattr(t, attr.name) for t in disc.tracks])
+
+    return ''.join(parts)
+
+
+def _pack_values(parts, kind, values):
+    if kind == 'int':
+        _pack_array(parts, INT_TYPE, [NONE_INT if v is None else v for v in values])
+
+    elif kind == 'bool':
+        _pack_array(parts, 'b', [NONE_BOOL if v is None else int(v) for v in values])
+
+    elif kind == 'intlist':
+        _pack_array(parts, INT_TYPE, [-1 if v is None else len(v) for v in values])
+        _pack_array(parts, INT_TYPE, [i for v in values if v for i in v])
+
+    else:
+        for v in values:
+            if v is None:
+                parts.append(LENGTH.pack(-1))
+            else:
+                if kind == 'enum':
+                    v = v.__name__
+                if isinstance(v, unicode):
+                    v = v.encode('utf-8')
+                parts.append(LENGTH.pack(len(v)))
+                parts.append(v)
+
+
+def _pack_array(parts, typecode, values):
+    a = array.array(typecode, values)
+    if sys.byteorder == 'little':
+        a.byteswap()
+    parts.append(a.tostring())
+
+
+#
+# Unpacking
+#
+
+def unpack_disc(data, json_size = None, json_mtime = None, json_ino = None):
+    """Return a DbDisc unpacked from DATA.
+
+    If JSON_SIZE, JSON_MTIME and JSON_INO are provided, raise
+    PackError if the data wasn't made from a JSON file with that size,
+    mtime and inode.
+    """
+
+    num_tracks = _unpack_header(data, json_size, json_mtime, json_ino)
+    reader = _Reader(data, HEADER.size)
+
+    try:
+        disc = model.DbDisc()
+        values = {}
+        for attr, kind in DISC_ATTRS:
+            values[attr.name] = reader.values(kind, 1, attr)[0]
+            values['_populated_' + attr.name] = True
+
+        values['tracks'] = tracks = [model.DbTrack() for i in xrange(num_tracks)]
+        values['_populated_tracks'] = True
+        disc.__dict__.update(values)
+
+        for attr, kind in TRACK_ATTRS:
+            name = attr.name
+            populated = '_populated_' + name
+            for t, v in zip(tracks, reader.values(kind, num_tracks, attr)):
+                d = t.__dict__
+                d[name] = v
+                d[populated] = True
+
+    except (struct.error, IndexError, ValueError):
+        raise PackError('truncated data')
+
+    if reader.pos != len(data):
+        raise PackError('trailing data')
+
+    return disc
+
+
+def _unpack_header(data, json_size, json_mtime, json_ino):
+    # Check the header and return the number of tracks
+    try:
+        magic, version, signature, size, mtime, ino, num_tracks = HEADER.unpack_from(data)
+    except struct.error:
+        raise PackError('truncated header')
+
+    if magic != MAGIC or version != VERSION:
+        raise PackError('not a packed disc file')
+
+    if signature != SIGNATURE:
+        raise PackError('packed with different disc attributes')
+
+    if json_size is not None and (size != json_size or mtime != json_mtime or ino != json_ino):
+        raise PackError('disc info file has changed')
+
+    return num_tracks
+
+
+class _Reader(object):
+    def __init__(self, data, pos):
+        self.data = data
+        self.pos = pos
+
+    def array(self, typecode, count):
+        a = array.array(typecode)
+        end = self.pos + a.itemsize * count
+        if end > len(self.data):
+            raise ValueError('truncated')
+
+        a.fromstring(self.data[self.pos:end])
+        if sys.byteorder == 'little':
+            a.byteswap()
+        self.pos = end
+        return a
+
+    def values(self, kind, count, attr):
+        if kind == 'int':
+            return [None if v == NONE_INT else v for v in self.array(INT_TYPE, count)]
+
+        if kind == 'bool':
+            return [None if v == NONE_BOOL else bool(v) for v in self.array('b', count)]
+
+        if kind == 'intlist':
+            lengths = self.array(INT_TYPE, count)
+            items = self.array(INT_TYPE, sum(n for n in lengths if n > 0)).tolist()
+            result = []
+            pos = 0
+            for n in lengths:
+                if n < 0:
+                    result.append(None)
+                else:
+                    result.append(items[pos:pos + n])
+                    pos += n
+            return result
+
+        result = []
+        for i in xrange(count):
+            length, = LENGTH.unpack_from(self.data, self.pos)
+            self.pos += LENGTH.size
+            if length < 0:
+                result.append(None)
+                continue
+
+            end = self.pos + length
+            if end > len(self.data):
+                raise ValueError('truncated')
+            v = self.data[self.pos:end]
+            self.pos = end
+
+            if kind == 'unicode':
+                v = v.decode('utf-8')
+            elif kind == 'enum':
+                for cls in attr.enum:
+                    if v == cls.__name__:
+                        v = cls
+                        break
+                else:
+                    raise PackError('invalid enum for attribute {0}: {1}'.format(attr.name, v))
+
+            result.append(v)
+
+        return result
+
+
+#
+# Files
+#
+
+def save_disc(disc, path, json_path):
+    """Pack DISC into the file PATH, recording the size, mtime and
+    inode of the disc info file JSON_PATH that it is a copy of.
+    """
+
+    try:
+        st = os.stat(json_path)
+        data = pack_disc(disc, st.st_size, st.st_mtime, st.st_ino)
+    except OverflowError, e:
+        raise PackError('cannot pack {0}: {1}'.format(path, e))
+    except OSError, e:
+        raise PackError('error saving to {0}: {1}'.format(path, e))
+
+    try:
+
+        dir, base = os.path.split(path)
+        with tempfile.NamedTemporaryFile(
+            dir = dir, prefix = base + '.', mode = 'wb', delete = False) as f:
+            temp_path = f.name
+            f.write(data)
+
+        try:
+            os.chmod(temp_path, serialize.SAVE_PERMISSIONS)
+            os.rename(temp_path, path)
+        except OSError:
+            os.unlink(temp_path)
+            raise
+
+    except (IOError, OSError), e:
+        raise PackError('error saving to {0}: {1}'.format(path, e))
+
+
+def load_disc(path, json_st):
+    """Load a DbDisc from the file PATH, if it was made from a JSON
+    file with the os.stat() result JSON_ST.
+
+    Raises PackError if the file can't be used.
+    """
+
+    try:
+        with open(path, 'rb') as f:
+            data = f.read()
+    except IOError, e:
+        raise PackError('error reading {0}: {1}'.format(path, e))
+
+    return unpack_disc(data, json_st.st_size, json_st.st_mtime, json_st.st_ino)
+
+
+def is_current(path, json_st):
+    """Return True if the file PATH is a packed disc made from a JSON
+    file with the os.stat() result JSON_ST.  Only the header is read.
+    """
+
+    try:
+        with open(path, 'rb') as f:
+            _unpack_header(f.read(HEADER.size), json_st.st_size, json_st.st_mtime, json_st.st_ino)
+        return True
+    except (IOError, PackError):
+        return False
@@ -0,0 +1,341 @@
+# codplayer - export discs as one audio file per track
+#
+# Copyright 2018 Peter Liljenberg <peter.liljenberg@gmail.com>
+#
+# Distributed under an MIT license, please see LICENSE in the top dir.
+
+"""
+Export the discs in the database as one file per track, e.g. to copy
+them to other devices.
+
+Tracks are written as WAV files, or piped as WAV through an external
+encoder command such as flac.  Each track starts at index 1, like when
+the player plays it, unless pregaps are included.
+
+The exported tracks are recorded in a manifest file in the output
+directory, together with a CRC32 of the audio data they were made
+from.  Tracks that have already been exported from the same audio are
+skipped, so an interrupted export can simply be run again.
+"""
+
+import os
+import array
+import struct
+import subprocess
+import tempfile
+import zlib
+
+from . import db
+from . import cdz
+from . import model
+from . import serialize
+from . import workpool
+
+
+# Manifest file, in the output directory
+MANIFEST_FILE = 'export.json'
+
+# Read this many audio frames at a time (30 seconds)
+CHUNK_FRAMES = model.PCM.rate * 30
+
+
+class ExportError(Exception):
+    pass
+
+
+class ExportedTrack(serialize.Serializable):
+    MAPPING = (
+        serialize.Attr('db_id', str),
+        serialize.Attr('number', int),
+        serialize.Attr('path', serialize.str_unicode),
+        serialize.Attr('size', (int, long)),
+        serialize.Attr('mtime', float),
+        serialize.Attr('crc32', (int, long)),
+        )
+
+    def __init__(self, db_id = None, number = 0, path = None):
+        self.db_id = db_id
+        self.number = number
+        self.path = path
+        self.size = 0
+        self.mtime = 0.0
+        self.crc32 = 0
+
+
+class ExportManifest(workpool.Manifest):
+    MAPPING = (
+        serialize.Attr('tracks', list_type = ExportedTrack),
+        )
+
+    ENTRIES = 'tracks'
+    ERROR = ExportError
+
+    @staticmethod
+    def entry_key(exported):
+        return (exported.db_id, exported.number)
+
+
+class ExportResult(object):
+    """The outcome of exporting a track.  exported is an ExportedTrack
+    if the track was written, error a string if it failed, and both
+    are None if it was skipped as already exported.
+    """
+
+    def __init__(self, db_id, number, exported = None, error = None):
+        self.db_id = db_id
+        self.number = number
+        self.exported = exported
+        self.error = error
+
+
+class ExportOptions(object):
+    """How to export tracks.
+
+    encoder: None to write WAV files, or a list of command arguments
+    that reads WAV on stdin.  The string {path} in the arguments is
+    replaced with the output path.
+
+    suffix: the output file suffix, e.g. '.flac' for a flac encoder.
+
+    pregaps: if true, include the pregap in each track.
+    """
+
+    def __init__(self, encoder = None, suffix = '.wav', pregaps = False):
+        self.encoder = encoder
+        self.suffix = suffix
+        self.pregaps = pregaps
+
+
+def track_path(out_dir, db_id, disc, track, options):
+    """Return the output path for TRACK on DISC.
+    """
+    name = u'{0:02d}'.format(track.number)
+    if track.title:
+        name += u' ' + track.title.replace(u'/', u'-').replace(u'\0', u'')
+
+    return os.path.join(out_dir, db_id, (name + options.suffix).encode('utf-8'))
+
+
+def get_track_range(track, options):
+    """Return a tuple (silence, file_offset, file_length) describing
+    the audio of TRACK to export, in frames.  SILENCE is the number of
+    frames not in the audio file that start the exported track.
+    """
+
+    if options.pregaps:
+        return (track.pregap_silence, track.file_offset, track.file_length)
+
+    # Start at index 1, which is never in the silent part of the pregap
+    skip = track.pregap_offset - track.pregap_silence
+    return (0, track.file_offset + skip, track.file_length - skip)
+
+
+def wav_header(frames, audio_format):
+    data_size = frames * audio_format.bytes_per_frame
+    return struct.pack(
+        '<4sI4s4sIHHIIHH4sI',
+        'RIFF', 36 + data_size, 'WAVE',
+        'fmt ', 16, 1, audio_format.channels, audio_format.rate,
+        audio_format.rate * audio_format.bytes_per_frame,
+        audio_format.bytes_per_frame, audio_format.bytes_per_sample * 8,
+        'data', data_size)
+
+
+def read_track_crc32(audio_path, disc, track, options):
+    """Return the CRC32 of the audio data in AUDIO_PATH that TRACK is
+    exported from.
+    """
+
+    silence, offset, length = get_track_range(track, options)
+    crc = 0
+    for data in _read_frames(audio_path, disc, offset, length):
+        crc = zlib.crc32(data, crc)
+    return crc & 0xffffffff
+
+
+def export_track(audio_path, disc, track, path, options):
+    """Export TRACK from the DISC audio file AUDIO_PATH to PATH.  The
+    output is written to a temporary file that is renamed when
+    complete.
+
+    Returns the CRC32 of the exported audio data.
+    """
+
+    audio_format = disc.audio_format
+    silence, offset, length = get_track_range(track, options)
+
+    dir, base = os.path.split(path)
+    if not os.path.isdir(dir):
+        os.makedirs(dir)
+
+    # Keep the suffix, since some encoders use it to pick the format
+    fd, temp_path = tempfile.mkstemp(dir = dir, prefix = '.' + base + '.',
+                                     suffix = options.suffix)
+    os.close(fd)
+
+    try:
+        if options.encoder:
+            # Let the encoder create the file itself
+            os.unlink(temp_path)
+            args = [arg.replace('{path}', temp_path) for arg in options.encoder]
+            proc = subprocess.Popen(args, stdin = subprocess.PIPE)
+            out = proc.stdin
+        else:
+            proc = None
+            out = open(temp_path, 'wb')
+
+        try:
+            out.write(wav_header(silence + length, audio_format))
+
+            if silence:
+                out.write('\0' * (silence * audio_format.bytes_per_frame))
+
+            crc = 0
+            for data in _read_frames(audio_path, disc, offset, length):
+                crc = zlib.crc32(data, crc)
+                out.write(_to_little_endian(data, audio_format))
+
+        finally:
+            out.close()
+            if proc:
+                rc = proc.wait()
+                if rc != 0:
+                    raise ExportError('encoder {0} failed with exit code {1}'.format(
+                        options.encoder[0], rc))
+
+        os.chmod(temp_path, serialize.SAVE_PERMISSIONS)
+        os.rename(temp_path, path)
+
+    except:
+        if os.path.exists(temp_path):
+            os.unlink(temp_path)
+        raise
+
+    return crc & 0xffffffff
+
+
+def _read_frames(audio_path, disc, offset, length):
+    # Generate the audio data in big chunks
+    bytes_per_frame = disc.audio_format.bytes_per_frame
+    try:
+        with cdz.open_audio(audio_path, disc.data_file_format) as f:
+            f.seek(offset * bytes_per_frame)
+            while length > 0:
+                data = f.read(min(CHUNK_FRAMES, length) * bytes_per_frame)
+                if not data:
+                    raise ExportError('audio file is truncated: {0}'.format(audio_path))
+                length -= len(data) // bytes_per_frame
+                yield data
+    except cdz.CDZError, e:
+        raise ExportError(str(e))
+
+
+def _to_little_endian(data, audio_format):
+    # WAV files are little endian.  Swap all samples in one go.
+    if not audio_format.big_endian:
+        return data
+
+    assert audio_format.bytes_per_sample == 2
+    samples = array.array('h', data)
+    samples.byteswap()
+    return samples.tostring()
+
+
+#
+# Exporting many tracks in a process pool
+#
+
+def export_disc_track(database, db_id, number, out_dir, options, previous = None):
+    """Export track NUMBER of disc DB_ID in DATABASE
+    to OUT_DIR, returning an ExportResult.
+
+    PREVIOUS is the ExportedTrack from the manifest, if any.  The
+    track is skipped if that file is unchanged and was exported from
+    the same audio data.
+    """
+
+    try:
+        disc = database.get_disc_by_db_id(db_id)
+        if disc is None:
+            return ExportResult(db_id, number, error = 'missing disc info file')
+
+        if disc.audio_format is None:
+            return ExportResult(db_id, number, error = 'no audio format in disc info')
+
+        for track in disc.tracks:
+            if track.number == number:
+                break
+        else:
+            return ExportResult(db_id, number, error = 'no track {0}'.format(number))
+
+        audio_path = database.get_disc_audio_path(db_id, disc)
+        path = track_path(out_dir, db_id, disc, track, options)
+
+        if previous is not None and previous.path == path.decode('utf-8'):
+            try:
+                st = os.stat(path)
+            except OSError:
+                st = None
+
+            if (st and st.st_size == previous.size and st.st_mtime == previous.mtime
+                and read_track_crc32(audio_path, disc, track, options) == previous.crc32):
+                return ExportResult(db_id, number)
+
+        exported = ExportedTrack(db_id, number, path.decode('utf-8'))
+        exported.crc32 = export_track(audio_path, disc, track, path, options)
+
+        st = os.stat(path)
+        exported.size = st.st_size
+        exported.mtime = st.st_mtime
+        return ExportResult(db_id, number, exported)
+
+    except (db.DatabaseError, ExportError, IOError, OSError), e:
+        return ExportResult(db_id, number, error = str(e))
+
+
+def export_database(database, out_dir, db_ids = None, options = None,
+                    processes = None, progress = None):
+    """Export the tracks of the discs DB_IDS (default all discs) in
+    DATABASE to OUT_DIR, in a pool of PROCESSES processes (default
+    one per CPU).
+
+    The manifest is saved periodically in OUT_DIR, so if the export
+    is interrupted the tracks already exported are skipped next time.
+
+    PROGRESS is called with (count, total, ExportResult) as each track
+    is done, in the order they finish.
+
+    Returns a list of ExportResult objects.
+    """
+
+    if options is None:
+        options = ExportOptions()
+
+    if db_ids is None:
+        db_ids = list(database.iterdiscs_db_ids())
+
+    if not os.path.isdir(out_dir):
+        raise ExportError('no such directory: {0}'.format(out_dir))
+
+    manifest_path = os.path.join(out_dir, MANIFEST_FILE)
+    manifest = ExportManifest.load(manifest_path)
+    previous = manifest.get_all()
+
+    jobs = []
+    for db_id in db_ids:
+        try:
+            disc = database.get_disc_by_db_id(db_id)
+        except db.DatabaseError, e:
+            raise ExportError(str(e))
+
+        if disc is None:
+            raise ExportError('no such disc: {0}'.format(db_id))
+
+        for track in disc.tracks:
+            jobs.append((db_id, track.number, out_dir, options,
+                         previous.get((db_id, track.number))))
+
+    return workpool.run_jobs(
+        database, export_disc_track, jobs, processes = processes, progress = progress,
+        manifest = manifest, manifest_path = manifest_path,
+        get_entry = lambda result: result.exported)
@@ -0,0 +1,394 @@
+# codplayer - import existing rips into the database
+#
+# Copyright 2018 Peter Liljenberg <peter.liljenberg@gmail.com>
+#
+# Distributed under an MIT license, please see LICENSE in the top dir.
+
+"""
+Import discs that have been ripped by other means, instead of
+ripping them again.
+
+Two kinds of sources are supported:
+
+  * A directory with one WAV file per track, in file name order.  The
+    WAV files must hold CD audio: 44.1 kHz stereo with 16-bit samples.
+    Each track is padded with silence to a whole CD sector if needed.
+    Since the pregaps aren't known they are kept at the end of the
+    previous track, as most rippers do by default.
+
+  * A raw .cdr audio file with a cdrdao .toc file next to it, as
+    written by codplayer itself.
+
+The Musicbrainz disc ID is calculated from the track layout, which
+gives the right ID for plain audio CDs.  Discs with data tracks can't
+be imported, since their layout can't be recreated from the audio.
+"""
+
+import os
+import array
+import hashlib
+import wave
+
+from . import db
+from . import model
+from . import toc
+from . import workpool
+
+
+# Copy this many bytes at a time
+CHUNK_BYTES = 4 * 1024 * 1024
+
+# The audio is copied to a file with this suffix added, which also
+# marks an interrupted import
+IMPORT_SUFFIX = '.import'
+
+# Musicbrainz disc IDs count track offsets from the start of the
+# 2 second lead-in
+LEAD_IN_SECTORS = 2 * model.PCM.cd_frames_per_second
+
+
+class ImportDiscError(Exception):
+    pass
+
+
+def calculate_disc_id(disc):
+    """Return the Musicbrainz disc ID for the track layout of DISC.
+    """
+
+    sector = model.PCM.audio_frames_per_cd_frame
+
+    # The start of the audio file is after any silence in the first
+    # track's pregap
+    start = disc.tracks[0].pregap_silence
+
+    offsets = []
+    for t in disc.tracks:
+        # Tracks start at index 1
+        pos = start + t.file_offset + t.pregap_offset - t.pregap_silence
+        offsets.append(pos // sector + LEAD_IN_SECTORS)
+
+    lead_out = (start + disc.get_disc_file_size_frames()) // sector + LEAD_IN_SECTORS
+
+    s = hashlib.sha1()
+    s.update('{0:02X}{1:02X}'.format(1, len(disc.tracks)))
+    s.update('{0:08X}'.format(lead_out))
+    for i in range(99):
+        s.update('{0:08X}'.format(offsets[i] if i < len(offsets) else 0))
+
+    return db.Database.db_to_disc_id(s.hexdigest())
+
+
+def frames_to_msf(frames):
+    """Translate a number of PCM audio frames into MM:SS:FF."""
+
+    cd_frames = frames // model.PCM.audio_frames_per_cd_frame
+    seconds, f = divmod(cd_frames, model.PCM.cd_frames_per_second)
+    m, s = divmod(seconds, 60)
+    return '{0:02d}:{1:02d}:{2:02d}'.format(m, s, f)
+
+
+#
+# Import sources
+#
+
+class ImportSource(object):
+    """Base class for discs to import.
+    """
+
+    def __init__(self, path):
+        self.path = path
+
+    def __str__(self):
+        return self.path
+
+    def get_toc(self, audio_file):
+        """Return a cdrdao TOC for the disc.  A generated TOC uses
+        AUDIO_FILE as the data file name.
+        """
+        raise NotImplementedError()
+
+    def copy_audio(self, out):
+        """Write the audio in big-endian raw CD format to the file OUT.
+        """
+        raise NotImplementedError()
+
+    def has_orig_toc(self):
+        """Return True if get_toc() returns a TOC read from the disc."""
+        return False
+
+    def get_disc(self):
+        """Return a DbDisc for the source, with its disc ID calculated
+        from the track layout.
+        """
+
+        text = self.get_toc('import' + model.RAW_CD.file_suffix)
+
+        # Count the tracks, since parse_toc() skips data tracks
+        num_tracks = len([l for l in text.splitlines() if l.strip().startswith('TRACK ')])
+
+        try:
+            disc = toc.parse_toc(text, None)
+        except toc.TOCError, e:
+            raise ImportDiscError('{0}: {1}'.format(self.path, e))
+
+        if len(disc.tracks) != num_tracks:
+            raise ImportDiscError('{0}: cannot import discs with data tracks'.format(
+                self.path))
+
+        disc.disc_id = calculate_disc_id(disc)
+        return disc
+
+
+class WavSource(ImportSource):
+    """A directory with one WAV file for each track.
+    """
+
+    def __init__(self, path, wav_files):
+        super(WavSource, self).__init__(path)
+        self.wav_files = wav_files
+
+    def _open(self, wav_file):
+        path = os.path.join(self.path, wav_file)
+        try:
+            w = wave.open(path, 'rb')
+        except (IOError, EOFError, wave.Error), e:
+            raise ImportDiscError('{0}: {1}'.format(path, e))
+
+        if (w.getnchannels() != model.PCM.channels
+            or w.getsampwidth() != model.PCM.bytes_per_sample
+            or w.getframerate() != model.PCM.rate
+            or w.getcomptype() != 'NONE'):
+            w.close()
+            raise ImportDiscError('{0}: not in CD audio format'.format(path))
+
+        return w
+
+    def _get_track_frames(self):
+        # Return the number of frames of each track, padded to sectors
+        sector = model.PCM.audio_frames_per_cd_frame
+        frames = []
+        for wav_file in self.wav_files:
+            w = self._open(wav_file)
+            n = w.getnframes()
+            w.close()
+            frames.append((n + sector - 1) // sector * sector)
+        return frames
+
+    def get_toc(self, audio_file):
+        lines = ['CD_DA']
+        offset = 0
+        for frames in self._get_track_frames():
+            lines.extend([
+                '',
+                'TRACK AUDIO',
+                'TWO_CHANNEL_AUDIO',
+                'FILE "{0}" {1} {2}'.format(
+                    audio_file, frames_to_msf(offset) if offset else '0',
+                    frames_to_msf(frames)),
+                ])
+            offset += frames
+
+        return '\n'.join(lines) + '\n'
+
+    def copy_audio(self, out):
+        sector_bytes = model.PCM.audio_frames_per_cd_frame * model.PCM.bytes_per_frame
+        chunk_frames = CHUNK_BYTES // model.PCM.bytes_per_frame
+
+        for wav_file in self.wav_files:
+            w = self._open(wav_file)
+            try:
+                written = 0
+                while True:
+                    data = w.readframes(chunk_frames)
+                    if not data:
+                        break
+
+                    # WAV is little-endian, so swap all samples in one go
+                    samples = array.array('h', data)
+                    samples.byteswap()
+                    out.write(samples.tostring())
+                    written += len(data)
+
+                if written % sector_bytes:
+                    out.write('\0' * (sector_bytes - written % sector_bytes))
+
+            except (IOError, EOFError, wave.Error), e:
+                raise ImportDiscError('{0}: {1}'.format(
+                    os.path.join(self.path, wav_file), e))
+            finally:
+                w.close()
+
+
+class RawSource(ImportSource):
+    """A raw big-endian .cdr audio file and its cdrdao .toc file.
+    """
+
+    def __init__(self, toc_path, audio_path):
+        super(RawSource, self).__init__(toc_path)
+        self.audio_path = audio_path
+
+    def has_orig_toc(self):
+        return True
+
+    def get_toc(self, audio_file):
+        try:
+            with open(self.path, 'rt') as f:
+                return f.read()
+        except IOError, e:
+            raise ImportDiscError(str(e))
+
+    def copy_audio(self, out):
+        try:
+            with open(self.audio_path, 'rb') as f:
+                while True:
+                    data = f.read(CHUNK_BYTES)
+                    if not data:
+                        break
+                    out.write(data)
+        except IOError, e:
+            raise ImportDiscError(str(e))
+
+
+def find_sources(paths):
+    """Return a list of ImportSource objects for the discs found in
+    PATHS, which can be .toc files or directories.  A directory with
+    WAV files is one disc, otherwise each .toc file in it with a .cdr
+    file next to it is a disc.
+    """
+
+    sources = []
+    for path in paths:
+        if os.path.isfile(path):
+            toc_paths = [path]
+        elif os.path.isdir(path):
+            files = sorted(os.listdir(path))
+            wav_files = [f for f in files if f.lower().endswith('.wav')]
+            if wav_files:
+                sources.append(WavSource(path, wav_files))
+                continue
+
+            toc_paths = [os.path.join(path, f) for f in files if f.endswith('.toc')]
+        else:
+            raise ImportDiscError('no such file or directory: {0}'.format(path))
+
+        for toc_path in toc_paths:
+            audio_path = os.path.splitext(toc_path)[0] + model.RAW_CD.file_suffix
+            if not os.path.isfile(audio_path):
+                raise ImportDiscError('missing audio file for {0}: {1}'.format(
+                    toc_path, audio_path))
+            sources.append(RawSource(toc_path, audio_path))
+
+    return sources
+
+
+#
+# Importing
+#
+
+class ImportResult(object):
+    """The outcome of importing a source.  imported is False if the
+    disc was already in the database, and error a string if the import
+    failed.
+    """
+
+    def __init__(self, source, db_id = None, imported = False, error = None):
+        self.source = source
+        self.db_id = db_id
+        self.imported = imported
+        self.error = error
+
+
+def import_disc(database, source):
+    """Import SOURCE into DATABASE, returning an ImportResult.
+
+    Discs that are already fully ripped in the database are skipped.
+    The disc is created before the audio is copied, like when ripping,
+    and is only flagged as ripped when the copy is complete.
+
+    While importing, the audio is copied to a file with IMPORT_SUFFIX
+    next to the audio file, which is kept if the import fails.  That
+    marks the disc as created by an interrupted import, which can be
+    run again.  The disc info is then kept, since it may have been
+    edited.  Other discs that aren't fully ripped, e.g. while
+    codplayerd is ripping them, are reported as errors.
+    """
+
+    try:
+        disc = source.get_disc()
+        db_id = database.disc_to_db_id(disc.disc_id)
+
+        audio_file = database.get_audio_file(db_id)
+        audio_path = database.get_audio_path(db_id)
+        temp_path = audio_path + IMPORT_SUFFIX
+
+        old_disc = database.get_disc_by_db_id(db_id)
+        if old_disc is not None:
+            if old_disc.rip:
+                return ImportResult(str(source), db_id)
+
+            if not os.path.exists(temp_path):
+                raise ImportDiscError(
+                    '{0}: disc {1} is in the database but not fully ripped'.format(
+                        source, disc.disc_id))
+
+            if ([(t.file_offset, t.file_length) for t in old_disc.tracks] !=
+                [(t.file_offset, t.file_length) for t in disc.tracks]):
+                raise ImportDiscError(
+                    '{0}: track layout differs from the interrupted import of disc {1}'.format(
+                        source, disc.disc_id))
+
+            # Restart the interrupted import, keeping the disc info
+            disc = old_disc
+
+        else:
+            if os.path.exists(audio_path):
+                raise ImportDiscError('{0}: audio file already exists: {1}'.format(
+                    source, audio_path))
+
+            disc.data_file_name = audio_file
+            database.create_disc(disc)
+
+        # Copy the audio to the temp file first, so a partial copy is
+        # never mistaken for the disc audio
+        try:
+            with open(temp_path, 'wb') as f:
+                source.copy_audio(f)
+
+            size = os.stat(temp_path).st_size
+            if size != disc.get_disc_file_size_bytes():
+                raise ImportDiscError('{0}: audio is {1} bytes, TOC expects {2}'.format(
+                    source, size, disc.get_disc_file_size_bytes()))
+
+            os.rename(temp_path, audio_path)
+        except:
+            # Keep an empty file to mark the interrupted import
+            if os.path.exists(temp_path):
+                open(temp_path, 'wb').close()
+            raise
+
+        if source.has_orig_toc():
+            with open(database.get_orig_toc_path(db_id), 'wt') as f:
+                f.write(source.get_toc(audio_file))
+            disc.toc = True
+
+        disc.rip = True
+        database.save_disc_info(disc)
+
+        return ImportResult(str(source), db_id, True)
+
+    except (ImportDiscError, db.DatabaseError, IOError, OSError), e:
+        return ImportResult(str(source), error = str(e))
+
+
+def import_discs(database, sources, processes = None, progress = None):
+    """Import SOURCES into DATABASE, in a pool of PROCESSES processes
+    (default one per CPU).
+
+    PROGRESS is called with (count, total, ImportResult) as each disc
+    is imported, in the order they finish.
+
+    Returns a list of ImportResult objects.
+    """
+
+    return workpool.run_jobs(database, import_disc, [(source, ) for source in sources],
+                             processes = processes, progress = progress)
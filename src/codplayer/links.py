@@ -0,0 +1,139 @@
+# codplayer - graph of the links between discs
+#
+# Copyright 2018 Peter Liljenberg <peter.liljenberg@gmail.com>
+#
+# Distributed under an MIT license, please see LICENSE in the top dir.
+
+"""
+Discs can be linked to other discs with the link_type and
+linked_disc_id attributes:
+
+  alias: play the linked disc instead of this one
+  next:  the linked disc is the next one in a set
+
+The LinkGraph keeps all links in memory, so following them doesn't
+require loading each disc in a chain.  Loops are rejected when links
+are set, but since the disc info files can be edited by hand the
+lookups still stop if they run into one.
+"""
+
+
+class LinkGraph(object):
+    """Map of disc_id -> (link_type, linked_disc_id), built from LINKS,
+    an iterator of (disc_id, link_type, linked_disc_id) tuples.
+    """
+
+    def __init__(self, links = ()):
+        self._links = {}
+        for disc_id, link_type, linked_disc_id in links:
+            if link_type and linked_disc_id:
+                self._links[disc_id] = (link_type, linked_disc_id)
+
+        # Derived from _links when first needed
+        self._aliases = None
+        self._previous = None
+
+
+    def __len__(self):
+        return len(self._links)
+
+
+    def copy(self):
+        graph = LinkGraph()
+        graph._links = dict(self._links)
+        return graph
+
+
+    def get_link(self, disc_id):
+        """Return a tuple (link_type, linked_disc_id) for DISC_ID, or
+        None if it isn't linked to another disc.
+        """
+        return self._links.get(disc_id)
+
+
+    def set_link(self, disc_id, link_type, linked_disc_id, check = True):
+        """Set or, if LINK_TYPE or LINKED_DISC_ID is empty, remove the
+        link from DISC_ID.
+
+        If CHECK is true, raise ValueError if the link would create a
+        loop of links of the same type.
+        """
+
+        if link_type and linked_disc_id:
+            link = (link_type, linked_disc_id)
+        else:
+            link = None
+
+        if link == self._links.get(disc_id):
+            return
+
+        if link and check:
+            self._check_loop(disc_id, link_type, linked_disc_id)
+
+        if link:
+            self._links[disc_id] = link
+        else:
+            self._links.pop(disc_id, None)
+
+        self._aliases = None
+        self._previous = None
+
+
+    def resolve_alias(self, disc_id):
+        """Return a tuple of the disc IDs reached by following alias
+        links from DISC_ID, ending with the disc that should be played
+        instead of it.  The tuple is empty if DISC_ID isn't an alias.
+        """
+
+        if self._aliases is None:
+            self._aliases = {}
+            for d, (link_type, linked_disc_id) in self._links.iteritems():
+                if link_type == 'alias':
+                    self._aliases[d] = tuple(self._follow(d, 'alias'))
+
+        return self._aliases.get(disc_id, ())
+
+
+    def get_disc_set(self, disc_id):
+        """Return a list of the disc IDs in the set that DISC_ID belongs
+        to, in the order they are linked by next links.  A disc that
+        isn't in any set is alone in its list.
+        """
+
+        if self._previous is None:
+            self._previous = {}
+            for d, (link_type, linked_disc_id) in self._links.iteritems():
+                if link_type == 'next':
+                    self._previous[linked_disc_id] = d
+
+        first = disc_id
+        visited = set([first])
+        while first in self._previous:
+            first = self._previous[first]
+            if first in visited:
+                break
+            visited.add(first)
+
+        return [first] + self._follow(first, 'next')
+
+
+    def _follow(self, disc_id, link_type):
+        # Return the disc IDs reached by LINK_TYPE links from DISC_ID,
+        # stopping before any disc already seen
+        chain = []
+        visited = set([disc_id])
+        link = self._links.get(disc_id)
+
+        while link and link[0] == link_type and link[1] not in visited:
+            disc_id = link[1]
+            chain.append(disc_id)
+            visited.add(disc_id)
+            link = self._links.get(disc_id)
+
+        return chain
+
+
+    def _check_loop(self, disc_id, link_type, linked_disc_id):
+        if linked_disc_id == disc_id or disc_id in self._follow(linked_disc_id, link_type):
+            raise ValueError('{0} link from {1} to {2} would create a loop'.format(
+                link_type, disc_id, linked_disc_id))
@@ -59,6 +59,11 @@ class RAW_CD:
     file_suffix = '.cdr'
 
 
+class COMPRESSED_CD:
+    """Losslessly compressed PCM audio, see the cdz module."""
+    file_suffix = '.cdz'
+
+
 # Various exceptions
 
 class DiscInfoError(Exception):
@@ -208,7 +213,7 @@ class DbDisc(Disc):
         serialize.Attr('toc', bool, optional = True, default = False),
 
         serialize.Attr('data_file_name', serialize.str_unicode),
-        serialize.Attr('data_file_format', enum = (RAW_CD, )),
+        serialize.Attr('data_file_format', enum = (RAW_CD, COMPRESSED_CD)),
         serialize.Attr('audio_format', enum = (PCM, )),
         )
 
@@ -407,6 +412,35 @@ class ExtDisc(Disc):
 
         return discs
 
+
+class DiscOverview(Disc):
+    """Summary of a disc for listings, with the number of tracks
+    instead of the track list.
+    """
+
+    MAPPING = Disc.MAPPING + (
+        serialize.Attr('tracks', int),
+        )
+
+    def __init__(self, disc = None):
+        super(DiscOverview, self).__init__()
+
+        self.tracks = 0
+
+        if disc:
+            self.disc_id = disc.disc_id
+            self.mb_id = disc.mb_id
+            self.cover_mb_id = disc.cover_mb_id
+            self.tracks = len(disc.tracks)
+            self.catalog = disc.catalog
+            self.title = disc.title
+            self.artist = disc.artist
+            self.barcode = disc.barcode
+            self.date = disc.date
+            self.link_type = disc.link_type
+            self.linked_disc_id = disc.linked_disc_id
+
+
 #
 # Musicbrainz helper functions
 #
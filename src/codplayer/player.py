@@ -23,15 +23,18 @@ import copy
 from . import full_version
 from . import serialize
 from . import db
+from . import dbevents
 from . import model
 from . import source
 from . import sink
 from . import rip
+from . import convert
 from .state import State, RipState
 from .command import CommandError
 from . import zerohub
 from .codaemon import Daemon, DaemonError
 from .sources import *
+from .sources import radiostream
 
 class PlayerError(DaemonError):
     pass
@@ -45,9 +48,13 @@ class Player(Daemon):
         self.log_debug = True
 
         self.transport = None
+        self.radio_standby = None
         
         self.ripper = None
 
+        # (db_id, version) of the disc last published by on_db_change()
+        self.published_disc_version = None
+
         if self.cfg.log_performance:
             self.audio_streamer_perf_log = open('/tmp/cod_audio_streamer.log', 'wt')
         else:
@@ -62,9 +69,22 @@ class Player(Daemon):
         self.state_pub = zerohub.AsyncSender(self.mq_cfg.state, name = 'player',
                                              io_loop = self.io_loop)
 
+        if self.mq_cfg.db:
+            self.db_pub = dbevents.DatabasePublisher(
+                self.db, self.mq_cfg.db, 'player', io_loop = self.io_loop)
+            self.db_client = dbevents.DatabaseClient(
+                self.mq_cfg.db, database = self.db, io_loop = self.io_loop,
+                on_change = self.on_db_change, ignore_sender = 'player')
+
 
     def run(self):
         try:
+            if self.cfg.radio_standby and self.cfg.radio_stations:
+                if self.cfg.radio_decoder_process:
+                    self.log('radio_standby is not used with radio_decoder_process')
+                else:
+                    self.radio_standby = radiostream.StandbyPool(self)
+
             self.transport = Transport(
                 self,
                 sink.SINKS[self.cfg.audio_device_type](self))
@@ -86,6 +106,9 @@ class Player(Daemon):
         finally:
             if self.transport:
                 self.transport.shutdown()
+
+            if self.radio_standby:
+                self.radio_standby.close()
         
 
     #
@@ -349,43 +372,29 @@ class Player(Daemon):
         """Follow any disc alias links, returning the disc that should really
         be played.
 
-        Any errors are handled by just returning whatever disc has
-        been reached in the chain, as that is probably good enough to
-        play.
+        The first link is read from the disc info file and the rest
+        are looked up in the database link graph, so only the disc at
+        the end of the chain is loaded.  Any errors are
+        handled by just returning the last disc in the chain that
+        exists, as that is probably good enough to play.
         """
 
-        # Keep track of the disc that started the link
-        source_disc = disc
-        source_disc_id = None
-
-        # Avoid getting stuck in circles
-        visited = set()
-        visited.add(disc.disc_id)
-
-        while disc.link_type == 'alias':
-            if disc.linked_disc_id:
-                linked = self.db.get_disc_by_disc_id(disc.linked_disc_id)
-            else:
-                linked = None
-
-            if not linked:
-                self.log('error: missing alias link from {} to {}',
-                         disc, disc.linked_disc_id)
-                break
-
-            if linked.disc_id in visited:
-                self.log('error: alias link circle from {} to {}',
-                         disc, linked)
-                break
+        try:
+            chain = self.db.resolve_alias(disc.disc_id)
+        except db.DatabaseError, e:
+            self.log('error: could not resolve alias links from {}: {}', disc, e)
+            return disc, None
 
-            self.debug('following alias link from {} to {}',
-                       disc, linked)
+        # Try the end of the chain first, but fall back on a missing link
+        for disc_id in reversed(chain):
+            linked = self.db.get_disc_by_disc_id(disc_id)
+            if linked:
+                self.debug('following alias link from {} to {}', disc, linked)
+                return linked, disc.disc_id
 
-            visited.add(linked.disc_id)
-            disc = linked
-            source_disc_id = source_disc.disc_id
+            self.log('error: missing alias link from {} to {}', disc, disc_id)
 
-        return disc, source_disc_id
+        return disc, None
 
 
     def play_disc(self, disc, track_number = 0):
@@ -428,6 +437,31 @@ class Player(Daemon):
 
             self.io_loop.add_callback(wait_for_eject)
 
+    def on_db_change(self, change):
+        self.debug('database change: {0}', change)
+
+        # Let state subscribers see edits of the current disc at once,
+        # even though the source keeps playing the loaded version
+        current = self.transport.get_source_disc()
+        if current and current.disc_id == change.disc_id:
+            db_id = self.db.disc_to_db_id(change.disc_id)
+            try:
+                # Get the version before loading the disc, so a save
+                # in between is picked up by the next change
+                version = (db_id, self.db.get_disc_version(db_id))
+                if version == self.published_disc_version:
+                    return
+
+                disc = self.db.get_disc_by_db_id(db_id)
+            except db.DatabaseError, e:
+                self.log('error reading changed disc: {0}', e)
+                return
+
+            if disc:
+                self.published_disc_version = version
+                self.transport.update_source_disc(model.ExtDisc(disc))
+
+
     #
     # State publishing
     #
@@ -498,6 +532,12 @@ class Transport(object):
 
         self.sink = sink
 
+        # Optionally convert all sources to the same output format
+        if player.cfg and player.cfg.audio_output_rate:
+            self.converter = convert.FormatConverter(player.cfg.audio_output_rate)
+        else:
+            self.converter = None
+
         self.queue = Queue.Queue(self.PACKETS_PER_SECOND * self.MAX_BUFFER_SECS)
 
         # The following members can only be accessed when holding the lock
@@ -507,6 +547,10 @@ class Transport(object):
         self.state = State()
         self.paused_by_user = False
 
+        # The ExtDisc for the source disc, if any.  Like self.state it
+        # is replaced and never changed, so its encoding is cached.
+        self.ext_disc = None
+
         # Event objects to tell the source and sink threads that the
         # context has changed to allow them to react faster
         self.source_context_changed = threading.Event()
@@ -538,10 +582,18 @@ class Transport(object):
 
     def get_source_disc(self):
         with self.lock:
-            if self.source and self.source.disc:
-                return model.ExtDisc(self.source.disc)
-            else:
-                return None
+            return self.ext_disc
+
+
+    def update_source_disc(self, disc):
+        """Replace the external view of the current source disc with
+        the ExtDisc DISC, e.g. after it has been edited, and publish
+        it.  The source keeps playing the disc it has loaded.
+        """
+        with self.lock:
+            if self.ext_disc and self.ext_disc.disc_id == disc.disc_id:
+                self.ext_disc = serialize.cache_encoding(disc)
+                self.player.publish_disc(self.ext_disc)
 
 
     #
@@ -688,6 +740,7 @@ class Transport(object):
 
                 self.new_context()
                 self.source = None
+                self.update_disc()
                 self.set_state_no_disc()
 
 
@@ -741,7 +794,13 @@ class Transport(object):
         self.new_context()
 
         if new_source is not None:
+            old_disc = self.source.disc if self.source else None
             self.source = new_source
+
+            # Skipping tracks keeps the disc, so only publish a new one
+            if new_source.disc is not old_disc:
+                self.update_disc()
+
             self.set_state_working()
         else:
             self.set_state_stop()
@@ -778,13 +837,17 @@ class Transport(object):
             state.track != self.state.track):
             self.debug('state: {0}', state)
 
-        self.state = state
+        self.state = serialize.cache_encoding(state)
         self.player.publish_state(self.state)
 
 
     def update_disc(self):
-        disc = model.ExtDisc(self.source.disc) if self.source else None
-        self.player.publish_disc(disc)
+        if self.source and self.source.disc:
+            self.ext_disc = serialize.cache_encoding(model.ExtDisc(self.source.disc))
+            self.player.publish_disc(self.ext_disc)
+        else:
+            self.ext_disc = None
+            self.player.publish_disc(model.ExtDisc() if self.source else None)
 
     #
     # Source thread
@@ -816,6 +879,9 @@ class Transport(object):
                 # Packet loop: get packets from the source until we're told
                 # to do something else or reaches the end
 
+                if self.converter:
+                    self.converter.reset()
+
                 try:
                     stalled = True
 
@@ -826,6 +892,10 @@ class Transport(object):
                         if packet is not None:
                             stalled = False
                             packet.context = context
+
+                            if self.converter:
+                                packet = self.converter.convert(packet)
+
                             self.queue.put(packet)
 
                         elif not stalled and self.queue.empty():
@@ -29,7 +29,9 @@ class PyAlsaSink(sink.Sink):
     # four periods.
     PERIOD_SIZE = 4096
 
-    def __init__(self, player, card, start_without_device, log_performance):
+    def __init__(self, player, card, start_without_device, log_performance,
+                 use_mmap = False, sched_policy = None, sched_priority = 0,
+                 cpus = None, lock_memory = False):
         self.log = player.log
         self.debug = player.debug
         self.alsa_card = card
@@ -59,6 +61,12 @@ class PyAlsaSink(sink.Sink):
 
         self.log("using python implementation of ALSA sink - you might get glitchy sound");
 
+        if use_mmap:
+            self.log('alsa: mmap access not supported by python implementation, ignoring alsa_use_mmap')
+
+        if cpus or lock_memory:
+            self.log('alsa: thread affinity and memory locking not supported by python implementation')
+
         # See if we can open the device, just for logging purposes -
         # this will be properly handled in start().
 
@@ -8,8 +8,10 @@ from pkg_resources import resource_filename
 import os
 import sys
 import time
+import threading
 import traceback
 import json
+import email.utils
 
 from tornado import web
 from tornado import httpserver
@@ -22,6 +24,7 @@ from . import version
 from . import config
 from . import command
 from . import db
+from . import dbevents
 from . import model
 from . import serialize
 from . import state
@@ -160,11 +163,11 @@ class RemotePlayer(object):
 
 
     def _on_state(self, state):
-        # Pass state through JSON serialization back to dict,
-        # since sockjs-tornado expects objects that can be
-        # serialized without any of the codplayer special stuff.
+        # Pass a dict, since sockjs-tornado expects objects that can
+        # be serialized without any of the codplayer special stuff.
+        # It is kept for new subscribers.
 
-        self._current_state = json.loads(serialize.get_jsons(state))
+        self._current_state = serialize.dump_object(state)
 
         self._socket_router.broadcast(
             self._subscribers,
@@ -175,7 +178,7 @@ class RemotePlayer(object):
 
 
     def _on_rip_state(self, rip_state):
-        self._current_rip_state = json.loads(serialize.get_jsons(rip_state))
+        self._current_rip_state = serialize.dump_object(rip_state)
 
         self._socket_router.broadcast(
             self._subscribers,
@@ -186,7 +189,7 @@ class RemotePlayer(object):
 
 
     def _on_disc(self, disc):
-        self._current_disc = json.loads(serialize.get_jsons(disc))
+        self._current_disc = serialize.dump_object(disc)
 
         self._socket_router.broadcast(
             self._subscribers,
@@ -205,6 +208,7 @@ class RestConfig(config.DaemonConfig):
         serialize.Attr('host', str),
         serialize.Attr('port', int),
         serialize.Attr('players', list_type=RemotePlayer),
+        serialize.Attr('codmq_conf_path', str, optional=True),
         )
 
     def __init__(self, config_file=None):
@@ -212,28 +216,25 @@ class RestConfig(config.DaemonConfig):
         for player in self.players:
             player.load_mq_config(self.config_path)
 
+        # Only used for the db topic
+        self.mq_config = None
+        if self.codmq_conf_path:
+            self.mq_config = config.MQConfig(os.path.join(os.path.dirname(self.config_path),
+                                                          self.codmq_conf_path))
 
-class DiscOverview(model.Disc):
-    def __init__(self, disc):
-        super(DiscOverview, self).__init__()
 
-        self.disc_id = disc.disc_id
-        self.mb_id = disc.mb_id
-        self.cover_mb_id = disc.cover_mb_id
-        self.tracks = len(disc.tracks)
-        self.catalog = disc.catalog
-        self.title = disc.title
-        self.artist = disc.artist
-        self.barcode = disc.barcode
-        self.date = disc.date
-        self.link_type = disc.link_type
-        self.linked_disc_id = disc.linked_disc_id
+# Moved to model, kept here for compatibility
+DiscOverview = model.DiscOverview
 
 
 class RestDaemon(Daemon):
     def __init__(self, cfg, database, debug = False):
         self._database = database
         self._debug_mode = debug
+        self._socket_router = None
+        self._clients = set()
+        self._db_pub = None
+        self._db_client = None
         super(RestDaemon, self).__init__(cfg, debug = debug)
 
     @property
@@ -268,11 +269,23 @@ class RestDaemon(Daemon):
             return PlayerClientConnection(self, self.config.players, *args)
 
         socket_router = SockJSRouter(connection, prefix='/client', io_loop=self.io_loop)
+        self._socket_router = socket_router
+
+        self._database.add_change_listener(self._on_local_db_change)
+
+        if self.config.mq_config and self.config.mq_config.db:
+            self.log('publishing database changes on {}', self.config.mq_config.db)
+            self._db_pub = dbevents.DatabasePublisher(
+                self._database, self.config.mq_config.db, 'rest', io_loop=self.io_loop)
+            self._db_client = dbevents.DatabaseClient(
+                self.config.mq_config.db, database=self._database, io_loop=self.io_loop,
+                on_change=self._on_db_change, ignore_sender='rest')
 
         urls = [
             web.URLSpec('^/discs$', DiscListHandler, params),
             web.URLSpec('^/discs/([^/]+)$', DiscHandler, params),
             web.URLSpec('^/discs/([^/]+)/musicbrainz$', MusicbrainzHandler, params),
+            web.URLSpec('^/roots$', RootListHandler, params),
             web.URLSpec('^/players$', PlayerListHandler, params),
             web.URLSpec('^/players/([^/]+)$', PlayerHandler, params),
             web.URLSpec('^/players/([^/]+)/([^/]+)$', PlayerCommandHandler, params),
@@ -296,10 +309,55 @@ class RestDaemon(Daemon):
         for p in self.config.players:
             p.start(self, socket_router)
 
+        if not self._database.is_catalog_complete():
+            # Requests read the disc files until the catalog is built
+            catalog_thread = threading.Thread(target=self._build_catalog,
+                                              name='build catalog')
+            catalog_thread.daemon = True
+            catalog_thread.start()
+
         self.log('listening on {}:{}', self.config.host, self.config.port)
         self.io_loop.start()
 
 
+    def _build_catalog(self):
+        self.log('building the database catalog index')
+        try:
+            errors = self._database.reindex()
+        except db.DatabaseError as e:
+            self.log('error building the catalog index: {}', e)
+            return
+
+        for db_id, e in errors:
+            self.log('error reading {}: {}', db_id, e)
+        self.log('catalog index built')
+
+
+    def add_client(self, connection):
+        self._clients.add(connection)
+
+    def remove_client(self, connection):
+        self._clients.discard(connection)
+
+
+    def _on_local_db_change(self, change):
+        # Changes are made by request handlers, but be safe
+        self.io_loop.add_callback(lambda: self._on_db_change(change))
+
+    def _on_db_change(self, change):
+        """Tell all connected clients which disc has changed, so they
+        can fetch it again.
+        """
+        if self._clients:
+            self._socket_router.broadcast(self._clients, {
+                'db': {
+                    'disc_id': change.disc_id,
+                    'event': change.event,
+                    'seq': change.seq,
+                }
+            })
+
+
     def _log_request(self, handler):
         status = handler.get_status()
         self.log('{0.method} {0.uri} {1} {0.remote_ip}', handler.request, status)
@@ -318,6 +376,32 @@ class BaseHandler(web.RequestHandler):
         self.set_header('Content-type', 'application/json')
         self.finish(serialize.get_jsons(obj, pretty=pretty))
 
+    def _not_modified(self, etag, timestamp):
+        """Set the ETag and Last-Modified (if TIMESTAMP isn't None)
+        headers for the resource.  If the client already has this
+        version, send a 304 response and return True.
+        """
+
+        self.set_header('Etag', etag)
+        if timestamp is not None:
+            self.set_header('Last-Modified', email.utils.formatdate(timestamp, usegmt=True))
+
+        if self.request.headers.get('If-None-Match'):
+            not_modified = self.check_etag_header()
+        else:
+            not_modified = False
+            since = self.request.headers.get('If-Modified-Since')
+            if since and timestamp is not None:
+                since = email.utils.parsedate_tz(since)
+                if since is not None:
+                    not_modified = int(timestamp) <= email.utils.mktime_tz(since)
+
+        if not_modified:
+            self.set_status(304)
+            self.finish()
+
+        return not_modified
+
     def log_exception(self, exc_type, exc_value, exc_tb):
         if not isinstance(exc_value, web.HTTPError):
             self._daemon.log('Unhandled exception:\n{}', ''.join(
@@ -327,21 +411,100 @@ class BaseHandler(web.RequestHandler):
 class DiscListHandler(BaseHandler):
     """Return an array of DiscOverview JSON objects for all discs
     in the database.
+
+    If the query parameter q is provided, only the discs matching the
+    search words are returned, best matches first.  offset and limit
+    can be used to page through the search results.
+
+    If the query parameter since is provided, a JSON object is returned
+    instead, with the discs that have changed after that sequence
+    number:
+
+      {
+        "seq": current sequence number, used in the next request,
+        "full": true if this is the full list, since the changes
+                since the requested sequence number aren't known,
+        "discs": [ DiscOverview objects ]
+      }
+
+    The response has an ETag based on the current sequence number, so
+    a conditional request returns 304 if no disc has changed.
+
+    PUT an array of model.ExtDisc JSON objects to update several discs
+    at once.  Either all of them are updated, or none.  The response
+    is an array of the updated discs.
     """
 
     def get(self):
-        discs = []
-        for db_id in self._database.iterdiscs_db_ids():
+        version = self._database.get_catalog_version()
+        if version.catalog_id is not None and self._not_modified(
+                '"{0}-{1}"'.format(version.catalog_id, version.seq), version.timestamp):
+            return
+
+        query = self.get_argument('q', None)
+        since = self.get_argument('since', None)
+
+        if since is not None:
+            try:
+                since = int(since)
+            except ValueError:
+                raise web.HTTPError(400, 'Invalid since')
+
+            version, discs = self._database.get_changed_discs(since)
+            full = discs is None
+            if full:
+                discs = list(self._database.iterdiscs_overviews())
+
+            self._send_json({ 'seq': version.seq, 'full': full, 'discs': discs },
+                            pretty=False)
+            return
+
+        if query is None:
+            discs = list(self._database.iterdiscs_overviews())
+        else:
             try:
-                disc = self._database.get_disc_by_db_id(db_id)
-                if disc:
-                    discs.append(DiscOverview(disc))
-            except model.DiscInfoError, e:
-                pass
+                offset = int(self.get_argument('offset', 0))
+                limit = self.get_argument('limit', None)
+                if limit is not None:
+                    limit = int(limit)
+            except ValueError:
+                raise web.HTTPError(400, 'Invalid offset or limit')
+
+            if offset < 0 or (limit is not None and limit < 0):
+                raise web.HTTPError(400, 'Invalid offset or limit')
+
+            discs = self._database.search_discs(query, offset, limit)
 
         self._send_json(discs, pretty=False)
 
 
+    def put(self):
+        if not self.request.body:
+            raise web.HTTPError(400, 'Missing disc JSON')
+
+        try:
+            raw = json.loads(self.request.body)
+        except ValueError as e:
+            raise web.HTTPError(400, 'malformed JSON: {0}'.format(e))
+
+        if not isinstance(raw, list) or not all(isinstance(d, dict) for d in raw):
+            raise web.HTTPError(400, 'Expected a JSON array of discs')
+
+        try:
+            input_discs = [serialize.load_jsono(model.ExtDisc, d) for d in raw]
+        except serialize.LoadError as e:
+            raise web.HTTPError(400, str(e))
+
+        try:
+            db_discs = self._database.update_discs(input_discs)
+        except ValueError as e:
+            raise web.HTTPError(400, str(e))
+        except db.DatabaseError as e:
+            raise web.HTTPError(500, str(e))
+
+        self._send_json([model.ExtDisc(d) for d in db_discs])
+
+
 class DiscHandler(BaseHandler):
     """GET or PUT full model.ExtDisc JSON object for the disc with the
     provided Musicbrainz disc ID.
@@ -351,6 +514,15 @@ class DiscHandler(BaseHandler):
         if not self._database.is_valid_disc_id(disc_id):
             raise web.HTTPError(400, 'Invalid disc_id')
 
+        disc_version = self._database.get_disc_version(
+            self._database.disc_to_db_id(disc_id))
+
+        if disc_version is not None:
+            mtime, size, inode = disc_version
+            etag = '"{0:x}-{1:x}-{2:x}"'.format(int(mtime * 1000), size, inode)
+            if self._not_modified(etag, mtime):
+                return
+
         disc = self._database.get_disc_by_disc_id(disc_id)
         if disc is None:
             raise web.HTTPError(404, 'Unknown disc_id')
@@ -374,7 +546,13 @@ class DiscHandler(BaseHandler):
             raise web.HTTPError(400, 'disc_id mismatch: got "{0}" in URL, "{1}" in JSON'.format(
                 disc_id, input_disc.disc_id))
 
-        db_disc = self._database.update_disc(input_disc)
+        try:
+            db_disc = self._database.update_disc(input_disc)
+        except ValueError as e:
+            raise web.HTTPError(400, str(e))
+        except db.DatabaseError as e:
+            raise web.HTTPError(500, str(e))
+
         self._send_json(model.ExtDisc(db_disc))
 
 
@@ -408,6 +586,18 @@ class MusicbrainzHandler(BaseHandler):
             raise web.HTTPError(500, 'Musicbrainz web service error: {0}'.format(e))
 
 
+class RootListHandler(BaseHandler):
+    """Return an array of db.RootInfo JSON objects for the database
+    storage roots, with the I/O made by codrestd to each.
+    """
+
+    def get(self):
+        try:
+            self._send_json(self._database.get_root_info())
+        except db.DatabaseError, e:
+            raise web.HTTPError(500, str(e))
+
+
 class PlayerListHandler(BaseHandler):
     def get(self):
         self._send_json([p.json for p in self._daemon.config.players])
@@ -462,10 +652,12 @@ class PlayerClientConnection(SockJSConnection):
         super(PlayerClientConnection, self).__init__(*args)
 
     def on_open(self, request):
+        self._daemon.add_client(self)
         for p in self._players:
             p.subscribe(self)
 
     def on_close(self):
+        self._daemon.remove_client(self)
         for p in self._players:
             p.unsubscribe(self)
 
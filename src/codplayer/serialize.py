@@ -9,6 +9,7 @@ Wrappers around basic json serialization and deserialization.
 n"""
 
 import json
+import re
 import types
 import tempfile
 import os
@@ -43,6 +44,9 @@ class Serializable(object):
     populate_object.
     """
 
+    # The JSON string for objects passed to cache_encoding()
+    _cached_jsons = None
+
     @classmethod
     def from_file(cls, path):
         """Load an object from the JSON stored in the file PATH."""
@@ -144,6 +148,12 @@ def populate_object(src, dest, mapping):
     Raises LoadError if a value is missing or is of the wrong type.
     """
 
+    # Use the compiled loader when populating a Serializable from its
+    # own mapping
+    if mapping is getattr(dest.__class__, 'MAPPING', None):
+        get_loader(dest.__class__)(src, dest)
+        return
+
     for attr in mapping:
         try:
             value = src[attr.name]
@@ -159,6 +169,313 @@ def populate_object(src, dest, mapping):
         setattr(dest, '_populated_' + attr.name, present)
 
 
+#
+# Compiled loaders and dumpers
+#
+# Interpreting the MAPPING for each object and value is slow, so a
+# loader, a dumper and a JSON encoder function specialised for each
+# class are generated from its MAPPING on first use.
+#
+
+_loaders = {}
+_dumpers = {}
+_encoders = {}
+
+_identifier = re.compile(r'^[A-Za-z_][A-Za-z0-9_]*$')
+
+
+def get_loader(cls):
+    """Return a function loader(src, dest) that populates DEST of
+    class CLS from the dictionary SRC using CLS.MAPPING, with the same
+    result as populate_object().
+    """
+    try:
+        return _loaders[cls]
+    except KeyError:
+        loader = _loaders[cls] = _compile_loader(cls)
+        return loader
+
+
+def get_dumper(cls):
+    """Return a function dumper(obj) that returns a dictionary with
+    the MAPPING attributes of the object OBJ of class CLS, ready to be
+    encoded as JSON.
+    """
+    try:
+        return _dumpers[cls]
+    except KeyError:
+        dumper = _dumpers[cls] = _compile_dumper(cls)
+        return dumper
+
+
+def dump_object(obj):
+    """Return a dictionary with the MAPPING attributes of OBJ, with
+    nested objects and enum classes translated to JSON values.
+    """
+    if obj is None:
+        return None
+    return get_dumper(obj.__class__)(obj)
+
+
+def get_encoder(cls):
+    """Return a function encoder(obj) that returns the compact JSON
+    string for the object OBJ of class CLS.  Only the MAPPING
+    attributes are included, in MAPPING order.
+    """
+    try:
+        return _encoders[cls]
+    except KeyError:
+        encoder = _encoders[cls] = _compile_encoder(cls)
+        return encoder
+
+
+def encode_object(obj):
+    """Return the compact JSON string for the MAPPING attributes of
+    OBJ, in MAPPING order.
+    """
+    if obj is None:
+        return 'null'
+
+    jsons = obj._cached_jsons
+    if jsons is not None:
+        return jsons
+
+    return get_encoder(obj.__class__)(obj)
+
+
+def cache_encoding(obj):
+    """Encode OBJ and keep the JSON string in it, so that get_jsons()
+    and encode_object() return it directly whenever OBJ is sent.
+
+    OBJ must not be changed after this, and neither may copies of it
+    made with copy.copy().  Returns OBJ.
+    """
+    obj._cached_jsons = None
+    obj._cached_jsons = encode_object(obj)
+    return obj
+
+
+_encode_string = json.encoder.encode_basestring_ascii
+
+def _encode_value(value):
+    # Plain JSON values, with the common types handled directly
+    if value is None:
+        return 'null'
+
+    t = value.__class__
+    if t is str or t is str_unicode:
+        return _encode_string(value)
+    if t is int or t is long:
+        return str(value)
+    if t is bool:
+        return 'true' if value else 'false'
+    if t is list or t is tuple:
+        return '[' + ','.join([_encode_value(v) for v in value]) + ']'
+    if t is dict and all(isinstance(k, basestring) for k in value):
+        return '{' + ','.join([_encode_string(k) + ':' + _encode_value(v)
+                               for k, v in value.iteritems()]) + '}'
+    if isinstance(value, Serializable):
+        return encode_object(value)
+
+    return _fallback_encoder.encode(value)
+
+
+def _compile(source, namespace, func_name):
+    code = compile(source, '<serialize {0}>'.format(func_name), 'exec')
+    exec code in namespace
+    return namespace[func_name]
+
+
+def _value_loader_lines(var, name, value_type, index, indent, namespace):
+    # Return code checking and translating the value in VAR
+
+    type_var = 'type_{0}'.format(index)
+    namespace[type_var] = value_type
+
+    if isinstance(value_type, type) and issubclass(value_type, Serializable):
+        lines = [
+            'if {var} is not None:',
+            '    if not isinstance({var}, dict):',
+            '        raise LoadError("expected mapping for attribute {{0}}, got {{1!r}}".format({name!r}, {var}))',
+            '    o = {type_var}()',
+            '    get_loader({type_var})({var}, o)',
+            '    {var} = o',
+            ]
+    else:
+        lines = ['if {var} is not None:']
+        if value_type is str:
+            # Special case: translate unicode to str
+            lines += [
+                '    if isinstance({var}, str_unicode):',
+                '        {var} = str({var})',
+                ]
+        lines += [
+            '    if not isinstance({var}, {type_var}):',
+            '        raise LoadError("expected type {{0!r}} for attribute {{1}}, got {{2!r}}".format({type_var}, {name!r}, {var}))',
+            ]
+
+    return [' ' * indent + line.format(var = var, name = name, type_var = type_var)
+            for line in lines]
+
+
+def _compile_loader(cls):
+    namespace = {
+        'LoadError': LoadError,
+        'str_unicode': str_unicode,
+        'get_loader': get_loader,
+        }
+
+    lines = ['def load(src, dest):',
+             '    d = dest.__dict__']
+
+    for i, attr in enumerate(cls.MAPPING):
+        name = attr.name
+
+        lines += ['    try:',
+                  '        v = src[{0!r}]'.format(name),
+                  '        p = True',
+                  '    except KeyError:']
+
+        if attr.optional:
+            default_var = 'default_{0}'.format(i)
+            namespace[default_var] = attr.default
+            lines += ['        v = {0}'.format(default_var),
+                      '        p = False']
+        else:
+            lines += ['        raise LoadError({0!r})'.format(
+                'missing attribute: {0}'.format(name))]
+
+        if attr.value_type:
+            lines += _value_loader_lines('v', name, attr.value_type, i, 4, namespace)
+
+        elif attr.list_type:
+            lines += ['    if v is not None:',
+                      '        if not isinstance(v, list):',
+                      '            raise LoadError("expected list for attribute {{0}}, got {{1!r}}".format({0!r}, v))'.format(name),
+                      '        values = []',
+                      '        for e in v:']
+            lines += _value_loader_lines('e', name, attr.list_type, i, 12, namespace)
+            lines += ['            values.append(e)',
+                      '        v = values']
+
+        elif attr.enum:
+            enum_var = 'enum_{0}'.format(i)
+            # The first class with a given name wins, like in Attr
+            namespace[enum_var] = dict((c.__name__, c) for c in reversed(attr.enum))
+            lines += ['    try:',
+                      '        v = {0}[v]'.format(enum_var),
+                      '    except (KeyError, TypeError):',
+                      '        raise LoadError("invalid class enum for attribute {{0}}, got {{1}}".format({0!r}, v))'.format(name)]
+
+        else:
+            assert False, 'this should not happen'
+
+        lines += ['    d[{0!r}] = v'.format(name),
+                  '    d[{0!r}] = p'.format('_populated_' + name)]
+
+    lines.append('    return dest')
+
+    return _compile('\n'.join(lines) + '\n', namespace, 'load')
+
+
+def _compile_dumper(cls):
+    namespace = {
+        'dump_object': dump_object,
+        }
+
+    lines = ['def dump(obj):',
+             '    d = {}']
+
+    for attr in cls.MAPPING:
+        name = attr.name
+        assert _identifier.match(name), 'bad attribute name: {0!r}'.format(name)
+
+        value_type = attr.value_type or attr.list_type
+        nested = isinstance(value_type, type) and issubclass(value_type, Serializable)
+
+        if attr.value_type and nested:
+            lines += ['    v = obj.{0}'.format(name),
+                      '    d[{0!r}] = None if v is None else dump_object(v)'.format(name)]
+
+        elif attr.list_type and nested:
+            lines += ['    v = obj.{0}'.format(name),
+                      '    d[{0!r}] = None if v is None else [dump_object(e) for e in v]'.format(name)]
+
+        elif attr.enum:
+            lines += ['    v = obj.{0}'.format(name),
+                      '    d[{0!r}] = None if v is None else v.__name__'.format(name)]
+
+        else:
+            lines += ['    d[{0!r}] = obj.{1}'.format(name, name)]
+
+    lines.append('    return d')
+
+    return _compile('\n'.join(lines) + '\n', namespace, 'dump')
+
+
+def _compile_encoder(cls):
+    namespace = {
+        'encode_object': encode_object,
+        'encode_value': _encode_value,
+        'encode_string': _encode_string,
+        'str_unicode': str_unicode,
+        }
+
+    lines = ['def encode(obj):']
+    parts = []
+
+    for i, attr in enumerate(cls.MAPPING):
+        name = attr.name
+        assert _identifier.match(name), 'bad attribute name: {0!r}'.format(name)
+
+        var = 'v{0}'.format(i)
+        key = '{0}{1}:'.format(',' if i else '{', _encode_string(name))
+
+        value_type = attr.value_type or attr.list_type
+        nested = isinstance(value_type, type) and issubclass(value_type, Serializable)
+
+        if attr.value_type and nested:
+            value = 'encode_object(obj.{0})'.format(name)
+
+        elif attr.list_type and nested:
+            lines.append('    {0} = obj.{1}'.format(var, name))
+            value = ("'null' if {0} is None else "
+                     "'[' + ','.join([encode_object(e) for e in {0}]) + ']'".format(var))
+
+        elif attr.enum:
+            lines.append('    {0} = obj.{1}'.format(var, name))
+            value = """'null' if {0} is None else '"' + {0}.__name__ + '"'""".format(var)
+
+        elif attr.value_type in (str, str_unicode):
+            lines.append('    {0} = obj.{1}'.format(var, name))
+            value = ("encode_string({0}) if {0}.__class__ is str or {0}.__class__ is str_unicode "
+                     "else encode_value({0})".format(var))
+
+        elif attr.value_type is int or attr.value_type == (int, long):
+            lines.append('    {0} = obj.{1}'.format(var, name))
+            value = "str({0}) if {0}.__class__ is int else encode_value({0})".format(var)
+
+        elif attr.value_type is bool:
+            lines.append('    {0} = obj.{1}'.format(var, name))
+            value = ("'true' if {0} is True else 'false' if {0} is False "
+                     "else encode_value({0})".format(var))
+
+        else:
+            value = 'encode_value(obj.{0})'.format(name)
+
+        parts += ['        {0!r},'.format(key),
+                  '        {0},'.format(value)]
+
+    if parts:
+        lines.append("    return ''.join((")
+        lines += parts
+        lines.append("        '}'))")
+    else:
+        lines.append("    return '{}'")
+
+    return _compile('\n'.join(lines) + '\n', namespace, 'encode')
+
+
 def attr_populated(obj, attr):
     """Return True if attr was populated in obj from source JSON."""
     return not not getattr(obj, '_populated_' + attr, False)
@@ -169,6 +486,9 @@ class CodEncoder(json.JSONEncoder):
 
     - Classes are serialized by name, to handle the various state and
       format IDs
+
+    - Serializable objects are serialized with their MAPPING
+      attributes only, leaving out internal attributes
     """
 
     def default(self, obj):
@@ -176,49 +496,137 @@ class CodEncoder(json.JSONEncoder):
             return obj.__name__
 
         if isinstance(obj, Serializable):
-            # TODO: strip out anything starting with underscore
-            return obj.__dict__
+            return dump_object(obj)
 
         super(CodEncoder, self).default(obj)
-        
+
+
+_fallback_encoder = CodEncoder(separators = (',', ':'))
 
     
 def save_json(obj, path):
-    """Serialize OBJ (really its __dict__) to json and save it in a file in PATH.
+    """Serialize OBJ to json and save it in a file in PATH.
+
+    The file is replaced atomically and synced to disk before
+    returning.  Use a SaveBatch to save several files with a single
+    wait for the disk.
     """
 
-    # TODO: also handle UTF-8 properly
+    batch = SaveBatch()
+    batch.add(obj, path)
+    batch.commit()
 
-    try:
-        dir, base = os.path.split(path)
 
-        # Work with a temporary file in the same directory as the
-        # state file, so we know we can safely rename it later
-        with tempfile.NamedTemporaryFile(
-            dir = dir,
-            prefix = base + '.',
-            mode = 'wt',
-            delete = False) as f:
+class SaveBatch(object):
+    """Save several objects to JSON files, replacing each file
+    atomically and durably.
 
-            temp_path = f.name
+    add() writes each object to a temporary file next to its target
+    path.  commit() then syncs all the temporary files, renames them
+    into place, and syncs the directories.  That lets the disk
+    writes of all files be flushed together instead of one at a time.
 
-            json.dump(obj, f, indent = 2, sort_keys = True, cls = CodEncoder)
+    If an error is raised before commit() has finished, the files
+    that haven't been renamed yet are left unchanged.
+    """
+
+    def __init__(self):
+        # (temp_path, path)
+        self._files = []
+
+
+    def __len__(self):
+        return len(self._files)
+
+
+    def add(self, obj, path):
+        """Write OBJ to a temporary file that will replace PATH on commit().
+        """
 
-        os.chmod(temp_path, SAVE_PERMISSIONS)
+        # TODO: also handle UTF-8 properly
 
         try:
-            os.unlink(path)
-        except OSError:
-            pass
-        
-        os.rename(temp_path, path)
+            dir, base = os.path.split(path)
+
+            # Work with a temporary file in the same directory as the
+            # state file, so we know we can safely rename it later
+            with tempfile.NamedTemporaryFile(
+                dir = dir,
+                prefix = base + '.',
+                mode = 'wt',
+                delete = False) as f:
+
+                self._files.append((f.name, path))
+
+                json.dump(obj, f, indent = 2, sort_keys = True, cls = CodEncoder)
+
+            os.chmod(f.name, SAVE_PERMISSIONS)
+
+        except (IOError, OSError), e:
+            self.abort()
+            raise SaveError('error saving to {0}: {1}'.format(path, e))
+
+
+    def commit(self):
+        """Move all the files into place, and return when they are
+        safely on disk.
+        """
+
+        files = self._files
+        self._files = []
+        dirs = set()
+
+        try:
+            # Sync all data before any file is replaced, so a crash
+            # can't leave a renamed but empty file
+            for temp_path, path in files:
+                _fsync_path(temp_path)
+
+            while files:
+                temp_path, path = files[0]
+                os.rename(temp_path, path)
+                files.pop(0)
+                dirs.add(os.path.dirname(path) or '.')
+
+            for dir in dirs:
+                _fsync_path(dir)
+
+        except (IOError, OSError), e:
+            self._files = files
+            self.abort()
+            raise SaveError('error saving to {0}: {1}'.format(
+                files[0][1] if files else ', '.join(dirs), e))
+
+
+    def abort(self):
+        """Remove any temporary files not yet committed."""
+
+        for temp_path, path in self._files:
+            try:
+                os.unlink(temp_path)
+            except OSError:
+                pass
+
+        self._files = []
+
+
+def _fsync_path(path):
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
 
-    except (IOError, OSError), e:
-        raise SaveError('error saving to {0}: {1}'.format(path, e))
-    
 
 def get_jsons(obj, pretty = False):
-    return json.dumps(obj, indent = 2 if pretty else None, sort_keys = pretty, cls = CodEncoder)
+    """Return OBJ serialized to a JSON string.  Unless PRETTY is
+    True, the string is compact and Serializable objects are encoded
+    with their compiled encoders.
+    """
+    if pretty:
+        return json.dumps(obj, indent = 2, sort_keys = True, cls = CodEncoder)
+
+    return _encode_value(obj)
 
     
 def load_json(cls, path):
@@ -236,9 +644,7 @@ def load_json(cls, path):
     if raw is None:
         return None
 
-    obj = cls()
-    populate_object(raw, obj, cls.MAPPING)
-    return obj
+    return get_loader(cls)(raw, cls())
         
 
 def load_jsons(cls, string):
@@ -255,9 +661,7 @@ def load_jsons(cls, string):
     if raw is None:
         return None
 
-    obj = cls()
-    populate_object(raw, obj, cls.MAPPING)
-    return obj
+    return get_loader(cls)(raw, cls())
 
 
 def load_jsono(cls, raw):
@@ -270,8 +674,6 @@ def load_jsono(cls, raw):
     if raw is None:
         return None
 
-    obj = cls()
-    populate_object(raw, obj, cls.MAPPING)
-    return obj
+    return get_loader(cls)(raw, cls())
 
         
@@ -146,10 +146,16 @@ class AlsaSink(Sink):
             player.debug('error importing c_alsa_sink: {0}', e)
             from .py_alsa_sink import PyAlsaSink as AlsaSinkImpl
 
+        cfg = player.cfg
         self.impl = AlsaSinkImpl(player,
-                                 player.cfg.alsa_card,
-                                 player.cfg.start_without_device,
-                                 player.cfg.log_performance)
+                                 cfg.alsa_card,
+                                 cfg.start_without_device,
+                                 cfg.log_performance,
+                                 use_mmap = cfg.alsa_use_mmap,
+                                 sched_policy = cfg.alsa_thread_policy,
+                                 sched_priority = cfg.alsa_thread_priority,
+                                 cpus = cfg.alsa_thread_cpus,
+                                 lock_memory = cfg.alsa_lock_memory)
 
         if hasattr(self.impl, 'log_helper'):
             # Kick off a thread that helps the C thread to log through
@@ -0,0 +1,345 @@
+# codplayer - jitter buffer for network sources
+#
+# Copyright 2018 Peter Liljenberg <peter.liljenberg@gmail.com>
+#
+# Distributed under an MIT license, please see LICENSE in the top dir.
+
+"""
+Buffer audio packets arriving over the network, so that short network
+hiccups don't starve the audio device.
+
+The buffer is filled by a reader thread calling put(), and the source
+iterator gets packets to play with get().  The fill level is measured
+all the way to the sink by tracking which packet is currently
+playing, since packets are passed on to the transport queue as soon
+as playback has started.
+"""
+
+import threading
+import collections
+import time
+
+from .. import audio
+
+
+class BufferedPacket(audio.AudioPacket):
+    """Audio packet passed on from a JitterBuffer, reporting back to
+    the buffer when it is played.
+    """
+
+    def __init__(self, jitter_buffer, packet, position):
+        super(BufferedPacket, self).__init__(packet.format, packet.flags)
+        self.data = packet.data
+        self.position = position
+        self.duration = packet_duration(packet)
+        self._jitter_buffer = jitter_buffer
+
+    def update_state(self, state):
+        self._jitter_buffer.playing(self)
+        return None
+
+
+class JitterBuffer(object):
+    """Adaptive buffer between a network stream and the transport.
+
+    Playback starts once the buffer holds the target fill level.  The
+    target adapts to the observed variation in packet arrival times,
+    between min_target and max_target seconds, and is raised when the
+    sink runs out of packets.
+
+    Since the stream is played by the device clock and not the clock
+    of the sender, the fill level slowly drifts.  This is corrected by
+    dropping or repeating single frames, spread out over a packet,
+    when the fill level is too far from the target.
+    """
+
+    # Smoothing of the arrival jitter estimate, as in RFC 3550
+    JITTER_GAIN = 1.0 / 16
+
+    # The target fill is at least this many times the arrival jitter...
+    JITTER_FACTOR = 4
+
+    # ...or the largest arrival delay seen during this many seconds.
+    # The target is also kept for at least this long after being raised.
+    DELAY_MEMORY = 300
+
+    # Raise the target by this factor when the sink runs dry
+    UNDERRUN_FACTOR = 1.5
+
+    # Smoothing of the fill level used for drift correction, per packet
+    FILL_GAIN = 1.0 / 50
+
+    # Correct drift when the fill level is this fraction off target
+    DRIFT_THRESHOLD = 0.25
+
+    # At most drop or repeat this fraction of the frames in a packet
+    MAX_CORRECTION = 0.001
+
+    # Don't correct drift if the sink hasn't reported playing a
+    # packet for this many seconds
+    PLAYOUT_TIMEOUT = 2
+
+    def __init__(self, log, debug, min_target, max_target):
+        self.log = log
+        self.debug = debug
+        self.min_target = min_target
+        self.max_target = max_target
+
+        self._cond = threading.Condition()
+        self._packets = collections.deque()
+        self._queued = 0.0
+        self._received = 0.0
+        self._playing = None
+        self._playing_time = 0
+        self._last_arrival = None
+        self._last_duration = 0.0
+        self._jitter = 0.0
+        self._delay = 0.0
+        self._delay_time = 0
+        self._target = min_target
+        self._target_time = 0
+        self._fill = None
+        self._offset = 0
+        self._buffering = True
+        self._closed = False
+        self._error = None
+
+
+    @property
+    def closed(self):
+        return self._closed
+
+
+    @property
+    def target(self):
+        return self._target
+
+
+    def put(self, packet):
+        """Add a packet received from the stream."""
+
+        duration = packet_duration(packet)
+        if duration == 0:
+            return
+
+        with self._cond:
+            if self._closed:
+                return
+
+            now = time.time()
+            if self._last_arrival is not None:
+                delay = (now - self._last_arrival) - self._last_duration
+                self._jitter += (abs(delay) - self._jitter) * self.JITTER_GAIN
+
+                if delay > self._delay or now - self._delay_time > self.DELAY_MEMORY:
+                    self._delay = max(delay, 0)
+                    self._delay_time = now
+
+                self._update_target()
+
+            self._last_arrival = now
+            self._last_duration = duration
+
+            if not self._store(BufferedPacket(self, packet, self._received)):
+                return
+
+            self._received += duration
+            self._queued += duration
+
+            self._cond.notify()
+
+
+    def get(self, timeout):
+        """Return the next packet to play, or None if there is none
+        within TIMEOUT seconds or the buffer is still filling up.
+
+        Raises any error set by set_error() once the buffered packets
+        have been returned.
+        """
+
+        with self._cond:
+            end = time.time() + timeout
+
+            while True:
+                if self._closed:
+                    return None
+
+                if self._buffering and (self._queued >= self._target or self._error):
+                    self.log('buffered {0:.1f} s, starting playback', self._queued)
+                    self._buffering = False
+
+                if not self._buffering and self._packets:
+                    break
+
+                if self._error and not self._packets:
+                    raise self._error
+
+                remaining = end - time.time()
+                if remaining <= 0:
+                    return None
+
+                self._cond.wait(remaining)
+
+            packet = self._load()
+            self._queued -= packet.duration
+
+            self._correct_drift(packet)
+            return packet
+
+
+    def playing(self, packet):
+        """Called by the sink thread when PACKET is being played."""
+        with self._cond:
+            now = time.time()
+
+            if (self._playing is not None
+                and now - self._playing_time > self.PLAYOUT_TIMEOUT):
+                # Playback has been paused, so anything buffered
+                # beyond the target while paused is kept as a delay
+                # instead of being corrected as drift
+                self._offset = max(0, self._received - packet.position - self._target)
+                self._fill = None
+                self.debug('playback resumed {0:.1f} s behind stream', self._offset)
+
+            if self._playing is None or packet.position > self._playing:
+                self._playing = packet.position
+            self._playing_time = now
+
+
+    def underrun(self):
+        """Called when the sink has run out of packets.  Rebuffer
+        before continuing, to a higher target level.
+        """
+        with self._cond:
+            if self._buffering or self._closed:
+                return
+
+            self._target = min(self._target * self.UNDERRUN_FACTOR, self.max_target)
+            self._target_time = time.time()
+            self._buffering = True
+            self._fill = None
+            self.log('buffer underrun, rebuffering to {0:.1f} s', self._target)
+
+
+    def set_error(self, error):
+        """Raise ERROR in get() once the buffer has been emptied."""
+        with self._cond:
+            self._error = error
+            self._cond.notify_all()
+
+
+    def close(self):
+        with self._cond:
+            self._closed = True
+            self._packets.clear()
+            self._queued = 0.0
+            self._cond.notify_all()
+
+
+    def wait_closed(self, timeout):
+        """Wait up to TIMEOUT seconds for the buffer to be closed.
+
+        Returns True if it has been closed.
+        """
+        with self._cond:
+            end = time.time() + timeout
+            while not self._closed:
+                remaining = end - time.time()
+                if remaining <= 0:
+                    break
+                self._cond.wait(remaining)
+
+            return self._closed
+
+
+    def _store(self, packet):
+        """Add PACKET to the buffered packets, returning False if it
+        can't be buffered.  Called with the lock held.
+        """
+        self._packets.append(packet)
+        return True
+
+
+    def _load(self):
+        """Remove and return the first buffered packet.  Called with
+        the lock held.
+        """
+        return self._packets.popleft()
+
+
+    def _update_target(self):
+        target = max(self.JITTER_FACTOR * self._jitter, self._delay)
+        target = min(max(target, self.min_target), self.max_target)
+
+        # Raise the target at once, but only lower it when it hasn't
+        # been raised for a while.  The drift correction then slowly
+        # brings down the fill level.
+        now = time.time()
+        if target > self._target:
+            self.debug('raising buffer target to {0:.1f} s', target)
+            self._target = target
+            self._target_time = now
+
+        elif target < self._target and now - self._target_time > self.DELAY_MEMORY:
+            self.debug('lowering buffer target to {0:.1f} s', target)
+            self._target = target
+            self._target_time = now
+
+
+    def _correct_drift(self, packet):
+        if self._playing is None or time.time() - self._playing_time > self.PLAYOUT_TIMEOUT:
+            return
+
+        fill = self._received - self._playing - self._offset
+        if self._fill is None:
+            self._fill = fill
+        else:
+            self._fill += (fill - self._fill) * self.FILL_GAIN
+
+        error = (self._fill - self._target) / self._target
+        if abs(error) < self.DRIFT_THRESHOLD:
+            return
+
+        frame_size = packet.format.channels * packet.format.bytes_per_sample
+        frames = len(packet.data) // frame_size
+        count = max(1, int(frames * self.MAX_CORRECTION))
+
+        if error > 0:
+            packet.data = drop_frames(packet.data, frame_size, count)
+        else:
+            packet.data = repeat_frames(packet.data, frame_size, count)
+
+
+def packet_duration(packet):
+    """Return the duration of PACKET in seconds."""
+    f = packet.format
+    return float(len(packet.data)) / (f.channels * f.bytes_per_sample * f.rate)
+
+
+def _frame_positions(data, frame_size, count):
+    frames = len(data) // frame_size
+    return [(frames * (i + 1) // (count + 1)) * frame_size for i in range(count)]
+
+
+def drop_frames(data, frame_size, count):
+    """Return DATA with COUNT frames dropped, spread out evenly."""
+    result = bytearray()
+    start = 0
+    for pos in _frame_positions(data, frame_size, count):
+        result += data[start:pos]
+        start = pos + frame_size
+
+    result += data[start:]
+    return result
+
+
+def repeat_frames(data, frame_size, count):
+    """Return DATA with COUNT frames repeated, spread out evenly."""
+    result = bytearray()
+    start = 0
+    for pos in _frame_positions(data, frame_size, count):
+        result += data[start:pos + frame_size]
+        start = pos
+
+    result += data[start:]
+    return result
@@ -10,6 +10,8 @@ import errno
 import threading
 
 from .. import audio
+from .. import cdz
+from .. import db
 from ..source import *
 from ..state import State
 
@@ -17,6 +19,9 @@ class PCMDiscSource(Source):
     """Generate audio packets from a database disc in PCM format.
     """
 
+    # Number of blocks of compressed audio files to decode ahead
+    READ_AHEAD_BLOCKS = 2
+
     def __init__(self, player, disc, track_number, is_ripping):
         super(PCMDiscSource, self).__init__()
 
@@ -36,11 +41,10 @@ class PCMDiscSource(Source):
         else:
             self.is_ripping = None
 
-        # Construct full path to data file
-        db_id = self._player.db.disc_to_db_id(self.disc.disc_id)
-        self.path = os.path.join(
-            self._player.db.get_disc_dir(db_id),
-            self.disc.data_file_name)
+        # Set by _open_audio_file(), since the disc may be moved
+        # while it is loaded
+        self.path = None
+        self._io_stats = None
 
         self.audio_file = None
 
@@ -75,8 +79,9 @@ class PCMDiscSource(Source):
 
         while self.audio_file is None:
             try:
-                self.debug('opening file {0}', self.path)
-                self.audio_file = open(self.path, 'rb')
+                self._open_audio_file()
+            except cdz.CDZError, e:
+                raise SourceError('error opening file {0}: {1}'.format(self.path, e))
             except IOError, e:
                 if e.errno == errno.ENOENT and self.is_ripping and self.is_ripping.is_set():
                     time.sleep(1)
@@ -87,22 +92,28 @@ class PCMDiscSource(Source):
 
         # Iterate over all packets, reading data into them
 
-        for p in PCMDiscAudioPacket.iterate(self.disc, self._track_number):
+        try:
+            for p in PCMDiscAudioPacket.iterate(self.disc, self._track_number):
 
-            try:
-                self._read_data_into_packet(p)
-            except IOError, e:
-                raise SourceError('error reading from file {0}: {1}'.format(self.path, e))
+                try:
+                    self._read_data_into_packet(p)
+                except (IOError, cdz.CDZError), e:
+                    raise SourceError('error reading from file {0}: {1}'.format(self.path, e))
 
-            # Send out packet to transport
-            yield p
+                # Send out packet to transport
+                yield p
+
+                if p.flags & p.PAUSE_AFTER:
+                    # Playback will effectively stop here, so remember the track number to start
+                    # playing at again and return to signal end of stream
+                    self.debug('disc pausing after track {}, stopping for now', p.track_number + 1)
+                    self._track_number = p.track_number + 1
+                    return
 
-            if p.flags & p.PAUSE_AFTER:
-                # Playback will effectively stop here, so remember the track number to start
-                # playing at again and return to signal end of stream
-                self.debug('disc pausing after track {}, stopping for now', p.track_number + 1)
-                self._track_number = p.track_number + 1
-                return
+        finally:
+            # Stops any decoding thread of compressed files
+            self.audio_file.close()
+            self.audio_file = None
 
         # Reset this so hitting PLAY again in STOP will start from the beginning of the disc
         self._track_number = 0
@@ -159,6 +170,31 @@ class PCMDiscSource(Source):
             return self
 
 
+    def _open_audio_file(self):
+        database = self._player.db
+        db_id = database.disc_to_db_id(self.disc.disc_id)
+
+        # Since the disc was loaded another process may have moved it
+        # to a different storage root, or compressed the audio file,
+        # so get the current file from the disc info
+        try:
+            db_disc = database.get_disc_by_db_id(db_id)
+        except db.DatabaseError, e:
+            raise SourceError('error reading disc info: {0}'.format(e))
+
+        if db_disc is None:
+            db_disc = self.disc
+
+        self.path = os.path.join(database.get_disc_dir(db_id), db_disc.data_file_name)
+
+        # Count reads for the storage root the file is on
+        self._io_stats = database.get_io_stats(db_id)
+
+        self.debug('opening file {0}', self.path)
+        self.audio_file = cdz.open_audio(
+            self.path, db_disc.data_file_format, self.READ_AHEAD_BLOCKS)
+
+
     def _new_source_track(self, track):
         return PCMDiscSource(self._player, self._disc, track, self.is_ripping and self.is_ripping.is_set())
 
@@ -176,7 +212,9 @@ class PCMDiscSource(Source):
             file_pos = p.file_pos * self.disc.audio_format.bytes_per_frame
             self.audio_file.seek(file_pos)
 
+            start = time.time()
             p.data = self.audio_file.read(length)
+            self._io_stats.add_audio_read(len(p.data), time.time() - start)
             length -= len(p.data)
             file_pos += len(p.data)
 
@@ -275,7 +313,9 @@ class PCMDiscAudioPacket(audio.AudioPacket):
 
 
     def update_state(self, state):
-        pos = int(self.rel_pos / self.format.rate)
+        # Use the disc format, since the packet may have been resampled
+        rate = self.disc.audio_format.rate
+        pos = int(self.rel_pos / rate)
 
         # New track
         if (state.track != self.track_number + 1
@@ -285,7 +325,7 @@ class PCMDiscAudioPacket(audio.AudioPacket):
                          index = self.index,
                          position = pos,
                          length = int((self.track.length - self.track.pregap_offset)
-                                      / self.format.rate))
+                                      / rate))
 
         # Position changed by a whole second
         if pos != state.position:
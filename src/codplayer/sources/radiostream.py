@@ -5,8 +5,14 @@
 # Distributed under an MIT license, please see LICENSE in the top dir.
 
 import sys
-import urllib
+import io
+import errno
+import struct
+import subprocess
+import threading
+import urlparse
 import httplib
+import collections
 import socket
 import select
 import time
@@ -15,6 +21,8 @@ import mad
 
 from .. import audio
 from .. import model
+from . import jitter
+from . import timeshift
 from ..source import *
 from ..state import State
 
@@ -27,6 +35,9 @@ class RadioStreamSource(Source):
     """Output audio packets from streamed internet radio.
     """
 
+    # Restart the stream if no audio has been received for this long
+    STREAM_TIMEOUT = 10
+
     def __init__(self, player, stream):
         super(RadioStreamSource, self).__init__()
 
@@ -36,12 +47,19 @@ class RadioStreamSource(Source):
         self._player = player
         self._stations = player.cfg.radio_stations
         self._current = stream
-        self._stream = None
-        self._stalled = False
+        self._buffer = None
+        self._standby = player.radio_standby
+        self._timeshift = player.cfg.radio_timeshift_file is not None
+
+        if player.cfg.radio_decoder_process:
+            self._stream_class = DecoderProcessStream
+        else:
+            self._stream_class = HttpMpegStream
 
     @property
     def pausable(self):
-        return False
+        # Without a timeshift buffer the stream just keeps on coming
+        return self._timeshift
 
     def initial_state(self, state):
         return State(state, stream = self._current.name)
@@ -49,42 +67,33 @@ class RadioStreamSource(Source):
     def iter_packets(self):
         self.log('streaming {} from {}', self._current.name, self._current.url)
 
-        while True:
-            self._stream = HttpMpegStream(self._player, self._current.url)
-            self._stalled = False
-
-            try:
-                for p in self._stream.iter_packets():
-                    if p is None and self._stalled:
-                        raise StreamError('transport stalled')
+        # The stream is read by a separate thread into the jitter
+        # buffer, so network delays and reconnects don't hold up the
+        # transport
+        buf = self._create_buffer()
+        self._buffer = buf
 
-                    if p is not None:
-                        self._stalled = False
+        t = threading.Thread(target = self._reader_thread, name = 'radio reader',
+                             args = (buf, ))
+        t.daemon = True
+        t.start()
 
-                    yield p
-
-            except StreamError, e:
-                self.log('stream error, restarting: {}', e)
-
-                if self._stream:
-                    # Send out a second of silence to make the break less sharp
-                    if self._stream.format:
-                        p = audio.AudioPacket(self._stream.format)
-                        p.data = '\0' * (self._stream.format.channels * self._stream.format.bytes_per_sample
-                                         * self._stream.format.rate)
-                        yield p
+        while True:
+            yield buf.get(1)
 
-                    self._stream.close()
-                    self._stream = None
 
     def stopped(self):
-        if self._stream:
-            self._stream.close()
-            self._stream = None
+        if self._buffer:
+            self._buffer.close()
+            self._buffer = None
+
+        if self._standby:
+            self._standby.idle()
 
 
     def stalled(self):
-        self._stalled = True
+        if self._buffer:
+            self._buffer.underrun()
 
 
     def next_source(self, state):
@@ -103,52 +112,146 @@ class RadioStreamSource(Source):
         return RadioStreamSource(self._player, self._stations[index - 1])
 
 
+    def _create_buffer(self):
+        cfg = self._player.cfg
+
+        if self._timeshift:
+            try:
+                return timeshift.TimeshiftBuffer(
+                    self.log, self.debug,
+                    cfg.radio_buffer_min_secs, cfg.radio_buffer_max_secs,
+                    cfg.radio_timeshift_file, cfg.radio_timeshift_size_mb * 1024 * 1024)
+            except EnvironmentError, e:
+                self.log('error opening timeshift buffer {}, radio will not be pausable: {}',
+                         cfg.radio_timeshift_file, e)
+                self._timeshift = False
+
+        return jitter.JitterBuffer(self.log, self.debug,
+                                   cfg.radio_buffer_min_secs, cfg.radio_buffer_max_secs)
+
+
+    def _reader_thread(self, buf):
+        backoff = Backoff()
+        connected = False
+        stream = None
+
+        try:
+            while not buf.closed:
+                try:
+                    stream = self._open_stream()
+                    connected = True
+                except SourceError, e:
+                    if not connected:
+                        # Never got going, so give up
+                        buf.set_error(e)
+                        return
+
+                    delay = backoff.next_delay()
+                    self.log('error reconnecting, retrying in {} s: {}', delay, e)
+                    buf.wait_closed(delay)
+                    continue
+
+                try:
+                    last_packet = time.time()
+
+                    for p in stream.iter_packets():
+                        if buf.closed:
+                            return
+
+                        if p is None:
+                            if time.time() - last_packet > self.STREAM_TIMEOUT:
+                                raise StreamError('no data for {} s'.format(self.STREAM_TIMEOUT))
+                        else:
+                            last_packet = time.time()
+                            backoff.reset()
+                            buf.put(p)
+
+                except StreamError, e:
+                    self.log('stream error, restarting: {}', e)
+
+                    stream.close()
+                    stream = None
+
+                    buf.wait_closed(backoff.next_delay())
+
+        finally:
+            if stream:
+                stream.close()
+
+
+    def _open_stream(self):
+        if not self._standby:
+            return self._stream_class(self._player, self._current.url)
+
+        connection = self._standby.take(self._current)
+        self._standby.prepare(self._adjacent_stations())
+
+        if connection:
+            self.debug('using standby connection to {}', self._current.url)
+            try:
+                return HttpMpegStream(self._player, self._current.url, connection)
+            except SourceError, e:
+                self.log('standby connection failed, reconnecting: {}', e)
+
+        return HttpMpegStream(self._player, self._current.url)
+
+
+    def _adjacent_stations(self):
+        if len(self._stations) < 2:
+            return []
+
+        index = self._stations.index(self._current)
+        stations = [self._stations[(index + 1) % len(self._stations)],
+                    self._stations[index - 1]]
+
+        return [s for i, s in enumerate(stations)
+                if s is not self._current and s not in stations[:i]]
+
+
+class Backoff(object):
+    """Exponential backoff for reconnection attempts.  The first
+    attempt is immediate, and the delay then doubles from INITIAL up
+    to MAXIMUM seconds until reset() is called.
+    """
+
+    def __init__(self, initial = 1, maximum = 30):
+        self.initial = initial
+        self.maximum = maximum
+        self.reset()
+
+    def reset(self):
+        self._delay = 0
+
+    def next_delay(self):
+        delay = self._delay
+        self._delay = min(max(delay * 2, self.initial), self.maximum)
+        return delay
+
+
 class HttpMpegStream(object):
     PACKETS_PER_SECOND = 10
     START_STREAMING_TIMEOUT = 15
 
-    def __init__(self, player, url):
+    def __init__(self, player, url, connection = None):
+        """Stream from URL, or use CONNECTION if it is an already
+        opened StreamConnection (e.g. from a StandbyPool).
+        """
         self.log = player.log
         self.debug = player.debug
         self._response_error = None
         self._format = None
         self._mpeg = None
-        self._connect(url)
-
-    def _connect(self, url):
-        try:
-            # TODO: there's no way to control how long to wait here.  It can potentially
-            # block forever if the socket connection is established but the server then
-            # doesn't respond to the request (unlikely, but not good)
-            r = urllib.urlopen(url)
-        except (httplib.HTTPException, IOError) as e:
-            raise SourceError('stream error: {}'.format(e))
+        self._connection = None
+        self._connect(url, connection)
 
-        headers = r.info()
-        self.debug('response headers: {}', headers)
+    def _connect(self, url, connection):
+        if connection is None:
+            connection = StreamConnection(self.log, self.debug, url)
 
-        if r.getcode() != 200:
-            raise SourceError('stream error: HTTP response code {}'.format(r.getcode()))
-
-        content_type = headers.get('content-type')
-        if content_type != 'audio/mpeg':
-            raise SourceError('unsupported stream type: {}'.format(content_type))
-
-        transfer_encoding = headers.get('transfer-encoding')
-        if transfer_encoding:
-            raise SourceError('unsupported transfer encoding: {}'.format(transfer_encoding))
-
-        content_encoding = headers.get('content-encoding')
-        if transfer_encoding:
-            raise SourceError('unsupported content encoding: {}'.format(content_encoding))
-
-        # Take over the socket to do raw streaming ourselves, so the request object
-        # can be closed
-        self._socket = socket.fromfd(r.fileno(), socket.AF_INET, socket.SOCK_STREAM)
-        r.close()
+        self._connection = connection
 
         self._poll = select.poll()
-        self._poll.register(self._socket, select.POLLIN)
+        self._poll.register(connection.socket, select.POLLIN)
 
         try:
             mf = mad.MadFile(self)
@@ -170,10 +273,28 @@ class HttpMpegStream(object):
         packet_size = (self._format.channels * self._format.bytes_per_sample
                        * self._format.rate) / self.PACKETS_PER_SECOND
 
+        # Decoded data that didn't fit into the previous packet, and
+        # the offset of the first unused byte in it
+        pending = None
+        pending_pos = 0
+
         while True:
-            data = ''
-            while len(data) < packet_size:
-                assert self._socket is not None
+            # Decode straight into a packet buffer of the final size,
+            # to avoid building the packet by string concatenation
+            data = bytearray(packet_size)
+            view = memoryview(data)
+            filled = 0
+
+            if pending is not None:
+                length = min(len(pending) - pending_pos, packet_size)
+                view[:length] = buffer(pending, pending_pos, length)
+                filled = length
+                pending_pos += length
+                if pending_pos >= len(pending):
+                    pending = None
+
+            while filled < packet_size:
+                assert self._connection is not None
 
                 try:
                     d = self._mpeg.read()
@@ -187,9 +308,21 @@ class HttpMpegStream(object):
                     # Timeout, return whatever we've got so far
                     break
 
-                data += str(d)
+                length = min(len(d), packet_size - filled)
+                view[filled:filled + length] = buffer(d, 0, length)
+                filled += length
+
+                if length < len(d):
+                    pending = d
+                    pending_pos = length
+
+            # The view must be released before the buffer can be resized
+            del view
+
+            if filled:
+                if filled < packet_size:
+                    del data[filled:]
 
-            if data:
                 p = audio.AudioPacket(self._format)
                 p.data = data
                 yield p
@@ -200,9 +333,9 @@ class HttpMpegStream(object):
 
     def close(self):
         self._poll = None
-        if self._socket:
-            self._socket.close()
-            self._socket = None
+        if self._connection:
+            self._connection.close()
+            self._connection = None
 
 
     def read(self, length):
@@ -214,15 +347,24 @@ class HttpMpegStream(object):
         try:
             timeout = time.time() + self.START_STREAMING_TIMEOUT
 
-            data = ''
-            while len(data) < length:
-                for fd, event in self._poll.poll(1000):
-                    if fd == self._socket.fileno() and event & select.POLLIN:
-                        d = self._socket.recv(length - len(data))
-                        if d:
-                            data += d
-                        else:
-                            self._response_error = 'stream closed by server'
+            # Collect the chunks returned by the socket and join them
+            # once, instead of concatenating them one by one
+            chunks = []
+            received = 0
+
+            while received < length:
+                # Data received by a standby connection comes first
+                d = self._connection.read_backlog(length - received)
+                if not d:
+                    for fd, event in self._poll.poll(1000):
+                        if fd == self._connection.socket.fileno() and event & select.POLLIN:
+                            d = self._connection.socket.recv(length - received)
+                            if not d:
+                                self._response_error = 'stream closed by server'
+
+                if d:
+                    chunks.append(d)
+                    received += len(d)
 
                 if self._mpeg is not None:
                     # Once the mpeg file header has been read and we're streaming
@@ -234,9 +376,597 @@ class HttpMpegStream(object):
                     self._response_error = 'timeout waiting for stream to start'
                     return ''
 
-            return data
+            # When streaming this is usually a single chunk, which
+            # join() returns as it is without copying it
+            return ''.join(chunks)
 
         except Exception as e:
             self._response_error = e
             return ''
 
+
+
+class _HTTP10Connection(httplib.HTTPConnection):
+    # Streaming servers may use chunked encoding for HTTP/1.1 clients
+    _http_vsn = 10
+    _http_vsn_str = 'HTTP/1.0'
+
+
+class StreamConnection(object):
+    """An HTTP connection to a stream, opened up to the start of the
+    response body.  Connecting and waiting for the response is limited
+    by CONNECT_TIMEOUT and RESPONSE_TIMEOUT, and redirects are
+    followed.
+
+    Raises SourceError if the stream can't be opened.
+    """
+
+    CONNECT_TIMEOUT = 5
+    RESPONSE_TIMEOUT = 10
+    MAX_REDIRECTS = 5
+
+    # Keep this much data received while waiting on standby, so the
+    # decoder can start on it immediately
+    BACKLOG_SIZE = 64 * 1024
+
+    def __init__(self, log, debug, url):
+        self.log = log
+        self.debug = debug
+        self.url = url
+        self.socket = None
+
+        self._backlog = collections.deque()
+        self._backlog_size = 0
+
+        self._open(url)
+
+
+    def _open(self, url):
+        for i in range(self.MAX_REDIRECTS + 1):
+            parts = urlparse.urlsplit(url)
+            if parts.scheme != 'http':
+                raise SourceError('unsupported stream URL: {}'.format(url))
+
+            path = parts.path or '/'
+            if parts.query:
+                path += '?' + parts.query
+
+            conn = _HTTP10Connection(parts.hostname, parts.port, timeout = self.CONNECT_TIMEOUT)
+
+            try:
+                conn.connect()
+                conn.sock.settimeout(self.RESPONSE_TIMEOUT)
+                conn.request('GET', path)
+                r = conn.getresponse()
+            except (httplib.HTTPException, socket.error) as e:
+                conn.close()
+                raise SourceError('stream error: {}'.format(e))
+
+            if r.status in (301, 302, 303, 307, 308):
+                location = r.getheader('location')
+                conn.close()
+
+                if not location:
+                    raise SourceError('stream error: redirect without location')
+
+                url = urlparse.urljoin(url, location)
+                self.debug('redirected to {}', url)
+                continue
+
+            break
+
+        else:
+            raise SourceError('stream error: too many redirects')
+
+        self.debug('response headers: {}', r.msg)
+
+        if r.status != 200:
+            conn.close()
+            raise SourceError('stream error: HTTP response code {}'.format(r.status))
+
+        content_type = r.getheader('content-type')
+        if content_type != 'audio/mpeg':
+            conn.close()
+            raise SourceError('unsupported stream type: {}'.format(content_type))
+
+        transfer_encoding = r.getheader('transfer-encoding')
+        if transfer_encoding:
+            conn.close()
+            raise SourceError('unsupported transfer encoding: {}'.format(transfer_encoding))
+
+        content_encoding = r.getheader('content-encoding')
+        if content_encoding:
+            conn.close()
+            raise SourceError('unsupported content encoding: {}'.format(content_encoding))
+
+        # Take over the socket to do raw streaming ourselves, so the
+        # response can be closed.  The response reads the headers
+        # unbuffered, so no body data has been consumed yet.
+        self.socket = socket.fromfd(r.fileno(), socket.AF_INET, socket.SOCK_STREAM)
+        r.close()
+        conn.close()
+
+
+    def fileno(self):
+        return self.socket.fileno()
+
+
+    def fill_backlog(self):
+        """Receive data waiting on the socket into the backlog,
+        dropping the oldest data if it grows beyond BACKLOG_SIZE.
+
+        Returns False if the server has closed the connection.
+        """
+        data = self.socket.recv(16384)
+        if not data:
+            return False
+
+        self._backlog.append(data)
+        self._backlog_size += len(data)
+
+        while self._backlog_size - len(self._backlog[0]) >= self.BACKLOG_SIZE:
+            self._backlog_size -= len(self._backlog.popleft())
+
+        return True
+
+
+    def read_backlog(self, length):
+        """Return the next chunk of the backlog, at most LENGTH bytes,
+        or an empty string if the backlog is empty.
+        """
+        if not self._backlog:
+            return ''
+
+        d = self._backlog.popleft()
+        if len(d) > length:
+            self._backlog.appendleft(d[length:])
+            d = d[:length]
+
+        self._backlog_size -= len(d)
+        return d
+
+
+    def close(self):
+        if self.socket:
+            self.socket.close()
+            self.socket = None
+
+        self._backlog.clear()
+        self._backlog_size = 0
+
+
+class StandbyPool(object):
+    """Keep connections open to the stations adjacent to the playing
+    one, so next/prev can switch stations without waiting for a new
+    connection and the decoder can start on already received data.
+
+    A background thread opens the connections, retrying with
+    exponential backoff, and keeps reading from them so the servers
+    don't drop them.  The connections are closed after IDLE_TIMEOUT
+    seconds without any radio stream playing.
+    """
+
+    IDLE_TIMEOUT = 30
+
+    def __init__(self, player):
+        self.log = player.log
+        self.debug = player.debug
+
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._wanted = []
+        self._connections = {}
+        self._retries = {}
+        self._idle_since = None
+        self._closed = False
+
+        self._thread = threading.Thread(target = self._run, name = 'radio standby')
+        self._thread.daemon = True
+        self._thread.start()
+
+
+    def prepare(self, stations):
+        """Open standby connections to STATIONS, closing any others."""
+        with self._lock:
+            self._wanted = list(stations)
+            self._idle_since = None
+        self._wakeup.set()
+
+
+    def take(self, station):
+        """Return the StreamConnection to STATION, or None if there isn't
+        one ready.  The caller takes over the connection.
+        """
+        with self._lock:
+            return self._connections.pop(station.url, None)
+
+
+    def idle(self):
+        """Called when a radio stream stops playing."""
+        with self._lock:
+            self._idle_since = time.time()
+        self._wakeup.set()
+
+
+    def close(self):
+        with self._lock:
+            self._closed = True
+        self._wakeup.set()
+        self._thread.join()
+
+
+    def _run(self):
+        while True:
+            with self._lock:
+                if self._closed:
+                    break
+
+                if self._idle_since and time.time() - self._idle_since > self.IDLE_TIMEOUT:
+                    self.debug('radio standby idle, closing connections')
+                    self._wanted = []
+                    self._idle_since = None
+
+                wanted = [s.url for s in self._wanted]
+
+            self._close_unwanted(wanted)
+            self._open_wanted(wanted)
+
+            # Only read from the connections that are still open
+            with self._lock:
+                connections = self._connections.values()
+
+            if connections:
+                self._read(connections)
+            else:
+                self._wakeup.wait(1)
+
+            self._wakeup.clear()
+
+        with self._lock:
+            connections = self._connections.values()
+            self._connections = {}
+
+        for c in connections:
+            c.close()
+
+
+    def _close_unwanted(self, wanted):
+        with self._lock:
+            for url in self._connections.keys():
+                if url not in wanted:
+                    self.debug('closing standby connection to {}', url)
+                    self._connections.pop(url).close()
+
+            for url in self._retries.keys():
+                if url not in wanted:
+                    del self._retries[url]
+
+
+    def _open_wanted(self, wanted):
+        for url in wanted:
+            with self._lock:
+                if url in self._connections:
+                    continue
+
+                backoff, next_attempt = self._retries.get(url, (None, 0))
+                if time.time() < next_attempt:
+                    continue
+
+            try:
+                c = StreamConnection(self.log, self.debug, url)
+            except SourceError, e:
+                if backoff is None:
+                    backoff = Backoff()
+                    backoff.next_delay()
+
+                delay = backoff.next_delay()
+                self.log('error opening standby connection to {}, retrying in {} s: {}',
+                         url, delay, e)
+
+                with self._lock:
+                    self._retries[url] = (backoff, time.time() + delay)
+
+                continue
+
+            self.debug('opened standby connection to {}', url)
+
+            with self._lock:
+                self._retries.pop(url, None)
+                if url in self._connections or self._closed:
+                    c.close()
+                else:
+                    self._connections[url] = c
+
+
+    def _read(self, connections):
+        poll = select.poll()
+        by_fd = {}
+        for c in connections:
+            # Taken and closed by a source since the snapshot
+            if c.socket is None:
+                continue
+            poll.register(c.socket, select.POLLIN)
+            by_fd[c.fileno()] = c
+
+        for fd, event in poll.poll(500):
+            c = by_fd[fd]
+
+            with self._lock:
+                # Leave it alone if it has been taken in the meantime
+                if self._connections.get(c.url) is not c:
+                    continue
+
+                try:
+                    ok = c.fill_backlog()
+                except socket.error, e:
+                    self.log('standby connection to {} failed: {}', c.url, e)
+                    ok = False
+                else:
+                    if not ok:
+                        self.log('standby connection to {} closed by server', c.url)
+
+                if not ok:
+                    del self._connections[c.url]
+                    c.close()
+
+
+#
+# Out-of-process decoding
+#
+# The decoder process runs HttpMpegStream and writes records to
+# stdout, each consisting of RECORD_HEADER (type and payload length)
+# followed by the payload.  Log messages are written to stderr, one
+# per line prefixed by the log level.
+#
+
+RECORD_HEADER = struct.Struct('!cI')
+FORMAT_RECORD = struct.Struct('!IIIB')
+
+RECORD_FORMAT = 'F'
+RECORD_DATA = 'D'
+RECORD_IDLE = 'N'
+RECORD_ERROR = 'E'
+
+
+class DecoderProcessStream(object):
+    """Decode a stream in a separate process, so the decoding doesn't
+    hold the GIL against the sink thread and the IO loop.
+
+    Has the same interface as HttpMpegStream.  If the decoder process
+    crashes or stops responding it is killed and a StreamError is
+    raised, so RadioStreamSource restarts it.
+    """
+
+    DECODER_TIMEOUT = 15
+
+    def __init__(self, player, url):
+        self.log = player.log
+        self.debug = player.debug
+        self._format = None
+        self._process = None
+        self._pipe = None
+        self._poll = None
+        self._start(url)
+
+    def _start(self, url):
+        try:
+            self._process = subprocess.Popen(
+                [sys.executable, '-m', __name__, url],
+                stdout = subprocess.PIPE,
+                stderr = subprocess.PIPE,
+                close_fds = True)
+        except OSError as e:
+            raise SourceError('error starting radio decoder: {}'.format(e))
+
+        self.debug('started radio decoder pid {}', self._process.pid)
+
+        # Unbuffered reads straight into the packet buffers
+        self._pipe = io.open(self._process.stdout.fileno(), 'rb', buffering = 0, closefd = False)
+        self._poll = select.poll()
+        self._poll.register(self._pipe, select.POLLIN)
+
+        t = threading.Thread(target = self._log_thread, name = 'radio decoder log',
+                             args = (self._process.stderr, ))
+        t.daemon = True
+        t.start()
+
+        try:
+            record = self._read_record(HttpMpegStream.START_STREAMING_TIMEOUT + 5)
+            if record is None:
+                raise StreamError('timeout waiting for stream to start')
+        except StreamError as e:
+            self.close()
+            raise SourceError(str(e))
+
+        rtype, data = record
+        if rtype == RECORD_FORMAT:
+            rate, channels, bytes_per_sample, big_endian = FORMAT_RECORD.unpack(bytes(data))
+            self._format = model.Format(rate = rate, channels = channels,
+                                        bytes_per_sample = bytes_per_sample,
+                                        big_endian = bool(big_endian))
+        elif rtype == RECORD_ERROR:
+            self.close()
+            raise SourceError(str(data))
+        else:
+            self.close()
+            raise SourceError('unexpected record from radio decoder: {!r}'.format(rtype))
+
+
+    @property
+    def format(self):
+        return self._format
+
+
+    def iter_packets(self):
+        last_record = time.time()
+
+        while True:
+            assert self._process is not None
+
+            record = self._read_record(1)
+            if record is None:
+                if time.time() - last_record > self.DECODER_TIMEOUT:
+                    raise StreamError('radio decoder not responding')
+
+                yield None
+                continue
+
+            last_record = time.time()
+            rtype, data = record
+
+            if rtype == RECORD_DATA:
+                p = audio.AudioPacket(self._format)
+                p.data = data
+                yield p
+
+            elif rtype == RECORD_IDLE:
+                # Just give transport control
+                yield None
+
+            elif rtype == RECORD_ERROR:
+                raise StreamError(str(data))
+
+            else:
+                raise StreamError('unexpected record from radio decoder: {!r}'.format(rtype))
+
+
+    def close(self):
+        self._poll = None
+
+        if self._pipe:
+            self._pipe.close()
+            self._pipe = None
+
+        if self._process:
+            p = self._process
+            self._process = None
+
+            if p.poll() is None:
+                p.terminate()
+
+                # Give it a second to exit cleanly
+                for i in range(10):
+                    time.sleep(0.1)
+                    if p.poll() is not None:
+                        break
+                else:
+                    self.log('radio decoder pid {} not exiting, killing it', p.pid)
+                    p.kill()
+
+            p.wait()
+            p.stdout.close()
+            self.debug('radio decoder pid {} exited with status {}', p.pid, p.returncode)
+
+
+    def _read_record(self, timeout):
+        """Return the next (type, payload) record from the decoder, or
+        None if nothing arrived within TIMEOUT seconds.
+        """
+        if not self._poll.poll(timeout * 1000):
+            return None
+
+        rtype, length = RECORD_HEADER.unpack(bytes(self._read_exact(RECORD_HEADER.size)))
+        return rtype, self._read_exact(length)
+
+
+    def _read_exact(self, length):
+        data = bytearray(length)
+        view = memoryview(data)
+        received = 0
+
+        while received < length:
+            if not self._poll.poll(self.DECODER_TIMEOUT * 1000):
+                raise StreamError('timeout reading from radio decoder')
+
+            n = self._pipe.readinto(view[received:])
+            if not n:
+                self._process.wait()
+                raise StreamError('radio decoder exited with status {}'.format(
+                    self._process.returncode))
+
+            received += n
+
+        del view
+        return data
+
+
+    def _log_thread(self, stderr):
+        for line in iter(stderr.readline, ''):
+            line = line.rstrip('\n')
+            if line.startswith('D '):
+                self.debug('radio decoder: {}', line[2:])
+            elif line.startswith('L '):
+                self.log('radio decoder: {}', line[2:])
+            else:
+                # Probably a traceback
+                self.log('radio decoder: {}', line)
+
+        stderr.close()
+
+
+class DecoderLog(object):
+    """Logger for HttpMpegStream when running in the decoder process."""
+
+    def __init__(self, output):
+        self._output = output
+
+    def log(self, msg, *args, **kwargs):
+        self._write('L', msg, args, kwargs)
+
+    def debug(self, msg, *args, **kwargs):
+        self._write('D', msg, args, kwargs)
+
+    def _write(self, level, msg, args, kwargs):
+        msg = msg.format(*args, **kwargs).replace('\n', ' ')
+        self._output.write('{} {}\n'.format(level, msg))
+        self._output.flush()
+
+
+def decoder_main(args):
+    """Run the decoder process for the stream URL in args."""
+
+    if len(args) != 2:
+        sys.exit('usage: python -m {} URL'.format(__name__))
+
+    out = sys.stdout
+    log = DecoderLog(sys.stderr)
+
+    def write_record(rtype, data):
+        out.write(RECORD_HEADER.pack(rtype, len(data)))
+        out.write(data)
+        out.flush()
+
+    try:
+        try:
+            stream = HttpMpegStream(log, args[1])
+        except SourceError as e:
+            write_record(RECORD_ERROR, str(e))
+            return 1
+
+        f = stream.format
+        write_record(RECORD_FORMAT, FORMAT_RECORD.pack(
+            f.rate, f.channels, f.bytes_per_sample, f.big_endian))
+
+        try:
+            for p in stream.iter_packets():
+                if p is None:
+                    write_record(RECORD_IDLE, '')
+                else:
+                    write_record(RECORD_DATA, p.data)
+
+        except StreamError as e:
+            write_record(RECORD_ERROR, str(e))
+            return 1
+
+        finally:
+            stream.close()
+
+    except IOError as e:
+        if e.errno == errno.EPIPE:
+            # The player has closed the pipe, just quit
+            return 0
+        raise
+
+
+if __name__ == '__main__':
+    sys.exit(decoder_main(sys.argv))
@@ -0,0 +1,137 @@
+# codplayer - timeshift buffer for radio streams
+#
+# Copyright 2018 Peter Liljenberg <peter.liljenberg@gmail.com>
+#
+# Distributed under an MIT license, please see LICENSE in the top dir.
+
+"""
+Record a radio stream into a ring buffer on disk while it plays, so
+that it can be paused and resumed from the recorded audio.
+
+The ring buffer is a fixed-size file that is allocated once and then
+reused, mapped into memory.  This avoids fragmenting SD cards by
+growing and truncating files.
+"""
+
+import os
+import mmap
+
+from . import jitter
+
+
+class RingFile(object):
+    """A file of SIZE bytes at PATH mapped into memory, read and
+    written as a ring buffer.
+    """
+
+    # Write this much at a time when allocating the file
+    ALLOCATE_CHUNK = 1024 * 1024
+
+    def __init__(self, path, size):
+        self.path = path
+        self.size = size
+        self._map = None
+
+        fd = os.open(path, os.O_RDWR | os.O_CREAT, 0600)
+        try:
+            if os.fstat(fd).st_size != size:
+                self._allocate(fd, size)
+
+            self._map = mmap.mmap(fd, size)
+        finally:
+            os.close(fd)
+
+
+    def _allocate(self, fd, size):
+        # Write out the whole file, rather than just truncating it to
+        # the right size, to get the blocks allocated up front
+        os.ftruncate(fd, 0)
+
+        chunk = '\0' * self.ALLOCATE_CHUNK
+        remaining = size
+        while remaining > 0:
+            remaining -= os.write(fd, chunk[:remaining])
+
+        os.fsync(fd)
+
+
+    def write(self, offset, data):
+        """Write DATA at OFFSET, wrapping around at the end of the file."""
+        first = min(len(data), self.size - offset)
+        self._map[offset:offset + first] = bytes(data[:first])
+        if first < len(data):
+            self._map[:len(data) - first] = bytes(data[first:])
+
+
+    def read(self, offset, length):
+        """Return LENGTH bytes from OFFSET, wrapping around at the end
+        of the file.
+        """
+        first = min(length, self.size - offset)
+        data = bytearray(self._map[offset:offset + first])
+        if first < length:
+            data += self._map[:length - first]
+        return data
+
+
+    def close(self):
+        if self._map:
+            self._map.close()
+            self._map = None
+
+
+class TimeshiftBuffer(jitter.JitterBuffer):
+    """A JitterBuffer keeping the buffered audio in a RingFile instead
+    of in memory.  This allows the buffer to hold the stream received
+    while playback is paused.  If the ring fills up the oldest audio
+    is dropped.
+    """
+
+    def __init__(self, log, debug, min_target, max_target, path, size):
+        super(TimeshiftBuffer, self).__init__(log, debug, min_target, max_target)
+
+        self._ring = RingFile(path, size)
+
+        # Absolute byte positions, wrapped when accessing the ring
+        self._write_pos = 0
+        self._overflowing = False
+
+
+    def close(self):
+        with self._cond:
+            super(TimeshiftBuffer, self).close()
+            self._ring.close()
+
+
+    def _store(self, packet):
+        length = len(packet.data)
+        if length > self._ring.size:
+            self.log('dropping {0} byte packet, larger than the timeshift buffer', length)
+            return False
+
+        # Make room by dropping the oldest packets
+        dropped = False
+        while (self._packets and
+               self._write_pos + length - self._packets[0].ring_pos > self._ring.size):
+            old = self._packets.popleft()
+            self._queued -= old.duration
+            dropped = True
+
+        if dropped and not self._overflowing:
+            self.log('timeshift buffer full, dropping oldest audio')
+        self._overflowing = dropped
+
+        self._ring.write(self._write_pos % self._ring.size, packet.data)
+        packet.ring_pos = self._write_pos
+        packet.ring_length = length
+        packet.data = None
+
+        self._write_pos += length
+        self._packets.append(packet)
+        return True
+
+
+    def _load(self):
+        packet = self._packets.popleft()
+        packet.data = self._ring.read(packet.ring_pos % self._ring.size, packet.ring_length)
+        return packet
@@ -0,0 +1,197 @@
+# codplayer - test the cdz module
+#
+# Copyright 2018 Peter Liljenberg <peter.liljenberg@gmail.com>
+#
+# Distributed under an MIT license, please see LICENSE in the top dir.
+
+import unittest
+import os
+import math
+import random
+import struct
+import tempfile
+
+from .. import model
+from .. import cdz
+from .. import verify
+from .test_db import TestDisc, DB_ID
+
+TOC = """
+TRACK AUDIO
+TWO_CHANNEL_AUDIO
+FILE "data.cdr" 0 00:01:00
+
+TRACK AUDIO
+TWO_CHANNEL_AUDIO
+FILE "data.cdr" 00:01:00 00:02:10
+"""
+
+
+def make_audio(frames, noise = 100):
+    # Some tones with a bit of noise, to be somewhat like music
+    r = random.Random(frames)
+    samples = []
+    for i in xrange(frames):
+        left = int(8000 * math.sin(i * 0.0627) + 3000 * math.sin(i * 0.17)
+                   + r.randint(-noise, noise))
+        right = int(0.7 * left + r.randint(-noise, noise))
+        samples.append(struct.pack('>hh', left, right))
+    return ''.join(samples)
+
+
+@unittest.skipIf(cdz.numpy is None, 'numpy not installed')
+class TestBlocks(unittest.TestCase):
+    def test_round_trip(self):
+        data = make_audio(5000)
+        block = cdz.encode_block(data)
+        self.assertEqual(block[0], chr(cdz.MODE_RICE))
+        self.assertLess(len(block), len(data) * 0.7)
+        self.assertEqual(cdz.decode_block(block, 5000), data)
+
+    def test_extremes(self):
+        data = struct.pack('>4h', 32767, -32768, -32768, 32767) * 300
+        self.assertEqual(cdz.decode_block(cdz.encode_block(data), 600), data)
+
+        data = '\0' * 4000
+        self.assertEqual(cdz.decode_block(cdz.encode_block(data), 1000), data)
+
+    def test_noise_stored_raw(self):
+        r = random.Random(1)
+        data = ''.join(chr(r.randint(0, 255)) for i in xrange(4000))
+        block = cdz.encode_block(data)
+        self.assertEqual(block, chr(cdz.MODE_RAW) + data)
+        self.assertEqual(cdz.decode_block(block, 1000), data)
+
+    def test_corrupt_block(self):
+        block = cdz.encode_block(make_audio(1000))
+        with self.assertRaises(cdz.CDZError):
+            cdz.decode_block(block[:len(block) // 2], 1000)
+        with self.assertRaises(cdz.CDZError):
+            cdz.decode_block(block + 'x', 1000)
+        with self.assertRaises(cdz.CDZError):
+            cdz.decode_block('\x07' + block[1:], 1000)
+
+
+@unittest.skipIf(cdz.numpy is None, 'numpy not installed')
+class TestFile(unittest.TestCase):
+    def setUp(self):
+        self.data = make_audio(10000)
+        fd, self.raw_path = tempfile.mkstemp(suffix = '.cdr')
+        with os.fdopen(fd, 'wb') as f:
+            f.write(self.data)
+        self.path = self.raw_path[:-4] + '.cdz'
+
+    def tearDown(self):
+        os.remove(self.raw_path)
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+    def test_read(self):
+        cdz.compress_file(self.raw_path, self.path, block_frames = 1024)
+        self.assertEqual(cdz.get_audio_size(self.path, model.COMPRESSED_CD), len(self.data))
+
+        for read_ahead in (0, 3):
+            with cdz.CDZFile(self.path, read_ahead) as f:
+                self.assertEqual(f.header.num_blocks, 10)
+                self.assertEqual(f.read(len(self.data) + 100), self.data)
+                self.assertEqual(f.read(100), '')
+
+                # Seek across block boundaries
+                for pos in (0, 4095, 4096, 20000, 39996):
+                    f.seek(pos)
+                    self.assertEqual(f.read(5000), self.data[pos:pos + 5000])
+                    self.assertEqual(f.tell(), min(pos + 5000, len(self.data)))
+
+                # Sequential reads in player-sized pieces
+                f.seek(0)
+                parts = []
+                while True:
+                    d = f.read(588 * 4)
+                    if not d:
+                        break
+                    parts.append(d)
+                self.assertEqual(''.join(parts), self.data)
+
+    def test_bad_file(self):
+        with open(self.path, 'wb') as f:
+            f.write('CODX' + '\0' * 100)
+
+        with self.assertRaises(cdz.CDZError):
+            cdz.CDZFile(self.path)
+
+        cdz.compress_file(self.raw_path, self.path, block_frames = 1024)
+        with open(self.path, 'r+b') as f:
+            f.truncate(os.stat(self.path).st_size - 10)
+
+        with cdz.CDZFile(self.path, 2) as f:
+            self.assertEqual(f.read(4096), self.data[:4096])
+            f.seek(len(self.data) - 10)
+            with self.assertRaises(cdz.CDZError):
+                f.read(10)
+
+
+@unittest.skipIf(cdz.numpy is None, 'numpy not installed')
+class TestCompressDisc(TestDisc, unittest.TestCase):
+    TOC = TOC
+
+    def setUpDisc(self, disc):
+        disc.data_file_name = self.db.get_audio_file(DB_ID)
+        disc.rip = True
+
+    def setUp(self):
+        super(TestCompressDisc, self).setUp()
+        self.db.MOVE_QUIET_SECS = 0
+
+    def make_disc_audio(self, size):
+        # Something that compresses like music
+        return make_audio(size // 4)
+
+
+    def test_compress(self):
+        result = cdz.compress_disc(self.db, DB_ID)
+        self.assertIsNone(result.error)
+        self.assertIsNone(result.skipped)
+        self.assertEqual(result.raw_size, len(self.audio))
+        self.assertLess(result.compressed_size, len(self.audio))
+
+        self.assertFalse(os.path.exists(self.db.get_audio_path(DB_ID)))
+
+        disc = self.db.get_disc_by_db_id(DB_ID)
+        self.assertIs(disc.data_file_format, model.COMPRESSED_CD)
+        self.assertEqual(disc.data_file_name, self.db.get_compressed_audio_file(DB_ID))
+
+        path = self.db.get_disc_audio_path(DB_ID, disc)
+        with cdz.open_audio(path, disc.data_file_format) as f:
+            self.assertEqual(f.read(len(self.audio)), self.audio)
+
+        # The verifier reads compressed files too
+        result = verify.verify_disc(self.db, DB_ID)
+        self.assertEqual(result.problems, [])
+
+        result = cdz.compress_disc(self.db, DB_ID)
+        self.assertEqual(result.skipped, 'already compressed')
+
+
+    def test_skip_unfinished(self):
+        self.disc.rip = False
+        self.db.save_disc_info(self.disc)
+
+        result = cdz.compress_disc(self.db, DB_ID)
+        self.assertEqual(result.skipped, 'not fully ripped')
+
+        self.disc.rip = True
+        self.db.save_disc_info(self.disc)
+        self.db.MOVE_QUIET_SECS = 3600
+
+        result = cdz.compress_disc(self.db, DB_ID)
+        self.assertEqual(result.skipped, 'changed recently')
+        self.assertTrue(os.path.exists(self.db.get_audio_path(DB_ID)))
+
+
+    def test_truncated_raw_file(self):
+        with open(self.db.get_audio_path(DB_ID), 'r+b') as f:
+            f.truncate(len(self.audio) - 4)
+
+        result = cdz.compress_disc(self.db, DB_ID)
+        self.assertIn('expected', result.error)
+        self.assertFalse(os.path.exists(self.db.get_compressed_audio_path(DB_ID)))
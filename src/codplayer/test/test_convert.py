@@ -0,0 +1,120 @@
+# codplayer - test the format conversion
+#
+# Copyright 2018 Peter Liljenberg <peter.liljenberg@gmail.com>
+#
+# Distributed under an MIT license, please see LICENSE in the top dir.
+
+import unittest
+import array
+import math
+import sys
+
+from .. import audio
+from .. import model
+from .. import convert
+
+
+def make_packet(samples, rate, channels = 2, big_endian = False):
+    a = array.array('h', samples)
+    if big_endian != (sys.byteorder == 'big'):
+        a.byteswap()
+
+    p = audio.AudioPacket(model.Format(channels = channels, rate = rate,
+                                       big_endian = big_endian))
+    p.data = a.tostring()
+    return p
+
+
+def get_samples(packet):
+    a = array.array('h', packet.data)
+    if packet.format.big_endian != (sys.byteorder == 'big'):
+        a.byteswap()
+    return list(a)
+
+
+@unittest.skipIf(convert.numpy is None, 'numpy not installed')
+class TestFormatConverter(unittest.TestCase):
+    def test_pass_through(self):
+        c = convert.FormatConverter(44100)
+        p = make_packet([1, 2, 3, 4], 44100, big_endian = (sys.byteorder == 'big'))
+        data = p.data
+        fmt = p.format
+
+        self.assertIs(c.convert(p), p)
+        self.assertIs(p.data, data)
+        self.assertIs(p.format, fmt)
+
+    def test_byte_swap(self):
+        # CD audio and decoded radio streams have different byte
+        # orders, but must come out in the same format
+        c = convert.FormatConverter(44100)
+        p = c.convert(make_packet([1, -2, 300, 4], 44100, big_endian = (sys.byteorder != 'big')))
+
+        self.assertIs(p.format, c.format)
+        self.assertListEqual(get_samples(p), [1, -2, 300, 4])
+
+    def test_mono_to_stereo(self):
+        c = convert.FormatConverter(44100)
+        p = c.convert(make_packet([1, -2, 300], 44100, channels = 1, big_endian = True))
+
+        self.assertEqual(p.format.channels, 2)
+        self.assertEqual(p.format.rate, 44100)
+        self.assertListEqual(get_samples(p), [1, 1, -2, -2, 300, 300])
+
+    def test_upsample_across_packets(self):
+        c = convert.FormatConverter(44100)
+
+        # Doubling the rate interpolates a frame between each input frame,
+        # including between the last and first frame of two packets
+        p1 = c.convert(make_packet([0, 0, 100, -100], 22050))
+        p2 = c.convert(make_packet([200, -200, 300, -300], 22050))
+
+        self.assertIs(p1.format, c.format)
+        self.assertListEqual(get_samples(p1), [0, 0, 50, -50])
+        self.assertListEqual(get_samples(p2), [100, -100, 150, -150, 200, -200, 250, -250])
+
+    def test_downsample_length(self):
+        c = convert.FormatConverter(44100)
+
+        total = 0
+        for i in range(10):
+            p = c.convert(make_packet([i] * 4800 * 2, 48000))
+            total += len(p.data) / 4
+
+        # Ten packets of 4800 frames at 48 kHz is one second, give or
+        # take the frame held back for interpolation
+        self.assertTrue(44099 <= total <= 44100, total)
+
+    def test_reset_on_new_format(self):
+        c = convert.FormatConverter(44100)
+        c.convert(make_packet([0, 0, 100, 100], 22050))
+
+        p = c.convert(make_packet([1000, 1000, 2000, 2000], 11025))
+        self.assertListEqual(get_samples(p)[:4], [1000, 1000, 1250, 1250])
+
+    def test_downsample_filters_aliasing(self):
+        c = convert.FormatConverter(44100)
+
+        # A 23 kHz tone can't be represented at 44.1 kHz, and should
+        # be filtered out instead of aliasing to 21.1 kHz
+        samples = []
+        for i in range(4800):
+            v = int(10000 * math.sin(2 * math.pi * 23000 * i / 48000.0))
+            samples.extend((v, v))
+
+        p = c.convert(make_packet(samples, 48000))
+        out = get_samples(p)[200:]
+        rms = math.sqrt(sum(v * v for v in out) / float(len(out)))
+        self.assertLess(rms, 1000)
+
+        # While lower frequencies pass through
+        c.reset()
+        samples = []
+        for i in range(4800):
+            v = int(10000 * math.sin(2 * math.pi * 1000 * i / 48000.0))
+            samples.extend((v, v))
+
+        p = c.convert(make_packet(samples, 48000))
+        out = get_samples(p)[200:]
+        rms = math.sqrt(sum(v * v for v in out) / float(len(out)))
+        self.assertGreater(rms, 6500)
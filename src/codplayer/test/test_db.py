@@ -6,12 +6,17 @@
 
 import unittest
 import os
+import errno
 import tempfile
+import sqlite3
 
 from .. import db
+from .. import catalog
 from .. import model
 from .. import toc
 from .. import serialize
+from .. import discpack
+from .. import verify
 
 
 class TestDiscIDs(unittest.TestCase):
@@ -52,7 +57,11 @@ class TestDir(object):
         for f in os.listdir(self.test_dir):
 
             # Top dir files
-            if f in (db.Database.VERSION_FILE, ):
+            if f in (db.Database.VERSION_FILE,
+                     db.Database.CATALOG_FILE,
+                     db.Database.CATALOG_FILE + '-journal',
+                     db.Database.ROOTS_FILE,
+                     verify.MANIFEST_FILE):
                 os.remove(os.path.join(self.test_dir, f))
                 
             # Top dir subdirs
@@ -93,8 +102,10 @@ class TestDir(object):
 
             if s in (db.Database.DISC_ID_SUFFIX,
                      db.Database.AUDIO_SUFFIX,
+                     db.Database.COMPRESSED_AUDIO_SUFFIX,
                      db.Database.ORIG_TOC_SUFFIX,
                      db.Database.DISC_INFO_SUFFIX,
+                     db.Database.DISC_PACK_SUFFIX,
                      '.log',
                      ):
                 os.remove(os.path.join(d, f))
@@ -104,6 +115,72 @@ class TestDir(object):
         os.rmdir(d)
 
 
+# The disc used by TestDisc
+DISC_ID = 'uP.sebZoiZSYakZh.g3coKrme8I-'
+DB_ID = 'b8ffac79b6688994986a4661fa0ddca0aae67bc2'
+
+
+def make_audio(size):
+    """Return SIZE bytes of audio data that doesn't repeat too often."""
+    return ''.join(chr((i * 7 + i // 256) & 0xff) for i in xrange(size))
+
+
+class TestDatabase(TestDir):
+    """Mixin class to setup an empty database in the test directory,
+    available as self.db.
+    """
+
+    def setUp(self):
+        super(TestDatabase, self).setUp()
+        db.Database.init_db(self.test_dir)
+        self.db = db.Database(self.test_dir)
+
+    def tearDown(self):
+        self.db.catalog.close()
+        super(TestDatabase, self).tearDown()
+
+
+class TestDisc(TestDatabase):
+    """Mixin class to setup a database with the disc DISC_ID, parsed
+    from the class attribute TOC, as self.disc.  The disc audio file
+    self.audio_path holds self.audio.
+
+    CHUNK_FRAMES is lowered in the modules in CHUNK_MODULES during the
+    tests, so the files are read in several chunks.
+    """
+
+    TOC = None
+    CHUNK_MODULES = ()
+
+    def setUp(self):
+        super(TestDisc, self).setUp()
+
+        self.disc = toc.parse_toc(self.TOC, DISC_ID)
+        self.setUpDisc(self.disc)
+        self.db.create_disc(self.disc)
+
+        self.audio_path = self.db.get_audio_path(DB_ID)
+        self.audio = self.make_disc_audio(self.disc.get_disc_file_size_bytes())
+        with open(self.audio_path, 'wb') as f:
+            f.write(self.audio)
+
+        self.orig_chunk_frames = [(m, m.CHUNK_FRAMES) for m in self.CHUNK_MODULES]
+        for m in self.CHUNK_MODULES:
+            m.CHUNK_FRAMES = 1000
+
+    def tearDown(self):
+        for m, chunk_frames in self.orig_chunk_frames:
+            m.CHUNK_FRAMES = chunk_frames
+        super(TestDisc, self).tearDown()
+
+    def setUpDisc(self, disc):
+        """Override to change the disc before it is created."""
+        pass
+
+    def make_disc_audio(self, size):
+        return make_audio(size)
+
+
 #
 # Negative test cases on init or opening DB dir
 #
@@ -410,3 +487,698 @@ FILE "{0}.cdr" 0 02:54:53
         self.assertListEqual(new_track.index, [])
 
         
+
+
+#
+# Test the cache of parsed discs
+#
+
+class TestDiscCache(TestDir, unittest.TestCase):
+    DISC_ID = 'uP.sebZoiZSYakZh.g3coKrme8I-'
+    DB_ID = 'b8ffac79b6688994986a4661fa0ddca0aae67bc2'
+
+    def setUp(self):
+        super(TestDiscCache, self).setUp()
+        db.Database.init_db(self.test_dir)
+        self.db = db.Database(self.test_dir)
+
+        disc = toc.parse_toc("""
+TRACK AUDIO
+TWO_CHANNEL_AUDIO
+FILE "{0}.cdr" 0 02:54:53
+""".format(self.DB_ID[:8]), self.DISC_ID)
+        disc.title = u'Disc title'
+
+        self.db.create_disc(disc)
+
+
+    def test_returns_copies(self):
+        disc = self.db.get_disc_by_db_id(self.DB_ID)
+        disc.title = u'Changed'
+        disc.tracks[0].index.append(17)
+        del disc.tracks[:]
+
+        disc2 = self.db.get_disc_by_db_id(self.DB_ID)
+        self.assertIsNot(disc2, disc)
+        self.assertEqual(disc2.title, u'Disc title')
+        self.assertEqual(len(disc2.tracks), 1)
+        self.assertListEqual(disc2.tracks[0].index, [])
+
+
+    def test_invalidate_on_update(self):
+        self.db.get_disc_by_db_id(self.DB_ID)
+
+        ext_disc = serialize.load_jsono(model.ExtDisc, {
+            'disc_id': self.DISC_ID,
+            'title': u'New title',
+        })
+        self.db.update_disc(ext_disc)
+
+        disc = self.db.get_disc_by_db_id(self.DB_ID)
+        self.assertEqual(disc.title, u'New title')
+
+
+    def test_file_changed_on_disk(self):
+        disc = self.db.get_disc_by_db_id(self.DB_ID)
+
+        # Another process saving the disc
+        disc.title = u'Other title'
+        serialize.save_json(disc, self.db.get_disc_info_path(self.DB_ID))
+
+        disc2 = self.db.get_disc_by_db_id(self.DB_ID)
+        self.assertEqual(disc2.title, u'Other title')
+
+
+    def test_file_removed(self):
+        self.db.get_disc_by_db_id(self.DB_ID)
+        os.remove(self.db.get_disc_info_path(self.DB_ID))
+        self.assertIsNone(self.db.get_disc_by_db_id(self.DB_ID))
+
+
+    def test_bounded(self):
+        d = db.Database(self.test_dir, cache_size = 0)
+        d.get_disc_by_db_id(self.DB_ID)
+        self.assertEqual(len(d._disc_cache), 0)
+
+
+    def test_disc_pack(self):
+        pack_path = self.db.get_disc_pack_path(self.DB_ID)
+        info_path = self.db.get_disc_info_path(self.DB_ID)
+        self.assertTrue(os.path.exists(pack_path))
+
+        # Sneak in a different title in the pack, to see that it is
+        # used by a database without a cached copy
+        disc = self.db.get_disc_by_db_id(self.DB_ID)
+        disc.title = u'Packed title'
+        discpack.save_disc(disc, pack_path, info_path)
+
+        d = db.Database(self.test_dir)
+        self.assertEqual(d.get_disc_by_db_id(self.DB_ID).title, u'Packed title')
+
+
+    def test_disc_pack_ignored_when_changed(self):
+        pack_path = self.db.get_disc_pack_path(self.DB_ID)
+        info_path = self.db.get_disc_info_path(self.DB_ID)
+
+        disc = self.db.get_disc_by_db_id(self.DB_ID)
+        disc.title = u'Edited title'
+        serialize.save_json(disc, info_path)
+
+        d = db.Database(self.test_dir)
+        self.assertEqual(d.get_disc_by_db_id(self.DB_ID).title, u'Edited title')
+
+        # Reading doesn't write the pack, but reindexing does
+        self.assertFalse(discpack.is_current(pack_path, os.stat(info_path)))
+
+        self.assertEqual(d.reindex(), [])
+        d.catalog.close()
+
+        disc = discpack.load_disc(pack_path, os.stat(info_path))
+        self.assertEqual(disc.title, u'Edited title')
+
+
+    def test_disc_pack_broken(self):
+        with open(self.db.get_disc_pack_path(self.DB_ID), 'wb') as f:
+            f.write('garbage')
+
+        d = db.Database(self.test_dir)
+        self.assertEqual(d.get_disc_by_db_id(self.DB_ID).title, u'Disc title')
+
+
+#
+# Test the catalog index
+#
+
+class TestCatalog(TestDir, unittest.TestCase):
+    DISC_ID = 'uP.sebZoiZSYakZh.g3coKrme8I-'
+    DB_ID = 'b8ffac79b6688994986a4661fa0ddca0aae67bc2'
+
+    def setUp(self):
+        super(TestCatalog, self).setUp()
+        db.Database.init_db(self.test_dir)
+        self.db = db.Database(self.test_dir)
+
+        disc = toc.parse_toc("""
+TRACK AUDIO
+TWO_CHANNEL_AUDIO
+FILE "{0}.cdr" 0 02:54:53
+""".format(self.DB_ID[:8]), self.DISC_ID)
+        disc.artist = u'Disc artist'
+        disc.title = u'Disc title'
+
+        self.db.create_disc(disc)
+        self.assertEqual(self.db.reindex(), [])
+
+    def tearDown(self):
+        self.db.catalog.close()
+        super(TestCatalog, self).tearDown()
+
+
+    def test_list(self):
+        discs = list(self.db.iterdiscs_overviews())
+        self.assertEqual(len(discs), 1)
+
+        d = discs[0]
+        self.assertIsInstance(d, model.DiscOverview)
+        self.assertEqual(d.disc_id, self.DISC_ID)
+        self.assertEqual(d.tracks, 1)
+        self.assertEqual(d.artist, u'Disc artist')
+        self.assertEqual(d.title, u'Disc title')
+        self.assertIsNone(d.barcode)
+
+
+    def test_update(self):
+        ext_disc = serialize.load_jsono(model.ExtDisc, {
+            'disc_id': self.DISC_ID,
+            'title': u'New title',
+        })
+        self.db.update_disc(ext_disc)
+
+        discs = list(self.db.iterdiscs_overviews())
+        self.assertEqual(discs[0].title, u'New title')
+
+
+    def test_read_files_when_missing(self):
+        # Simulate an existing database without a catalog
+        self.db.catalog.close()
+        path = os.path.join(self.test_dir, db.Database.CATALOG_FILE)
+        os.remove(path)
+
+        d = db.Database(self.test_dir)
+        try:
+            self.assertFalse(d.is_catalog_complete())
+
+            discs = list(d.iterdiscs_overviews())
+            self.assertEqual([disc.disc_id for disc in discs], [self.DISC_ID])
+            self.assertEqual(discs[0].title, u'Disc title')
+
+            self.assertEqual([disc.disc_id for disc in d.search_discs(u'disc tit')],
+                             [self.DISC_ID])
+            self.assertEqual(d.search_discs(u'disc madonna'), [])
+
+            version = d.get_catalog_version()
+            self.assertIsNone(version.catalog_id)
+            self.assertIsNone(d.get_changed_discs(version.seq)[1])
+
+            # Reading doesn't build the catalog
+            self.assertFalse(os.path.exists(path))
+
+            self.assertEqual(d.reindex(), [])
+            self.assertTrue(d.is_catalog_complete())
+            self.assertIsNotNone(d.get_catalog_version().catalog_id)
+        finally:
+            d.catalog.close()
+
+
+    def test_reindex(self):
+        # Edit the file behind the database's back
+        disc = self.db.get_disc_by_db_id(self.DB_ID)
+        disc.title = u'Edited title'
+        serialize.save_json(disc, self.db.get_disc_info_path(self.DB_ID))
+
+        self.assertEqual(list(self.db.iterdiscs_overviews())[0].title, u'Disc title')
+
+        self.assertEqual(self.db.reindex(), [])
+        self.assertEqual(list(self.db.iterdiscs_overviews())[0].title, u'Edited title')
+
+
+    def test_rebuild_while_updated(self):
+        self.db.catalog.REBUILD_BATCH = 1
+        other_id = 'AAAAAAAAAAAAAAAAAAAAAAAAAAA-'
+        other_db_id = db.Database.disc_to_db_id(other_id)
+        other = toc.parse_toc("""
+TRACK AUDIO
+TWO_CHANNEL_AUDIO
+FILE "{0}.cdr" 0 02:54:53
+""".format(other_db_id[:8]), other_id)
+
+        # The discs as read before they are changed
+        discs = [(other_db_id, other), (self.DB_ID, self.db.get_disc_by_db_id(self.DB_ID))]
+
+        def iterdiscs():
+            yield discs[0]
+
+            # Another process can write while the discs are read
+            cat = catalog.Catalog(self.db.catalog.path)
+            cat.BUSY_TIMEOUT = 0
+            try:
+                disc = self.db.get_disc_by_db_id(self.DB_ID)
+                disc.title = u'New title'
+                cat.update_disc(self.DB_ID, disc)
+                cat.remove_disc(other_db_id)
+            finally:
+                cat.close()
+
+            yield discs[1]
+
+        self.db.catalog.rebuild(iterdiscs())
+
+        self.assertTrue(self.db.catalog.is_complete())
+        self.assertEqual([(d.disc_id, d.title) for d in self.db.iterdiscs_overviews()],
+                         [(self.DISC_ID, u'New title')])
+        self.assertEqual([d.disc_id for d in self.db.search_discs(u'new')], [self.DISC_ID])
+
+
+    def test_parallel_load_reports_errors(self):
+        # Add a disc that sorts first, and break it
+        broken_id = 'AAAAAAAAAAAAAAAAAAAAAAAAAAA-'
+        broken_db_id = db.Database.disc_to_db_id(broken_id)
+        self.db.create_disc(toc.parse_toc("""
+TRACK AUDIO
+TWO_CHANNEL_AUDIO
+FILE "{0}.cdr" 0 02:54:53
+""".format(broken_db_id[:8]), broken_id))
+
+        with open(self.db.get_disc_info_path(broken_db_id), 'wt') as f:
+            f.write('{ broken')
+
+        discs = list(self.db.iterdiscs_parallel(threads = 2))
+        self.assertEqual([d[0] for d in discs], [broken_db_id, self.DB_ID])
+
+        db_id, disc, error = discs[0]
+        self.assertIsNone(disc)
+        self.assertIsInstance(error, db.DatabaseError)
+
+        db_id, disc, error = discs[1]
+        self.assertEqual(disc.title, u'Disc title')
+        self.assertIsNone(error)
+
+        # The broken disc is left out of the catalog
+        errors = self.db.reindex()
+        self.assertEqual([e[0] for e in errors], [broken_db_id])
+        self.assertEqual([d.disc_id for d in self.db.iterdiscs_overviews()],
+                         [self.DISC_ID])
+
+
+    def test_search(self):
+        ext_disc = serialize.load_jsono(model.ExtDisc, {
+            'disc_id': self.DISC_ID,
+            'artist': u'Bj\xf6rk',
+            'title': u'Debut',
+            'barcode': u'075596148627',
+            'tracks': [ { 'number': 1, 'title': u'Human Behaviour' } ],
+        })
+        self.db.update_disc(ext_disc)
+
+        def search(query):
+            return [d.disc_id for d in self.db.search_discs(query)]
+
+        self.assertEqual(search(u'bjork'), [self.DISC_ID])
+        self.assertEqual(search(u'BJ\xd6RK deb'), [self.DISC_ID])
+        self.assertEqual(search(u'behav'), [self.DISC_ID])
+        self.assertEqual(search(u'0755961'), [self.DISC_ID])
+        self.assertEqual(search(u'bjork madonna'), [])
+        self.assertEqual(search(u''), [])
+
+        # Old words are removed on update
+        self.assertEqual(search(u'disc'), [])
+
+
+    def test_search_ranking(self):
+        # Add a disc where the word is only in a track title
+        other_id = 'AAAAAAAAAAAAAAAAAAAAAAAAAAA-'
+        other = toc.parse_toc("""
+TRACK AUDIO
+TWO_CHANNEL_AUDIO
+FILE "{0}.cdr" 0 02:54:53
+""".format(db.Database.disc_to_db_id(other_id)[:8]), other_id)
+        other.tracks[0].title = u'Another title'
+        self.db.create_disc(other)
+
+        discs = self.db.search_discs(u'title')
+        self.assertEqual([d.disc_id for d in discs], [self.DISC_ID, other_id])
+
+        discs = self.db.search_discs(u'title', offset = 1, limit = 5)
+        self.assertEqual([d.disc_id for d in discs], [other_id])
+
+        discs = self.db.search_discs(u'title', limit = 1)
+        self.assertEqual([d.disc_id for d in discs], [self.DISC_ID])
+
+
+    def test_changes(self):
+        version = self.db.get_catalog_version()
+
+        version2, discs = self.db.get_changed_discs(version.seq)
+        self.assertEqual(version2, version)
+        self.assertEqual(discs, [])
+
+        ext_disc = serialize.load_jsono(model.ExtDisc, {
+            'disc_id': self.DISC_ID,
+            'title': u'New title',
+        })
+        self.db.update_disc(ext_disc)
+
+        version2, discs = self.db.get_changed_discs(version.seq)
+        self.assertEqual(version2.catalog_id, version.catalog_id)
+        self.assertGreater(version2.seq, version.seq)
+        self.assertIsNotNone(version2.timestamp)
+        self.assertEqual([d.title for d in discs], [u'New title'])
+
+        # Unknown sequence numbers require a full listing
+        self.assertIsNone(self.db.get_changed_discs(version2.seq + 1)[1])
+
+        # As does anything before a reindex
+        self.db.reindex()
+        version3, discs = self.db.get_changed_discs(version2.seq)
+        self.assertGreater(version3.seq, version2.seq)
+        self.assertIsNone(discs)
+        self.assertEqual(self.db.get_changed_discs(version3.seq)[1], [])
+
+
+    def test_changes_pruned(self):
+        self.db.catalog.CHANGES_WINDOW = 2
+        version = self.db.get_catalog_version()
+
+        for i in range(3):
+            self.db.update_disc(serialize.load_jsono(model.ExtDisc, {
+                'disc_id': self.DISC_ID,
+                'title': u'Title {0}'.format(i),
+            }))
+
+        version2, discs = self.db.get_changed_discs(version.seq + 1)
+        self.assertEqual(version2.seq, version.seq + 3)
+        self.assertEqual([d.title for d in discs], [u'Title 2'])
+
+        # Changes outside the window require a full listing
+        self.assertIsNone(self.db.get_changed_discs(version.seq)[1])
+
+
+    def test_read_only(self):
+        # Build the catalog
+        version = self.db.get_catalog_version()
+        self.db.catalog.close()
+
+        path = os.path.join(self.test_dir, db.Database.CATALOG_FILE)
+
+        class ReadOnlyCatalog(catalog.Catalog):
+            def _connect(self):
+                conn = super(ReadOnlyCatalog, self)._connect()
+                conn.set_authorizer(lambda action, *args: (
+                    sqlite3.SQLITE_OK if action in (sqlite3.SQLITE_SELECT, sqlite3.SQLITE_READ)
+                    else sqlite3.SQLITE_DENY))
+                return conn
+
+        cat = ReadOnlyCatalog(path)
+        try:
+            self.assertTrue(cat.is_complete())
+            self.assertEqual(cat.get_version(), version)
+            self.assertEqual([d.disc_id for d in cat.get_overviews()], [self.DISC_ID])
+            self.assertEqual(cat.get_changes(version.seq), (version, []))
+
+            with self.assertRaises(catalog.CatalogError):
+                cat.remove_disc(self.DB_ID)
+        finally:
+            cat.close()
+
+        # A missing catalog is not created just by reading it
+        os.remove(path)
+        cat = catalog.Catalog(path)
+        self.assertFalse(cat.is_complete())
+        cat.close()
+        self.assertFalse(os.path.exists(path))
+
+
+    def test_disc_version(self):
+        v = self.db.get_disc_version(self.DB_ID)
+        self.assertIsNotNone(v)
+        self.assertIsNone(self.db.get_disc_version('0' * 40))
+
+        ext_disc = serialize.load_jsono(model.ExtDisc, {
+            'disc_id': self.DISC_ID,
+            'title': u'New title',
+        })
+        self.db.update_disc(ext_disc)
+        self.assertNotEqual(self.db.get_disc_version(self.DB_ID), v)
+
+
+    def test_change_listener(self):
+        version = self.db.get_catalog_version()
+        changes = []
+        self.db.add_change_listener(changes.append)
+
+        ext_disc = serialize.load_jsono(model.ExtDisc, {
+            'disc_id': self.DISC_ID,
+            'title': u'New title',
+        })
+        self.db.update_disc(ext_disc)
+
+        self.assertEqual(len(changes), 1)
+        self.assertIsInstance(changes[0], db.DiscChange)
+        self.assertEqual(changes[0].disc_id, self.DISC_ID)
+        self.assertEqual(changes[0].event, 'update')
+        self.assertEqual(changes[0].seq, version.seq + 1)
+
+        self.db.remove_change_listener(changes.append)
+        self.db.update_disc(ext_disc)
+        self.assertEqual(len(changes), 1)
+
+
+    def test_create_event(self):
+        changes = []
+        self.db.add_change_listener(changes.append)
+
+        other_id = 'AAAAAAAAAAAAAAAAAAAAAAAAAAA-'
+        self.db.create_disc(toc.parse_toc("""
+TRACK AUDIO
+TWO_CHANNEL_AUDIO
+FILE "{0}.cdr" 0 02:54:53
+""".format(db.Database.disc_to_db_id(other_id)[:8]), other_id))
+
+        self.assertEqual([(c.disc_id, c.event) for c in changes],
+                         [(other_id, 'create')])
+
+
+    def test_update_discs(self):
+        other_id = 'AAAAAAAAAAAAAAAAAAAAAAAAAAA-'
+        self.db.create_disc(toc.parse_toc("""
+TRACK AUDIO
+TWO_CHANNEL_AUDIO
+FILE "{0}.cdr" 0 02:54:53
+""".format(db.Database.disc_to_db_id(other_id)[:8]), other_id))
+
+        changes = []
+        self.db.add_change_listener(changes.append)
+
+        discs = self.db.update_discs([
+            serialize.load_jsono(model.ExtDisc, { 'disc_id': self.DISC_ID, 'title': u'One' }),
+            serialize.load_jsono(model.ExtDisc, { 'disc_id': other_id, 'title': u'Two' }),
+        ])
+
+        self.assertEqual([d.title for d in discs], [u'One', u'Two'])
+        self.assertEqual(self.db.get_disc_by_disc_id(self.DISC_ID).title, u'One')
+        self.assertEqual(self.db.get_disc_by_disc_id(other_id).title, u'Two')
+        self.assertEqual([c.disc_id for c in changes], [self.DISC_ID, other_id])
+
+        # Nothing is saved if any update is invalid
+        with self.assertRaises(ValueError):
+            self.db.update_discs([
+                serialize.load_jsono(model.ExtDisc, { 'disc_id': self.DISC_ID, 'title': u'Three' }),
+                serialize.load_jsono(model.ExtDisc, { 'disc_id': other_id, 'tracks': [] }),
+            ])
+
+        self.assertEqual(self.db.get_disc_by_disc_id(self.DISC_ID).title, u'One')
+        self.assertEqual(len(changes), 2)
+
+
+    def test_links(self):
+        other_id = 'AAAAAAAAAAAAAAAAAAAAAAAAAAA-'
+        self.db.create_disc(toc.parse_toc("""
+TRACK AUDIO
+TWO_CHANNEL_AUDIO
+FILE "{0}.cdr" 0 02:54:53
+""".format(db.Database.disc_to_db_id(other_id)[:8]), other_id))
+
+        self.assertEqual(self.db.resolve_alias(self.DISC_ID), ())
+
+        self.db.update_disc(serialize.load_jsono(model.ExtDisc, {
+            'disc_id': self.DISC_ID, 'link_type': 'alias', 'linked_disc_id': other_id }))
+
+        self.assertEqual(self.db.get_disc_link(self.DISC_ID), ('alias', other_id))
+        self.assertEqual(self.db.resolve_alias(self.DISC_ID), (other_id, ))
+
+        # Loops are rejected
+        with self.assertRaises(ValueError):
+            self.db.update_disc(serialize.load_jsono(model.ExtDisc, {
+                'disc_id': other_id, 'link_type': 'alias', 'linked_disc_id': self.DISC_ID }))
+
+        self.assertIsNone(self.db.get_disc_link(other_id))
+
+        # Changes by other processes are picked up from the catalog
+        other_db = db.Database(self.test_dir)
+        other_db.update_disc(serialize.load_jsono(model.ExtDisc, {
+            'disc_id': self.DISC_ID, 'link_type': 'next', 'linked_disc_id': other_id }))
+        other_db.catalog.close()
+
+        self.assertEqual(self.db.resolve_alias(self.DISC_ID), ())
+        self.assertEqual(self.db.get_disc_set(other_id), [self.DISC_ID, other_id])
+
+        # A link edited by hand is followed from the inserted disc
+        disc = self.db.get_disc_by_disc_id(self.DISC_ID)
+        disc.link_type = 'alias'
+        serialize.save_json(disc, self.db.get_disc_info_path(self.DB_ID))
+        self.assertEqual(self.db.resolve_alias(self.DISC_ID), (other_id, ))
+
+        # Without a catalog the links are followed in the files,
+        # stopping at loops
+        disc = self.db.get_disc_by_disc_id(other_id)
+        disc.link_type = 'alias'
+        disc.linked_disc_id = self.DISC_ID
+        serialize.save_json(disc, self.db.get_disc_info_path(db.Database.disc_to_db_id(other_id)))
+
+        self.db.catalog.close()
+        os.remove(os.path.join(self.test_dir, db.Database.CATALOG_FILE))
+        self.assertEqual(self.db.resolve_alias(self.DISC_ID), (other_id, ))
+        self.assertEqual(self.db.resolve_alias(other_id), (self.DISC_ID, ))
+
+
+#
+# Test databases with several storage roots
+#
+
+class TestRoots(TestDir, unittest.TestCase):
+    DISC_ID = 'uP.sebZoiZSYakZh.g3coKrme8I-'
+    DB_ID = 'b8ffac79b6688994986a4661fa0ddca0aae67bc2'
+    OTHER_ID = 'AAAAAAAAAAAAAAAAAAAAAAAAAAA-'
+
+    def setUp(self):
+        super(TestRoots, self).setUp()
+        db.Database.init_db(self.test_dir)
+        self.db = db.Database(self.test_dir)
+        self.db.MOVE_QUIET_SECS = 0
+
+        self.root_dir = tempfile.mkdtemp()
+        self.db.add_root(self.root_dir)
+
+        self.free_space = {}
+        self.orig_get_free_space = db.get_free_space
+        db.get_free_space = self.get_free_space
+
+    def get_free_space(self, path):
+        space = self.free_space.get(path, 0)
+        if space is None:
+            # Like os.statvfs() on a missing root
+            raise OSError(errno.ENOENT, 'No such file or directory', path)
+        return space
+
+    def tearDown(self):
+        db.get_free_space = self.orig_get_free_space
+        self.db.catalog.close()
+
+        # Same careful cleanup as the main dir
+        for f in os.listdir(self.root_dir):
+            if f == db.Database.VERSION_FILE:
+                os.remove(os.path.join(self.root_dir, f))
+            elif f == db.Database.DISC_DIR:
+                self.tearDownDiscTopDir(os.path.join(self.root_dir, f))
+            else:
+                self.fail('unexpected root dir entry in %s: %s' % (self.root_dir, f))
+        os.rmdir(self.root_dir)
+
+        super(TestRoots, self).tearDown()
+
+
+    def create_disc(self, disc_id):
+        disc = toc.parse_toc("""
+TRACK AUDIO
+TWO_CHANNEL_AUDIO
+FILE "{0}.cdr" 0 02:54:53
+""".format(db.Database.disc_to_db_id(disc_id)[:8]), disc_id)
+        self.db.create_disc(disc)
+
+        with open(self.db.get_audio_path(self.db.disc_to_db_id(disc_id)), 'wb') as f:
+            f.write('\0' * 1000)
+
+
+    def test_add_root(self):
+        self.assertEqual(self.db.roots, [self.test_dir, self.root_dir])
+
+        d = db.Database(self.test_dir)
+        self.assertEqual(d.roots, [self.test_dir, self.root_dir])
+        d.catalog.close()
+
+        with self.assertRaises(db.DatabaseError):
+            self.db.add_root(self.root_dir)
+
+
+    def test_place_by_free_space(self):
+        self.free_space = { self.test_dir: 100, self.root_dir: 200 }
+        self.create_disc(self.DISC_ID)
+
+        self.assertEqual(self.db.get_disc_root(self.DB_ID), self.root_dir)
+        self.assertTrue(self.db.get_disc_dir(self.DB_ID).startswith(self.root_dir))
+        self.assertIsNotNone(self.db.get_disc_by_disc_id(self.DISC_ID))
+
+        self.free_space = { self.test_dir: 300, self.root_dir: 200 }
+        self.create_disc(self.OTHER_ID)
+        self.assertEqual(self.db.get_disc_root(self.db.disc_to_db_id(self.OTHER_ID)),
+                         self.test_dir)
+
+        # Found in both roots by another process
+        d = db.Database(self.test_dir)
+        self.assertItemsEqual(d.iterdiscs_db_ids(),
+                              [self.DB_ID, d.disc_to_db_id(self.OTHER_ID)])
+        self.assertEqual(d.get_disc_root(self.DB_ID), self.root_dir)
+        self.assertEqual([(r.path, r.discs) for r in d.get_root_info()],
+                         [(self.test_dir, 1), (self.root_dir, 1)])
+        d.catalog.close()
+
+
+    def test_place_skips_missing_root(self):
+        self.free_space = { self.test_dir: 100, self.root_dir: None }
+        self.create_disc(self.DISC_ID)
+        self.assertEqual(self.db.get_disc_root(self.DB_ID), self.test_dir)
+
+        self.free_space = { self.test_dir: None, self.root_dir: None }
+        with self.assertRaises(db.DatabaseError):
+            self.create_disc(self.OTHER_ID)
+
+
+    def test_move_disc(self):
+        self.create_disc(self.DISC_ID)
+        src = self.db.get_disc_dir(self.DB_ID)
+
+        # Another process that has already found the disc
+        other_db = db.Database(self.test_dir)
+        self.assertIsNotNone(other_db.get_disc_by_db_id(self.DB_ID))
+
+        self.db.move_disc(self.DB_ID, self.root_dir)
+
+        self.assertFalse(os.path.exists(src))
+        self.assertEqual(self.db.get_disc_root(self.DB_ID), self.root_dir)
+        self.assertEqual(os.path.getsize(self.db.get_audio_path(self.DB_ID)), 1000)
+        self.assertIsNotNone(self.db.get_disc_by_db_id(self.DB_ID))
+
+        self.assertIsNotNone(other_db.get_disc_by_db_id(self.DB_ID))
+        self.assertEqual(other_db.get_disc_root(self.DB_ID), self.root_dir)
+        other_db.catalog.close()
+
+        # Recently changed discs aren't moved
+        self.db.MOVE_QUIET_SECS = 60
+        with self.assertRaises(db.DatabaseError):
+            self.db.move_disc(self.DB_ID, self.test_dir)
+
+
+    def test_rebalance(self):
+        self.free_space = { self.test_dir: 100000, self.root_dir: 100000 }
+        self.create_disc(self.DISC_ID)
+        self.create_disc(self.OTHER_ID)
+
+        # Not worth moving anything
+        self.assertEqual(self.db.rebalance(), ([], []))
+
+        disc_dir = self.db.get_disc_dir(self.DB_ID)
+        disc_size = sum(os.path.getsize(os.path.join(disc_dir, f)) for f in os.listdir(disc_dir))
+
+        # Room to move one disc without tipping the balance
+        self.free_space = { self.test_dir: 100000, self.root_dir: 100000 + 3 * disc_size }
+        moves, errors = self.db.rebalance(dry_run = True)
+        self.assertEqual(len(moves), 1)
+        self.assertEqual(self.db.get_disc_root(moves[0][0]), self.test_dir)
+
+        moves, errors = self.db.rebalance()
+        self.assertEqual(errors, [])
+        self.assertEqual(len(moves), 1)
+
+        db_id, src, dest, size = moves[0]
+        self.assertEqual((src, dest), (self.test_dir, self.root_dir))
+        self.assertEqual(self.db.get_disc_root(db_id), self.root_dir)
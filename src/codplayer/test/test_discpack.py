@@ -0,0 +1,85 @@
+# codplayer - test the discpack module
+#
+# Copyright 2018 Peter Liljenberg <peter.liljenberg@gmail.com>
+#
+# Distributed under an MIT license, please see LICENSE in the top dir.
+
+from pkg_resources import resource_string
+import unittest
+import json
+
+from .. import model
+from .. import serialize
+from .. import discpack
+
+
+def load_test_disc():
+    return serialize.load_jsons(model.DbDisc, resource_string(
+        'codplayer.test', 'data/sonicyouth-daydreamnation.cod'))
+
+
+def disc_values(disc):
+    # Only compare the attribute values, not the _populated_ flags
+    def strip(obj):
+        if isinstance(obj, dict):
+            return dict((k, strip(v)) for k, v in obj.items()
+                        if not k.startswith('_populated_'))
+        if isinstance(obj, list):
+            return [strip(v) for v in obj]
+        return obj
+
+    return strip(json.loads(serialize.get_jsons(disc)))
+
+
+class TestPackDisc(unittest.TestCase):
+    def test_round_trip(self):
+        disc = load_test_disc()
+        disc.tracks[2].index = [100, 200]
+        disc.tracks[3].title = u'Hey Joni \xe5\xe4\xf6'
+        disc.tracks[4].skip = True
+        disc.link_type = None
+
+        data = discpack.pack_disc(disc, 1234, 5678.25, 42)
+        disc2 = discpack.unpack_disc(data, 1234, 5678.25, 42)
+
+        self.assertEqual(disc_values(disc2), disc_values(disc))
+
+        self.assertIsInstance(disc2.disc_id, str)
+        self.assertIsInstance(disc2.title, unicode)
+        self.assertIs(disc2.data_file_format, model.RAW_CD)
+        self.assertIs(disc2.audio_format, model.PCM)
+        self.assertEqual(disc2.tracks[2].index, [100, 200])
+        self.assertIs(disc2.tracks[4].skip, True)
+
+
+    def test_changed_json(self):
+        data = discpack.pack_disc(load_test_disc(), 1234, 5678.25, 42)
+
+        with self.assertRaises(discpack.PackError):
+            discpack.unpack_disc(data, 1235, 5678.25, 42)
+
+        with self.assertRaises(discpack.PackError):
+            discpack.unpack_disc(data, 1234, 5678.5, 42)
+
+        # Replaced by another file with the same size and mtime
+        with self.assertRaises(discpack.PackError):
+            discpack.unpack_disc(data, 1234, 5678.25, 43)
+
+
+    def test_truncated(self):
+        data = discpack.pack_disc(load_test_disc(), 1234, 5678.25, 42)
+
+        for length in (0, 10, discpack.HEADER.size, len(data) / 2, len(data) - 1):
+            with self.assertRaises(discpack.PackError):
+                discpack.unpack_disc(data[:length])
+
+        with self.assertRaises(discpack.PackError):
+            discpack.unpack_disc(data + '\0')
+
+
+    def test_too_large_value(self):
+        disc = load_test_disc()
+        disc.tracks[0].file_offset = 2 ** 40
+
+        with self.assertRaises(OverflowError):
+            discpack.pack_disc(disc, 1234, 5678.25, 42)
@@ -0,0 +1,162 @@
+# codplayer - test the export module
+#
+# Copyright 2018 Peter Liljenberg <peter.liljenberg@gmail.com>
+#
+# Distributed under an MIT license, please see LICENSE in the top dir.
+
+import unittest
+import os
+import sys
+import array
+import shutil
+import tempfile
+import wave
+
+from .. import export
+from .test_db import TestDisc, DB_ID
+
+
+TOC = """
+TRACK AUDIO
+TWO_CHANNEL_AUDIO
+SILENCE 00:00:02
+FILE "data.cdr" 0 00:00:20
+START 00:00:02
+
+TRACK AUDIO
+TWO_CHANNEL_AUDIO
+FILE "data.cdr" 00:00:20 00:00:30
+START 00:00:05
+"""
+
+
+def swap(data):
+    a = array.array('h', data)
+    a.byteswap()
+    return a.tostring()
+
+
+class TestExport(TestDisc, unittest.TestCase):
+    TOC = TOC
+    CHUNK_MODULES = (export, )
+
+    def setUpDisc(self, disc):
+        disc.tracks[0].title = u'Intro/Outro'
+
+    def setUp(self):
+        super(TestExport, self).setUp()
+        self.out_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.out_dir)
+        super(TestExport, self).tearDown()
+
+
+    def read_wav(self, path):
+        w = wave.open(path, 'rb')
+        try:
+            self.assertEqual(w.getnchannels(), 2)
+            self.assertEqual(w.getsampwidth(), 2)
+            self.assertEqual(w.getframerate(), 44100)
+            return w.readframes(w.getnframes())
+        finally:
+            w.close()
+
+
+    def test_track_names(self):
+        options = export.ExportOptions()
+        self.assertEqual(
+            export.track_path('out', DB_ID, self.disc, self.disc.tracks[0], options),
+            os.path.join('out', DB_ID, '01 Intro-Outro.wav'))
+        self.assertEqual(
+            export.track_path('out', DB_ID, self.disc, self.disc.tracks[1], options),
+            os.path.join('out', DB_ID, '02.wav'))
+
+
+    def test_export_wav(self):
+        results = export.export_database(self.db, self.out_dir, processes = 2)
+        self.assertEqual(len(results), 2)
+        self.assertEqual([r.error for r in results], [None, None])
+
+        # Track 1 starts at index 1, after the silent pregap
+        t1 = self.disc.tracks[0]
+        data = self.read_wav(os.path.join(self.out_dir, DB_ID, '01 Intro-Outro.wav'))
+        self.assertEqual(data, swap(self.audio[:t1.file_length * 4]))
+
+        # Track 2 skips the pregap in the audio file
+        t2 = self.disc.tracks[1]
+        data = self.read_wav(os.path.join(self.out_dir, DB_ID, '02.wav'))
+        self.assertEqual(len(data), (t2.length - t2.pregap_offset) * 4)
+        self.assertEqual(data, swap(self.audio[(t2.file_offset + t2.pregap_offset) * 4:]))
+
+
+    def test_export_pregaps(self):
+        options = export.ExportOptions(pregaps = True)
+        results = export.export_database(self.db, self.out_dir, options = options,
+                                         processes = 1)
+        self.assertEqual([r.error for r in results], [None, None])
+
+        t1 = self.disc.tracks[0]
+        data = self.read_wav(os.path.join(self.out_dir, DB_ID, '01 Intro-Outro.wav'))
+        self.assertEqual(data, '\0' * (t1.pregap_silence * 4) +
+                         swap(self.audio[:t1.file_length * 4]))
+
+        t2 = self.disc.tracks[1]
+        data = self.read_wav(os.path.join(self.out_dir, DB_ID, '02.wav'))
+        self.assertEqual(data, swap(self.audio[t2.file_offset * 4:]))
+
+
+    def test_resume(self):
+        results = export.export_database(self.db, self.out_dir, processes = 1)
+        self.assertTrue(all(r.exported for r in results))
+
+        # Nothing changed
+        results = export.export_database(self.db, self.out_dir, processes = 1)
+        self.assertEqual([(r.exported, r.error) for r in results], [(None, None)] * 2)
+
+        # Changed audio in track 2 is exported again
+        with open(self.audio_path, 'r+b') as f:
+            f.seek(len(self.audio) - 4)
+            f.write('\1\2\3\4')
+
+        results = export.export_database(self.db, self.out_dir, processes = 1)
+        self.assertEqual([r.number for r in results if r.exported], [2])
+
+        # So is a removed file
+        os.remove(os.path.join(self.out_dir, DB_ID, '01 Intro-Outro.wav'))
+        results = export.export_database(self.db, self.out_dir, processes = 1)
+        self.assertEqual([r.number for r in results if r.exported], [1])
+
+
+    def test_encoder(self):
+        options = export.ExportOptions(
+            encoder = [sys.executable, '-c',
+                       'import sys; open(sys.argv[1], "wb").write(sys.stdin.read()[44:])',
+                       '{path}'],
+            suffix = '.raw')
+
+        results = export.export_database(self.db, self.out_dir, [DB_ID],
+                                         options = options, processes = 1)
+        self.assertEqual([r.error for r in results], [None, None])
+
+        t2 = self.disc.tracks[1]
+        with open(os.path.join(self.out_dir, DB_ID, '02.raw'), 'rb') as f:
+            self.assertEqual(f.read(), swap(self.audio[(t2.file_offset + t2.pregap_offset) * 4:]))
+
+        # Failing encoder leaves no file behind
+        shutil.rmtree(os.path.join(self.out_dir, DB_ID))
+        os.remove(os.path.join(self.out_dir, export.MANIFEST_FILE))
+        options.encoder = [sys.executable, '-c', 'import sys; sys.exit(1)']
+
+        results = export.export_database(self.db, self.out_dir, [DB_ID],
+                                         options = options, processes = 1)
+        self.assertIn('exit code 1', results[0].error)
+        self.assertEqual(os.listdir(os.path.join(self.out_dir, DB_ID)), [])
+
+
+    def test_no_audio_format(self):
+        self.disc.audio_format = None
+        self.db.save_disc_info(self.disc)
+
+        results = export.export_database(self.db, self.out_dir, processes = 1)
+        self.assertEqual([r.error for r in results], ['no audio format in disc info'] * 2)
@@ -0,0 +1,217 @@
+# codplayer - test the importer module
+#
+# Copyright 2018 Peter Liljenberg <peter.liljenberg@gmail.com>
+#
+# Distributed under an MIT license, please see LICENSE in the top dir.
+
+from pkg_resources import resource_string
+import unittest
+import os
+import array
+import shutil
+import tempfile
+import wave
+
+from .. import db
+from .. import model
+from .. import serialize
+from .. import importer
+from .test_db import TestDatabase, make_audio
+
+
+RAW_TOC = """CD_DA
+
+TRACK AUDIO
+TWO_CHANNEL_AUDIO
+FILE "disc.cdr" 0 00:00:20
+
+TRACK AUDIO
+TWO_CHANNEL_AUDIO
+FILE "disc.cdr" 00:00:20 00:00:30
+START 00:00:05
+"""
+
+DATA_TOC = RAW_TOC + """
+TRACK MODE1
+DATAFILE "data.bin" 00:10:00
+"""
+
+
+class TestDiscID(unittest.TestCase):
+    def test_calculate_disc_id(self):
+        disc = serialize.load_jsons(model.DbDisc, resource_string(
+            'codplayer.test', 'data/sonicyouth-daydreamnation.cod'))
+        self.assertEqual(importer.calculate_disc_id(disc), disc.disc_id)
+
+    def test_frames_to_msf(self):
+        self.assertEqual(importer.frames_to_msf(0), '00:00:00')
+        self.assertEqual(importer.frames_to_msf(588 * (75 * 61 + 3)), '01:01:03')
+
+
+class TestImport(TestDatabase, unittest.TestCase):
+    def setUp(self):
+        super(TestImport, self).setUp()
+        self.src_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.src_dir)
+        super(TestImport, self).tearDown()
+
+
+    def write_wav(self, name, data, channels = 2):
+        w = wave.open(os.path.join(self.src_dir, name), 'wb')
+        w.setnchannels(channels)
+        w.setsampwidth(2)
+        w.setframerate(44100)
+        w.writeframes(data)
+        w.close()
+
+
+    def test_import_wav(self):
+        track1 = make_audio(588 * 4 * 10)
+        track2 = make_audio(588 * 4 * 20 + 400)
+        self.write_wav('01.wav', track1)
+        self.write_wav('02.wav', track2)
+
+        sources = importer.find_sources([self.src_dir])
+        self.assertEqual(len(sources), 1)
+
+        results = importer.import_discs(self.db, sources, processes = 2)
+        self.assertEqual(len(results), 1)
+        self.assertIsNone(results[0].error)
+        self.assertTrue(results[0].imported)
+
+        db_id = results[0].db_id
+        disc = self.db.get_disc_by_db_id(db_id)
+        self.assertTrue(disc.rip)
+        self.assertFalse(disc.toc)
+        self.assertEqual(disc.disc_id, importer.calculate_disc_id(disc))
+        self.assertEqual([t.file_length for t in disc.tracks], [588 * 10, 588 * 21])
+        self.assertFalse(os.path.exists(self.db.get_orig_toc_path(db_id)))
+
+        # Samples are stored big-endian, with the last track padded
+        # to a whole sector
+        expected = array.array('h', track1 + track2)
+        expected.byteswap()
+        with open(self.db.get_audio_path(db_id), 'rb') as f:
+            self.assertEqual(f.read(), expected.tostring() + '\0' * (588 * 4 - 400))
+
+        # Already imported
+        results = importer.import_discs(self.db, sources, processes = 1)
+        self.assertEqual(results[0].db_id, db_id)
+        self.assertFalse(results[0].imported)
+        self.assertIsNone(results[0].error)
+
+
+    def test_import_raw(self):
+        audio = make_audio(588 * 4 * 50)
+        with open(os.path.join(self.src_dir, 'disc.toc'), 'wt') as f:
+            f.write(RAW_TOC)
+        with open(os.path.join(self.src_dir, 'disc.cdr'), 'wb') as f:
+            f.write(audio)
+
+        results = importer.import_discs(
+            self.db, importer.find_sources([os.path.join(self.src_dir, 'disc.toc')]),
+            processes = 1)
+        self.assertIsNone(results[0].error)
+
+        db_id = results[0].db_id
+        disc = self.db.get_disc_by_db_id(db_id)
+        self.assertTrue(disc.rip)
+        self.assertTrue(disc.toc)
+        self.assertEqual(disc.data_file_name, self.db.get_audio_file(db_id))
+        self.assertEqual(disc.tracks[1].pregap_offset, 588 * 5)
+
+        with open(self.db.get_orig_toc_path(db_id), 'rt') as f:
+            self.assertEqual(f.read(), RAW_TOC)
+        with open(self.db.get_audio_path(db_id), 'rb') as f:
+            self.assertEqual(f.read(), audio)
+
+
+    def test_bad_sources(self):
+        with self.assertRaises(importer.ImportDiscError):
+            importer.find_sources([os.path.join(self.src_dir, 'missing')])
+
+        with open(os.path.join(self.src_dir, 'disc.toc'), 'wt') as f:
+            f.write(DATA_TOC)
+
+        with self.assertRaises(importer.ImportDiscError):
+            importer.find_sources([self.src_dir])
+
+        with open(os.path.join(self.src_dir, 'disc.cdr'), 'wb') as f:
+            f.write(make_audio(588 * 4 * 50))
+
+        results = importer.import_discs(
+            self.db, importer.find_sources([self.src_dir]), processes = 1)
+        self.assertIn('data tracks', results[0].error)
+
+        # Mono WAV files
+        self.write_wav('01.wav', make_audio(588 * 4), channels = 1)
+        results = importer.import_discs(
+            self.db, importer.find_sources([self.src_dir]), processes = 1)
+        self.assertIn('not in CD audio format', results[0].error)
+
+        self.assertEqual(list(self.db.iterdiscs_db_ids()), [])
+
+
+    def test_restart_import(self):
+        audio = make_audio(588 * 4 * 50)
+        with open(os.path.join(self.src_dir, 'disc.toc'), 'wt') as f:
+            f.write(RAW_TOC)
+        with open(os.path.join(self.src_dir, 'disc.cdr'), 'wb') as f:
+            f.write(audio[:588 * 4 * 10])
+
+        sources = importer.find_sources([os.path.join(self.src_dir, 'disc.toc')])
+
+        # The truncated audio leaves an interrupted import
+        results = importer.import_discs(self.db, sources, processes = 1)
+        self.assertIn('TOC expects', results[0].error)
+
+        db_id = self.db.disc_to_db_id(sources[0].get_disc().disc_id)
+        disc = self.db.get_disc_by_db_id(db_id)
+        self.assertFalse(disc.rip)
+        self.assertFalse(os.path.exists(self.db.get_audio_path(db_id)))
+
+        # Edited disc info is kept when the import is run again
+        disc.title = 'Edited'
+        self.db.save_disc_info(disc)
+
+        with open(os.path.join(self.src_dir, 'disc.cdr'), 'wb') as f:
+            f.write(audio)
+
+        results = importer.import_discs(self.db, sources, processes = 1)
+        self.assertIsNone(results[0].error)
+        self.assertTrue(results[0].imported)
+
+        disc = self.db.get_disc_by_db_id(db_id)
+        self.assertTrue(disc.rip)
+        self.assertEqual(disc.title, 'Edited')
+        self.assertFalse(os.path.exists(self.db.get_audio_path(db_id) + importer.IMPORT_SUFFIX))
+
+        with open(self.db.get_audio_path(db_id), 'rb') as f:
+            self.assertEqual(f.read(), audio)
+
+
+    def test_not_imported_disc(self):
+        audio = make_audio(588 * 4 * 50)
+        with open(os.path.join(self.src_dir, 'disc.toc'), 'wt') as f:
+            f.write(RAW_TOC)
+        with open(os.path.join(self.src_dir, 'disc.cdr'), 'wb') as f:
+            f.write(audio)
+
+        sources = importer.find_sources([os.path.join(self.src_dir, 'disc.toc')])
+
+        # A disc that is still being ripped is left alone
+        disc = sources[0].get_disc()
+        disc.title = 'Ripping'
+        self.db.create_disc(disc)
+        db_id = self.db.disc_to_db_id(disc.disc_id)
+        with open(self.db.get_audio_path(db_id), 'wb') as f:
+            f.write('rip')
+
+        results = importer.import_discs(self.db, sources, processes = 1)
+        self.assertIn('not fully ripped', results[0].error)
+
+        self.assertEqual(self.db.get_disc_by_db_id(db_id).title, 'Ripping')
+        with open(self.db.get_audio_path(db_id), 'rb') as f:
+            self.assertEqual(f.read(), 'rip')
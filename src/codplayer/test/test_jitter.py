@@ -0,0 +1,102 @@
+# codplayer - test the radio jitter buffer
+#
+# Copyright 2018 Peter Liljenberg <peter.liljenberg@gmail.com>
+#
+# Distributed under an MIT license, please see LICENSE in the top dir.
+
+import unittest
+
+from .. import audio
+from .. import model
+from ..sources import jitter
+
+
+def log(msg, *args, **kwargs):
+    pass
+
+
+def make_packet(frames, value = 0):
+    p = audio.AudioPacket(model.Format(rate = 1000))
+    p.data = bytearray([value]) * (frames * 4)
+    return p
+
+
+class TestFrameCorrection(unittest.TestCase):
+    def test_drop_frames(self):
+        data = bytearray(range(20))
+        self.assertEqual(jitter.drop_frames(data, 4, 1),
+                         bytearray(range(8) + range(12, 20)))
+
+    def test_repeat_frames(self):
+        data = bytearray(range(20))
+        self.assertEqual(jitter.repeat_frames(data, 4, 1),
+                         bytearray(range(12) + range(8, 20)))
+
+    def test_spread_out(self):
+        data = bytearray(range(36))
+        self.assertEqual(jitter.drop_frames(data, 4, 2),
+                         bytearray(range(12) + range(16, 24) + range(28, 36)))
+
+
+class TestJitterBuffer(unittest.TestCase):
+    def setUp(self):
+        self.buf = jitter.JitterBuffer(log, log, 0.5, 2)
+
+    def test_prebuffer(self):
+        # 0.1 s per packet, starts playing at 0.5 s
+        for i in range(4):
+            self.buf.put(make_packet(100, i))
+            self.assertIsNone(self.buf.get(0))
+
+        self.buf.put(make_packet(100, 4))
+
+        for i in range(5):
+            p = self.buf.get(0)
+            self.assertEqual(p.data[0], i)
+            self.assertAlmostEqual(p.position, i * 0.1)
+
+        self.assertIsNone(self.buf.get(0))
+
+    def test_underrun_raises_target(self):
+        for i in range(5):
+            self.buf.put(make_packet(100))
+        while self.buf.get(0):
+            pass
+
+        self.buf.underrun()
+        self.assertAlmostEqual(self.buf.target, 0.75)
+
+        # Rebuffering to the new target
+        for i in range(7):
+            self.buf.put(make_packet(100))
+        self.assertIsNone(self.buf.get(0))
+
+        self.buf.put(make_packet(100))
+        self.assertIsNotNone(self.buf.get(0))
+
+    def test_error_after_packets(self):
+        self.buf.put(make_packet(100))
+        self.buf.set_error(ValueError('foo'))
+
+        self.assertIsNotNone(self.buf.get(0))
+        with self.assertRaises(ValueError):
+            self.buf.get(0)
+
+    def test_drift_correction(self):
+        for i in range(20):
+            self.buf.put(make_packet(1000))
+
+        # Buffer holds 20 s, while the target is at most 2 s, so
+        # frames should be dropped once playback is reported
+        p = self.buf.get(0)
+        self.assertEqual(len(p.data), 4000)
+        p.update_state(None)
+
+        p = self.buf.get(0)
+        self.assertEqual(len(p.data), 3996)
+
+    def test_closed(self):
+        self.buf.put(make_packet(1000))
+        self.buf.close()
+        self.assertIsNone(self.buf.get(0))
+        self.assertTrue(self.buf.wait_closed(0))
@@ -0,0 +1,85 @@
+# codplayer - test the disc link graph
+#
+# Copyright 2018 Peter Liljenberg <peter.liljenberg@gmail.com>
+#
+# Distributed under an MIT license, please see LICENSE in the top dir.
+
+import unittest
+
+from .. import links
+
+
+class TestLinkGraph(unittest.TestCase):
+    def test_resolve_alias(self):
+        graph = links.LinkGraph([
+            ('a', 'alias', 'b'),
+            ('b', 'alias', 'c'),
+            ('c', 'next', 'd'),
+            ('x', None, None),
+            ])
+
+        self.assertEqual(graph.resolve_alias('a'), ('b', 'c'))
+        self.assertEqual(graph.resolve_alias('b'), ('c', ))
+        self.assertEqual(graph.resolve_alias('c'), ())
+        self.assertEqual(graph.resolve_alias('x'), ())
+        self.assertEqual(len(graph), 3)
+
+        graph.set_link('c', 'alias', 'e')
+        self.assertEqual(graph.resolve_alias('a'), ('b', 'c', 'e'))
+
+        graph.set_link('b', None, None)
+        self.assertEqual(graph.resolve_alias('a'), ('b', ))
+        self.assertIsNone(graph.get_link('b'))
+
+
+    def test_reject_loops(self):
+        graph = links.LinkGraph([
+            ('a', 'alias', 'b'),
+            ('b', 'alias', 'c'),
+            ('c', 'next', 'a'),
+            ])
+
+        with self.assertRaises(ValueError):
+            graph.set_link('c', 'alias', 'a')
+
+        with self.assertRaises(ValueError):
+            graph.set_link('d', 'next', 'd')
+
+        self.assertEqual(graph.get_link('c'), ('next', 'a'))
+
+        # Loops of different link types are fine
+        graph.set_link('a', 'next', 'b')
+        self.assertEqual(graph.get_link('a'), ('next', 'b'))
+
+
+    def test_existing_loops(self):
+        # Can only come from hand-edited disc files
+        graph = links.LinkGraph([
+            ('a', 'alias', 'b'),
+            ('b', 'alias', 'a'),
+            ('c', 'next', 'd'),
+            ('d', 'next', 'c'),
+            ])
+
+        self.assertEqual(graph.resolve_alias('a'), ('b', ))
+        self.assertEqual(sorted(graph.get_disc_set('c')), ['c', 'd'])
+
+        graph.set_link('c', 'next', 'e', check = False)
+        self.assertEqual(graph.get_disc_set('e'), ['d', 'c', 'e'])
+
+
+    def test_disc_set(self):
+        graph = links.LinkGraph([
+            ('a', 'next', 'b'),
+            ('b', 'next', 'c'),
+            ])
+
+        self.assertEqual(graph.get_disc_set('a'), ['a', 'b', 'c'])
+        self.assertEqual(graph.get_disc_set('b'), ['a', 'b', 'c'])
+        self.assertEqual(graph.get_disc_set('c'), ['a', 'b', 'c'])
+        self.assertEqual(graph.get_disc_set('x'), ['x'])
+
+        copy = graph.copy()
+        copy.set_link('c', 'next', 'd')
+        self.assertEqual(copy.get_disc_set('a'), ['a', 'b', 'c', 'd'])
+        self.assertEqual(graph.get_disc_set('a'), ['a', 'b', 'c'])
@@ -0,0 +1,94 @@
+# codplayer - test the PCM disc source
+#
+# Copyright 2018 Peter Liljenberg <peter.liljenberg@gmail.com>
+#
+# Distributed under an MIT license, please see LICENSE in the top dir.
+
+import unittest
+import shutil
+import tempfile
+
+from .. import db
+from .. import cdz
+from ..sources import pcmdisc
+from .test_db import TestDisc, DB_ID
+
+
+TOC = """
+TRACK AUDIO
+TWO_CHANNEL_AUDIO
+FILE "data.cdr" 0 00:00:20
+
+TRACK AUDIO
+TWO_CHANNEL_AUDIO
+FILE "data.cdr" 00:00:20 00:00:30
+"""
+
+
+def log(msg, *args, **kwargs):
+    pass
+
+
+class DummyPlayer(object):
+    log = staticmethod(log)
+    debug = log
+
+    def __init__(self, database):
+        self.db = database
+
+
+class TestPCMDiscSource(TestDisc, unittest.TestCase):
+    TOC = TOC
+
+    def setUpDisc(self, disc):
+        disc.data_file_name = self.db.get_audio_file(DB_ID)
+        disc.rip = True
+
+    def setUp(self):
+        super(TestPCMDiscSource, self).setUp()
+        self.db.MOVE_QUIET_SECS = 0
+
+        # The player has its own database object, like codplayerd
+        self.player = DummyPlayer(db.Database(self.test_dir))
+        self.source = pcmdisc.PCMDiscSource(
+            self.player, self.player.db.get_disc_by_db_id(DB_ID), 0, False)
+
+    def tearDown(self):
+        self.player.db.catalog.close()
+        super(TestPCMDiscSource, self).tearDown()
+
+
+    def play_first_packet(self):
+        # Read a packet and stop, closing the file like on pause or seek
+        packets = self.source.iter_packets()
+        try:
+            p = next(packets)
+        finally:
+            packets.close()
+
+        self.assertEqual(p.data, self.audio[:len(p.data)])
+
+
+    def test_reopen_after_move(self):
+        root_dir = tempfile.mkdtemp()
+        try:
+            self.db.add_root(root_dir)
+            self.play_first_packet()
+
+            self.db.move_disc(DB_ID, root_dir)
+            self.play_first_packet()
+            self.assertTrue(self.source.path.startswith(root_dir))
+
+        finally:
+            shutil.rmtree(root_dir)
+
+
+    @unittest.skipIf(cdz.numpy is None, 'numpy not installed')
+    def test_reopen_after_compress(self):
+        self.play_first_packet()
+
+        result = cdz.compress_disc(self.db, DB_ID)
+        self.assertIsNone(result.error)
+
+        self.play_first_packet()
+        self.assertEqual(self.source.path, self.db.get_compressed_audio_path(DB_ID))
@@ -0,0 +1,109 @@
+# codplayer - test the radio stream connections
+#
+# Copyright 2018 Peter Liljenberg <peter.liljenberg@gmail.com>
+#
+# Distributed under an MIT license, please see LICENSE in the top dir.
+
+import unittest
+import threading
+import time
+import socket
+import BaseHTTPServer
+import SocketServer
+
+from ..sources import radiostream
+
+
+def log(msg, *args, **kwargs):
+    pass
+
+
+class DummyPlayer(object):
+    log = staticmethod(log)
+    debug = log
+
+
+class Station(object):
+    def __init__(self, url):
+        self.url = url
+
+
+class StreamHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.0'
+
+    def do_GET(self):
+        self.send_response(200)
+        self.send_header('Content-Type', 'audio/mpeg')
+        self.end_headers()
+
+        try:
+            while True:
+                self.wfile.write('\0' * 1024)
+                self.wfile.flush()
+                time.sleep(0.01)
+        except socket.error:
+            pass
+
+    def log_message(self, *args):
+        pass
+
+
+class StreamServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+
+class TestStandbyPool(unittest.TestCase):
+    def setUp(self):
+        self.server = StreamServer(('127.0.0.1', 0), StreamHandler)
+        self.server_thread = threading.Thread(target = self.server.serve_forever)
+        self.server_thread.daemon = True
+        self.server_thread.start()
+
+        base = 'http://127.0.0.1:{0}/'.format(self.server.server_address[1])
+        self.station1 = Station(base + 'one')
+        self.station2 = Station(base + 'two')
+
+        self.pool = radiostream.StandbyPool(DummyPlayer())
+
+    def tearDown(self):
+        self.pool.close()
+        self.server.shutdown()
+        self.server.server_close()
+
+
+    def wait_for(self, check):
+        for i in range(100):
+            if check():
+                return True
+            time.sleep(0.05)
+        return False
+
+    def connected(self):
+        with self.pool._lock:
+            return sorted(self.pool._connections.keys())
+
+
+    def test_change_wanted(self):
+        self.pool.prepare([self.station1, self.station2])
+        self.assertTrue(self.wait_for(
+            lambda: self.connected() == [self.station1.url, self.station2.url]))
+
+        # Dropping a station while the pool is reading from it must
+        # not kill the standby thread
+        self.pool.prepare([self.station1])
+        self.assertTrue(self.wait_for(lambda: self.connected() == [self.station1.url]))
+
+        time.sleep(0.5)
+        self.assertTrue(self.pool._thread.is_alive())
+
+        # The remaining connection keeps receiving data
+        self.assertTrue(self.wait_for(
+            lambda: self.pool._connections[self.station1.url]._backlog_size > 0))
+
+        c = self.pool.take(self.station1)
+        self.assertIsNotNone(c)
+        c.close()
+
+        # A new connection replaces the one that was taken
+        self.assertTrue(self.wait_for(lambda: self.connected() == [self.station1.url]))
+        self.assertTrue(self.pool._thread.is_alive())
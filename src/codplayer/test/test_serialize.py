@@ -6,6 +6,10 @@
 
 import unittest
 import types
+import tempfile
+import shutil
+import os
+import json
 
 from .. import serialize
 
@@ -189,3 +193,192 @@ class TestPopulateObject(unittest.TestCase):
                 [serialize.Attr('values', list_type = int)]
                 )
 
+
+
+class TestSaveBatch(unittest.TestCase):
+    def setUp(self):
+        self.test_dir = tempfile.mkdtemp(prefix = 'codplayer_test_serialize_')
+
+    def tearDown(self):
+        shutil.rmtree(self.test_dir)
+
+    def load(self, name):
+        with open(os.path.join(self.test_dir, name), 'rt') as f:
+            return json.load(f)
+
+    def test_commit(self):
+        with open(os.path.join(self.test_dir, 'a'), 'wt') as f:
+            f.write('old')
+
+        batch = serialize.SaveBatch()
+        batch.add({ 'value': 1 }, os.path.join(self.test_dir, 'a'))
+        batch.add({ 'value': 2 }, os.path.join(self.test_dir, 'b'))
+
+        # Nothing is replaced until committed
+        with open(os.path.join(self.test_dir, 'a'), 'rt') as f:
+            self.assertEqual(f.read(), 'old')
+        self.assertFalse(os.path.exists(os.path.join(self.test_dir, 'b')))
+
+        batch.commit()
+
+        self.assertEqual(sorted(os.listdir(self.test_dir)), ['a', 'b'])
+        self.assertEqual(self.load('a'), { 'value': 1 })
+        self.assertEqual(self.load('b'), { 'value': 2 })
+
+    def test_abort(self):
+        batch = serialize.SaveBatch()
+        batch.add({ 'value': 1 }, os.path.join(self.test_dir, 'a'))
+        batch.abort()
+
+        self.assertEqual(os.listdir(self.test_dir), [])
+
+    def test_error_removes_temp_files(self):
+        batch = serialize.SaveBatch()
+        batch.add({ 'value': 1 }, os.path.join(self.test_dir, 'a'))
+
+        with self.assertRaises(serialize.SaveError):
+            batch.add({ 'value': 2 }, os.path.join(self.test_dir, 'missing', 'b'))
+
+        self.assertEqual(os.listdir(self.test_dir), [])
+        self.assertEqual(len(batch), 0)
+
+
+class Nested(serialize.Serializable):
+    MAPPING = (
+        serialize.Attr('name', str),
+        serialize.Attr('text', serialize.str_unicode, optional = True),
+        serialize.Attr('count', int, optional = True, default = 17),
+        serialize.Attr('kind', enum = (FOO, BAR)),
+        serialize.Attr('value', Structure, optional = True),
+        serialize.Attr('values', list_type = Structure, optional = True),
+        serialize.Attr('numbers', list_type = int, optional = True),
+        )
+
+
+class TestCompiled(unittest.TestCase):
+    SRC = {
+        'name': u'foo',
+        'text': u'bar\u20ac',
+        'kind': 'BAR',
+        'value': { 'number': 1 },
+        'values': [{ 'number': 2 }, None],
+        'numbers': None,
+        }
+
+    def populate_generic(self, src):
+        # A copy of the mapping is interpreted by populate_object
+        obj = Nested()
+        serialize.populate_object(src, obj, list(Nested.MAPPING))
+        return obj
+
+    def assertSameObject(self, a, b):
+        self.assertEqual(sorted(a.__dict__.keys()), sorted(b.__dict__.keys()))
+        for k, v in a.__dict__.items():
+            if isinstance(v, list):
+                self.assertEqual([e and e.__dict__ for e in v],
+                                 [e and e.__dict__ for e in b.__dict__[k]])
+            elif isinstance(v, serialize.Serializable):
+                self.assertEqual(v.__dict__, b.__dict__[k].__dict__)
+            else:
+                self.assertEqual(v, b.__dict__[k])
+                self.assertIs(type(v), type(b.__dict__[k]))
+
+
+    def test_load(self):
+        obj = serialize.load_jsono(Nested, self.SRC)
+        self.assertSameObject(obj, self.populate_generic(self.SRC))
+
+        self.assertIsInstance(obj.name, str)
+        self.assertIs(obj.kind, BAR)
+        self.assertEqual(obj.count, 17)
+        self.assertTrue(serialize.attr_populated(obj, 'numbers'))
+        self.assertFalse(serialize.attr_populated(obj, 'count'))
+        self.assertEqual(obj.values[0].number, 2)
+        self.assertIsNone(obj.values[1])
+
+        # populate_object uses the compiled loader for the class mapping
+        obj2 = Nested()
+        serialize.populate_object(self.SRC, obj2, Nested.MAPPING)
+        self.assertSameObject(obj2, obj)
+
+
+    def test_load_errors(self):
+        for key, value in (('name', 17),
+                           ('kind', 'GAZONK'),
+                           ('kind', []),
+                           ('value', 17),
+                           ('values', { 'number': 2 }),
+                           ('values', [{ 'number': 'x' }]),
+                           ('numbers', ['foo'])):
+            src = dict(self.SRC)
+            src[key] = value
+
+            with self.assertRaises(serialize.LoadError) as generic:
+                self.populate_generic(src)
+            with self.assertRaises(serialize.LoadError) as compiled:
+                serialize.load_jsono(Nested, src)
+            self.assertEqual(str(compiled.exception), str(generic.exception))
+
+        src = dict(self.SRC)
+        del src['kind']
+        with self.assertRaises(serialize.LoadError):
+            serialize.load_jsono(Nested, src)
+
+
+    def test_dump(self):
+        obj = serialize.load_jsono(Nested, self.SRC)
+        obj._private = True
+
+        d = serialize.dump_object(obj)
+        self.assertEqual(d, {
+            'name': 'foo',
+            'text': u'bar\u20ac',
+            'count': 17,
+            'kind': 'BAR',
+            'value': { 'number': 1 },
+            'values': [{ 'number': 2 }, None],
+            'numbers': None,
+            })
+
+        self.assertEqual(serialize.dump_object(serialize.load_jsono(Nested, d)), d)
+        self.assertIsNone(serialize.dump_object(None))
+
+
+    def test_encode(self):
+        obj = serialize.load_jsono(Nested, self.SRC)
+        obj._private = True
+
+        s = serialize.get_jsons(obj)
+        self.assertEqual(s, '{"name":"foo","text":"bar\\u20ac","count":17,"kind":"BAR",'
+                         '"value":{"number":1},"values":[{"number":2},null],"numbers":null}')
+        self.assertEqual(json.loads(s), serialize.dump_object(obj))
+
+        # Odd values are still encoded
+        obj.count = 17L
+        obj.numbers = [1, 2.5, True]
+        self.assertEqual(json.loads(serialize.get_jsons(obj))['count'], 17)
+        self.assertEqual(json.loads(serialize.get_jsons(obj))['numbers'], [1, 2.5, True])
+
+        # Objects in other values, and pretty printing
+        self.assertEqual(json.loads(serialize.get_jsons({ 'objs': [obj] })),
+                         { 'objs': [serialize.dump_object(obj)] })
+        self.assertEqual(json.loads(serialize.get_jsons(obj, pretty = True)),
+                         serialize.dump_object(obj))
+
+
+    def test_cache_encoding(self):
+        obj = serialize.load_jsono(Nested, self.SRC)
+        jsons = serialize.get_jsons(obj)
+
+        self.assertIs(serialize.cache_encoding(obj), obj)
+        self.assertEqual(serialize.get_jsons(obj), jsons)
+
+        # The cached string is used as it is, also in other values
+        obj.name = 'changed'
+        self.assertIs(serialize.get_jsons(obj), obj._cached_jsons)
+        self.assertEqual(serialize.get_jsons([obj]), '[' + jsons + ']')
+
+        # But not included in the object itself or in other objects
+        self.assertNotIn('_cached_jsons', serialize.get_jsons(obj))
+        self.assertEqual(json.loads(serialize.get_jsons(obj, pretty = True))['name'], 'changed')
+        self.assertIsNone(Nested()._cached_jsons)
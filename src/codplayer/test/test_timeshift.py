@@ -0,0 +1,85 @@
+# codplayer - test the radio timeshift buffer
+#
+# Copyright 2018 Peter Liljenberg <peter.liljenberg@gmail.com>
+#
+# Distributed under an MIT license, please see LICENSE in the top dir.
+
+import unittest
+import tempfile
+import os
+
+from ..sources import timeshift
+from .test_jitter import log, make_packet
+
+
+class TestTimeshiftBuffer(unittest.TestCase):
+    def setUp(self):
+        fd, self.path = tempfile.mkstemp(prefix = 'codplayer_test_timeshift_')
+        os.close(fd)
+
+        # Room for 1 s of audio at the test rate
+        self.buf = timeshift.TimeshiftBuffer(log, log, 0.2, 1, self.path, 4000)
+
+        # The packets are put all at once, so don't let that raise
+        # the target as if they arrived with a lot of jitter
+        self.buf.JITTER_FACTOR = 0
+
+    def tearDown(self):
+        self.buf.close()
+        os.unlink(self.path)
+
+    def test_allocate(self):
+        self.assertEqual(os.path.getsize(self.path), 4000)
+
+    def test_wrap_around(self):
+        for i in range(15):
+            self.buf.put(make_packet(300, i))
+
+        # Only the last three packets fit
+        for i in range(12, 15):
+            p = self.buf.get(0)
+            self.assertEqual(p.data, bytearray([i]) * 1200)
+
+        self.assertIsNone(self.buf.get(0))
+
+    def test_packet_larger_than_ring(self):
+        # Dropped without counting it as buffered
+        self.buf.put(make_packet(1001))
+        self.buf.put(make_packet(100, 1))
+        self.assertIsNone(self.buf.get(0))
+
+        self.buf.put(make_packet(100, 2))
+        p = self.buf.get(0)
+        self.assertEqual(p.data, bytearray([1]) * 400)
+        self.assertAlmostEqual(p.position, 0)
+
+    def test_pause_and_resume(self):
+        for i in range(3):
+            self.buf.put(make_packet(100, i))
+
+        p = self.buf.get(0)
+        self.assertEqual(p.data, bytearray([0]) * 400)
+        p.update_state(None)
+
+        # The stream is recorded while paused, dropping the oldest
+        # packet when the ring is full
+        for i in range(3, 12):
+            self.buf.put(make_packet(100, i))
+
+        # Resume after a pause longer than the playout timeout
+        self.buf.PLAYOUT_TIMEOUT = 0
+        p = self.buf.get(0)
+        p.update_state(None)
+        del self.buf.PLAYOUT_TIMEOUT
+
+        self.assertEqual(p.data, bytearray([2]) * 400)
+        self.assertAlmostEqual(p.position, 0.2)
+
+        # Plays on from the ring while the stream keeps coming,
+        # without correcting the recorded delay as drift
+        for i in range(3, 12):
+            p = self.buf.get(0)
+            self.assertEqual(p.data, bytearray([i]) * 400)
+            self.assertAlmostEqual(p.position, i * 0.1)
+            p.update_state(None)
+            self.buf.put(make_packet(100, i + 9))
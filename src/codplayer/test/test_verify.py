@@ -0,0 +1,138 @@
+# codplayer - test the verify module
+#
+# Copyright 2018 Peter Liljenberg <peter.liljenberg@gmail.com>
+#
+# Distributed under an MIT license, please see LICENSE in the top dir.
+
+import unittest
+import os
+import struct
+import zlib
+
+from .. import verify
+from .test_db import TestDisc, DB_ID
+
+
+TOC = """
+TRACK AUDIO
+TWO_CHANNEL_AUDIO
+FILE "data.cdr" 0 00:00:20
+
+TRACK AUDIO
+TWO_CHANNEL_AUDIO
+FILE "data.cdr" 00:00:20 00:00:30
+"""
+
+
+def ar_crc_reference(data, first, last):
+    # Straightforward version of the AccurateRip CRC for a track
+    frames = len(data) // 4
+    start = 5 * 588 - 1 if first else 0
+    end = frames - 5 * 588 if last else frames
+
+    crc = 0
+    for i in xrange(frames):
+        left, right = struct.unpack_from('>HH', data, i * 4)
+        mult = i + 1
+        if start <= mult <= end:
+            crc += ((left | (right << 16)) * mult) & 0xffffffff
+    return crc & 0xffffffff
+
+
+class TestVerify(TestDisc, unittest.TestCase):
+    TOC = TOC
+    CHUNK_MODULES = (verify, )
+
+    def setUpDisc(self, disc):
+        disc.toc = True
+
+    def setUp(self):
+        super(TestVerify, self).setUp()
+
+        with open(self.db.get_orig_toc_path(DB_ID), 'wt') as f:
+            f.write(TOC)
+
+        # Whole seconds, so it can be restored exactly with os.utime()
+        os.utime(self.audio_path, (1500000000, 1500000000))
+
+
+    def test_checksums(self):
+        checksums = verify.compute_checksums(self.audio_path, self.disc)
+        self.assertEqual(checksums.db_id, DB_ID)
+        self.assertEqual(len(checksums.tracks), 2)
+
+        for i, (track, tc) in enumerate(zip(self.disc.tracks, checksums.tracks)):
+            data = self.audio[track.file_offset * 4 :
+                              (track.file_offset + track.file_length) * 4]
+            self.assertEqual(tc.number, track.number)
+            self.assertEqual(tc.crc32, zlib.crc32(data) & 0xffffffff)
+
+            if verify.numpy is None:
+                self.assertIsNone(tc.ar_crc)
+            else:
+                self.assertEqual(tc.ar_crc, ar_crc_reference(data, i == 0, i == 1))
+
+
+    def test_good_disc(self):
+        result = verify.verify_disc(self.db, DB_ID)
+        self.assertEqual(result.problems, [])
+        self.assertTrue(result.hashed)
+
+
+    def test_truncated(self):
+        with open(self.audio_path, 'r+b') as f:
+            f.truncate(len(self.audio) - 2)
+
+        result = verify.verify_disc(self.db, DB_ID)
+        self.assertEqual(len(result.problems), 3)
+        self.assertIn('truncated', result.problems[0])
+        self.assertIn('whole number of frames', result.problems[1])
+        self.assertIn('TOC expects', result.problems[2])
+
+
+    def test_missing_files(self):
+        os.remove(self.db.get_orig_toc_path(DB_ID))
+        result = verify.verify_disc(self.db, DB_ID)
+        self.assertEqual(result.problems, ['missing TOC file'])
+
+        os.remove(self.audio_path)
+        result = verify.verify_disc(self.db, DB_ID)
+        self.assertEqual(len(result.problems), 1)
+        self.assertIn('missing audio file', result.problems[0])
+
+
+    def test_manifest(self):
+        manifest_path = os.path.join(self.test_dir, verify.MANIFEST_FILE)
+
+        results = verify.verify_database(self.db, processes = 1)
+        self.assertEqual(len(results), 1)
+        self.assertTrue(results[0].hashed)
+
+        manifest = verify.Manifest.load(manifest_path)
+        self.assertEqual(manifest.get(DB_ID).audio_size, len(self.audio))
+
+        # Unchanged file isn't read again
+        results = verify.verify_database(self.db, processes = 1)
+        self.assertFalse(results[0].hashed)
+        self.assertEqual(results[0].problems, [])
+
+        # Corrupt the file without changing size or mtime
+        with open(self.audio_path, 'r+b') as f:
+            f.seek(len(self.audio) - 10)
+            f.write('\xff\xfe')
+        os.utime(self.audio_path, (1500000000, 1500000000))
+
+        results = verify.verify_database(self.db, processes = 1)
+        self.assertFalse(results[0].hashed)
+        self.assertEqual(results[0].problems, [])
+
+        results = verify.verify_database(self.db, processes = 1, full = True)
+        self.assertTrue(results[0].hashed)
+        self.assertEqual(results[0].problems,
+                         ['track 2 checksum has changed since last verified'])
+
+        # The corrupted checksums don't replace the verified ones
+        results = verify.verify_database(self.db, processes = 1, full = True)
+        self.assertTrue(results[0].changed)
+        self.assertEqual(results[0].problems,
+                         ['track 2 checksum has changed since last verified'])
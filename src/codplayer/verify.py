@@ -0,0 +1,309 @@
+# codplayer - verify the ripped audio files in the database
+#
+# Copyright 2018 Peter Liljenberg <peter.liljenberg@gmail.com>
+#
+# Distributed under an MIT license, please see LICENSE in the top dir.
+
+"""
+Verify that the ripped audio files in the database are complete and
+haven't been corrupted.
+
+The cheap checks compare the size of each audio file with the size
+expected from the disc info file and the cdrdao TOC.  The expensive
+part is reading all the audio to compute checksums for each track: a
+CRC32 of the raw data, and a CRC in the style of AccurateRip (v1) of
+the samples.  (The AccurateRip database isn't queried.)  The latter
+requires numpy, which is an optional dependency.
+
+The checksums are kept in a manifest file, so later runs only read
+audio files that have changed since.  A full run reads all files
+again, and reports any track whose checksum has changed even though
+the file looks unchanged.
+"""
+
+import os
+import zlib
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+from . import db
+from . import cdz
+from . import model
+from . import serialize
+from . import toc
+from . import workpool
+
+
+# Default manifest file, in the database directory
+MANIFEST_FILE = 'verify.json'
+
+# Read this many audio frames at a time (30 seconds)
+CHUNK_FRAMES = model.PCM.rate * 30
+
+# AccurateRip skips the first and last five sectors of a disc
+AR_SKIP_FRAMES = 5 * model.PCM.audio_frames_per_cd_frame
+
+
+class VerifyError(Exception):
+    pass
+
+
+class TrackChecksum(serialize.Serializable):
+    MAPPING = (
+        serialize.Attr('number', int),
+        serialize.Attr('file_offset', (int, long)),
+        serialize.Attr('file_length', (int, long)),
+        serialize.Attr('crc32', (int, long)),
+        serialize.Attr('ar_crc', (int, long), optional = True),
+        )
+
+    def __init__(self, track = None):
+        self.number = track.number if track else 0
+        self.file_offset = track.file_offset if track else 0
+        self.file_length = track.file_length if track else 0
+        self.crc32 = 0
+        self.ar_crc = None
+
+
+class DiscChecksums(serialize.Serializable):
+    """The track checksums of a disc audio file with a given size and
+    modification time.
+    """
+
+    MAPPING = (
+        serialize.Attr('db_id', str),
+        serialize.Attr('audio_size', (int, long)),
+        serialize.Attr('audio_mtime', float),
+        serialize.Attr('tracks', list_type = TrackChecksum),
+        )
+
+    def __init__(self, db_id = None, st = None):
+        self.db_id = db_id
+        self.audio_size = st.st_size if st else 0
+        self.audio_mtime = st.st_mtime if st else 0.0
+        self.tracks = []
+
+    def same_file(self, st):
+        return self.audio_size == st.st_size and self.audio_mtime == st.st_mtime
+
+    def same_layout(self, disc):
+        return ([(t.number, t.file_offset, t.file_length) for t in self.tracks] ==
+                [(t.number, t.file_offset, t.file_length) for t in disc.tracks])
+
+
+class Manifest(workpool.Manifest):
+    MAPPING = (
+        serialize.Attr('discs', list_type = DiscChecksums),
+        )
+
+    ENTRIES = 'discs'
+    ERROR = VerifyError
+
+    @staticmethod
+    def entry_key(checksums):
+        return checksums.db_id
+
+
+class VerifyResult(object):
+    """The outcome of verifying a disc.  problems is a list of
+    strings, empty if the disc is fine.  checksums is the
+    DiscChecksums for the audio file, if it could be read, and hashed
+    is True if the file was read to compute them.  changed is True if
+    the checksums differ from the previous ones of an unchanged file.
+    """
+
+    def __init__(self, db_id, problems = None, checksums = None, hashed = False,
+                 changed = False):
+        self.db_id = db_id
+        self.problems = problems or []
+        self.checksums = checksums
+        self.hashed = hashed
+        self.changed = changed
+
+
+def verify_disc(database, db_id, previous = None, full = False):
+    """Verify the disc DB_ID in DATABASE, returning a VerifyResult.
+
+    PREVIOUS is the DiscChecksums from the manifest, if any.  If the
+    audio file hasn't changed since then it is only read if FULL is
+    true.
+    """
+
+    problems = []
+
+    try:
+        disc = database.get_disc_by_db_id(db_id)
+    except db.DatabaseError, e:
+        return VerifyResult(db_id, [str(e)])
+
+    if disc is None:
+        return VerifyResult(db_id, ['missing disc info file'])
+
+    if disc.audio_format is None:
+        return VerifyResult(db_id, ['no audio format in disc info'])
+
+    audio_path = database.get_disc_audio_path(db_id, disc)
+    try:
+        st = os.stat(audio_path)
+        size = cdz.get_audio_size(audio_path, disc.data_file_format)
+    except (OSError, IOError), e:
+        return VerifyResult(db_id, ['missing audio file: {0}'.format(e)])
+    except cdz.CDZError, e:
+        return VerifyResult(db_id, ['bad compressed audio file: {0}'.format(e)])
+
+    bytes_per_frame = disc.audio_format.bytes_per_frame
+    expected = disc.get_disc_file_size_bytes()
+
+    if size < expected:
+        problems.append('audio file is truncated: {0} bytes, expected {1}'.format(
+            size, expected))
+    elif size > expected:
+        problems.append('audio file is too long: {0} bytes, expected {1}'.format(
+            size, expected))
+
+    if size % bytes_per_frame:
+        problems.append('audio file size is not a whole number of frames: {0} bytes'.format(
+            size))
+
+    toc_path = database.get_orig_toc_path(db_id)
+    if os.path.exists(toc_path):
+        try:
+            toc_disc = toc.read_toc(toc_path, disc.disc_id)
+            toc_size = toc_disc.get_disc_file_size_bytes()
+            if toc_size != size:
+                problems.append('audio file is {0} bytes, TOC expects {1}'.format(
+                    size, toc_size))
+        except toc.TOCError, e:
+            problems.append('bad TOC file: {0}'.format(e))
+
+    elif disc.toc:
+        problems.append('missing TOC file')
+
+    unchanged = (previous is not None and previous.same_file(st)
+                 and previous.same_layout(disc))
+
+    if unchanged and not full:
+        return VerifyResult(db_id, problems, previous)
+
+    try:
+        checksums = compute_checksums(audio_path, disc, st)
+    except (IOError, cdz.CDZError), e:
+        problems.append('error reading audio file: {0}'.format(e))
+        return VerifyResult(db_id, problems)
+
+    changed = False
+    if unchanged:
+        for old, new in zip(previous.tracks, checksums.tracks):
+            if old.crc32 != new.crc32 or (
+                    old.ar_crc is not None and new.ar_crc is not None
+                    and old.ar_crc != new.ar_crc):
+                problems.append('track {0} checksum has changed since last verified'.format(
+                    new.number))
+                changed = True
+
+    return VerifyResult(db_id, problems, checksums, True, changed)
+
+
+def compute_checksums(path, disc, st = None):
+    """Read the audio file PATH for DISC in large chunks, returning a
+    DiscChecksums with the CRCs of each track.
+    """
+
+    if st is None:
+        st = os.stat(path)
+
+    checksums = DiscChecksums(db.Database.disc_to_db_id(disc.disc_id), st)
+    bytes_per_frame = disc.audio_format.bytes_per_frame
+    dtype = '>u2' if disc.audio_format.big_endian else '<u2'
+
+    with cdz.open_audio(path, disc.data_file_format) as f:
+        for i, track in enumerate(disc.tracks):
+            tc = TrackChecksum(track)
+
+            # Frame numbers (starting at 1) included in the AR CRC
+            ar_start = AR_SKIP_FRAMES - 1 if i == 0 else 0
+            ar_end = track.file_length - (AR_SKIP_FRAMES if i == len(disc.tracks) - 1 else 0)
+            ar_crc = 0
+
+            f.seek(track.file_offset * bytes_per_frame)
+            pos = 0
+            while pos < track.file_length:
+                data = f.read(min(CHUNK_FRAMES, track.file_length - pos) * bytes_per_frame)
+                if not data:
+                    break
+
+                tc.crc32 = zlib.crc32(data, tc.crc32)
+                if numpy is not None:
+                    ar_crc = _update_ar_crc(ar_crc, data, dtype, pos, ar_start, ar_end)
+
+                pos += len(data) // bytes_per_frame
+
+            tc.crc32 &= 0xffffffff
+            if numpy is not None:
+                tc.ar_crc = ar_crc
+
+            checksums.tracks.append(tc)
+
+    return checksums
+
+
+def _update_ar_crc(crc, data, dtype, pos, start, end):
+    # AccurateRip sums each stereo frame, as a little-endian 32-bit
+    # word with the left sample in the low half, multiplied by its
+    # frame number within the track.  All modulo 2^32.
+    samples = numpy.frombuffer(data, dtype = dtype, count = len(data) // 4 * 2)
+    frames = samples[0::2].astype(numpy.uint64) | (samples[1::2].astype(numpy.uint64) << 16)
+
+    first = pos + 1
+    mult = numpy.arange(first, first + len(frames), dtype = numpy.uint64)
+
+    lo = max(start - first, 0)
+    hi = max(min(end - first + 1, len(frames)), lo)
+
+    products = (frames[lo:hi] * mult[lo:hi]) & 0xffffffff
+    return (crc + int(products.sum())) & 0xffffffff
+
+
+#
+# Verifying many discs in a process pool
+#
+
+def verify_database(database, db_ids = None, manifest_path = None,
+                    full = False, processes = None, progress = None):
+    """Verify the discs DB_IDS (default all discs) in DATABASE, in a
+    pool of PROCESSES processes (default one per CPU).
+
+    The manifest is read from and saved to MANIFEST_PATH (default
+    MANIFEST_FILE in the database directory).  It is saved
+    periodically, so if the verification is interrupted the discs
+    already hashed are not hashed again.
+
+    PROGRESS is called with (count, total, VerifyResult) as each disc
+    is verified, in the order they finish.
+
+    Returns a list of VerifyResult objects.
+    """
+
+    if manifest_path is None:
+        manifest_path = os.path.join(database.db_dir, MANIFEST_FILE)
+
+    if db_ids is None:
+        db_ids = list(database.iterdiscs_db_ids())
+
+    manifest = Manifest.load(manifest_path)
+    previous = manifest.get_all()
+
+    def get_entry(result):
+        # Keep the old checksums of a file that has changed
+        # unexpectedly, so it is reported again on later runs
+        if result.hashed and not result.changed:
+            return result.checksums
+        return None
+
+    return workpool.run_jobs(
+        database, verify_disc, [(db_id, previous.get(db_id), full) for db_id in db_ids],
+        processes = processes, progress = progress,
+        manifest = manifest, manifest_path = manifest_path, get_entry = get_entry)
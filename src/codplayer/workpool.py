@@ -0,0 +1,148 @@
+# codplayer - run jobs on the database discs in a process pool
+#
+# Copyright 2018 Peter Liljenberg <peter.liljenberg@gmail.com>
+#
+# Distributed under an MIT license, please see LICENSE in the top dir.
+
+"""
+Run slow jobs on the discs in a database, such as verifying or
+exporting them, in a pool of processes that each open the database
+themselves.
+
+Jobs that keep a record of the work done use a Manifest, which is
+saved periodically so an interrupted run can be resumed.
+"""
+
+import os
+import time
+import multiprocessing
+
+from . import db
+from . import serialize
+
+
+# Save manifests this often while running jobs, in seconds
+SAVE_INTERVAL = 60
+
+
+class Manifest(serialize.Serializable):
+    """Base class for the manifest files of jobs.
+
+    Subclasses set MAPPING to a single list attribute named ENTRIES,
+    implement entry_key() to identify the entries, and set ERROR to
+    the exception raised if the file can't be loaded or saved.
+    """
+
+    ENTRIES = None
+    ERROR = None
+
+    def __init__(self):
+        setattr(self, self.ENTRIES, [])
+
+    @staticmethod
+    def entry_key(entry):
+        raise NotImplementedError()
+
+    @classmethod
+    def load(cls, path):
+        """Load the manifest in PATH, or return an empty one if there
+        is no such file.
+        """
+        if not os.path.exists(path):
+            return cls()
+
+        try:
+            return serialize.load_json(cls, path)
+        except serialize.LoadError, e:
+            raise cls.ERROR(str(e))
+
+    def save(self, path):
+        self._entries().sort(key = self.entry_key)
+        try:
+            serialize.save_json(self, path)
+        except serialize.SaveError, e:
+            raise self.ERROR(str(e))
+
+    def get(self, key):
+        for entry in self._entries():
+            if self.entry_key(entry) == key:
+                return entry
+        return None
+
+    def get_all(self):
+        return dict((self.entry_key(entry), entry) for entry in self._entries())
+
+    def set(self, entry):
+        key = self.entry_key(entry)
+        entries = [e for e in self._entries() if self.entry_key(e) != key]
+        entries.append(entry)
+        setattr(self, self.ENTRIES, entries)
+
+    def _entries(self):
+        return getattr(self, self.ENTRIES)
+
+
+_worker_database = None
+_worker_func = None
+
+def _init_worker(db_dir, func, niceness):
+    global _worker_database, _worker_func
+    if niceness:
+        os.nice(niceness)
+    _worker_database = db.Database(db_dir)
+    _worker_func = func
+
+
+def _run_worker(args):
+    return _worker_func(_worker_database, *args)
+
+
+def run_jobs(database, func, jobs, processes = None, niceness = 0, progress = None,
+             manifest = None, manifest_path = None, get_entry = None):
+    """Call FUNC(database, *job) for each tuple in JOBS, in a pool of
+    PROCESSES processes (default one per CPU) running at a lower
+    priority by NICENESS.  FUNC must be a module-level function.
+
+    PROGRESS is called with (count, total, result) as each job is
+    done, in the order they finish.
+
+    If MANIFEST is provided, GET_ENTRY is called with each result and
+    returns the entry to record in the manifest, or None.  The
+    manifest is saved to MANIFEST_PATH every SAVE_INTERVAL seconds
+    and when the jobs are done or interrupted.
+
+    Returns a list of the results.
+    """
+
+    results = []
+    recorded = False
+    last_save = time.time()
+
+    pool = multiprocessing.Pool(processes, _init_worker, (database.db_dir, func, niceness))
+    try:
+        for result in pool.imap_unordered(_run_worker, jobs):
+            results.append(result)
+
+            entry = get_entry(result) if manifest is not None else None
+            if entry is not None:
+                manifest.set(entry)
+                recorded = True
+
+                if time.time() - last_save > SAVE_INTERVAL:
+                    manifest.save(manifest_path)
+                    last_save = time.time()
+
+            if progress:
+                progress(len(results), len(jobs), result)
+
+        pool.close()
+        pool.join()
+
+    finally:
+        pool.terminate()
+
+        # Keep what's been done so far even if interrupted
+        if recorded:
+            manifest.save(manifest_path)
+
+    return results
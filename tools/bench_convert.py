@@ -0,0 +1,66 @@
+#!/usr/bin/env python
+#
+# Copyright 2018 Peter Liljenberg <peter.liljenberg@gmail.com>
+#
+# Distributed under an MIT license, please see LICENSE in the top dir.
+
+"""Measure the CPU cost of codplayer.convert.FormatConverter.
+
+Prints the CPU time needed per second of converted audio for some
+typical input formats, using packets of the same size as the radio
+and disc sources.  Run it on the target board, e.g. a Raspberry Pi:
+
+    python tools/bench_convert.py [SECONDS] [OUTPUT_RATE]
+"""
+
+import sys
+import os
+import time
+
+import numpy
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'src'))
+
+from codplayer import audio, model, convert
+
+PACKETS_PER_SECOND = 10
+
+FORMATS = (
+    ('disc 44.1 kHz', model.Format(rate = 44100, big_endian = True)),
+    ('radio 48 kHz', model.Format(rate = 48000, big_endian = False)),
+    ('radio 32 kHz', model.Format(rate = 32000, big_endian = False)),
+    ('radio 22.05 kHz', model.Format(rate = 22050, big_endian = False)),
+    ('radio 24 kHz mono', model.Format(rate = 24000, channels = 1, big_endian = False)),
+)
+
+
+def bench(name, format, seconds, output_rate):
+    frames = format.rate / PACKETS_PER_SECOND
+    noise = numpy.random.randint(-32768, 32767, size = frames * format.channels)
+    data = noise.astype('>i2' if format.big_endian else '<i2').tostring()
+
+    converter = convert.FormatConverter(output_rate)
+    count = seconds * PACKETS_PER_SECOND
+
+    start = time.clock()
+    for i in xrange(count):
+        p = audio.AudioPacket(format)
+        p.data = data
+        converter.convert(p)
+    used = time.clock() - start
+
+    print '{0:20s} {1:8.2f} ms CPU per second of audio ({2:.2f}% of one core)'.format(
+        name, 1000 * used / seconds, 100 * used / seconds)
+
+
+def main():
+    seconds = int(sys.argv[1]) if len(sys.argv) > 1 else 60
+    output_rate = int(sys.argv[2]) if len(sys.argv) > 2 else 44100
+
+    print 'converting {0} s of audio per format to {1} Hz'.format(seconds, output_rate)
+    for name, format in FORMATS:
+        bench(name, format, seconds, output_rate)
+
+
+if __name__ == '__main__':
+    main()
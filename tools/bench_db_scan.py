@@ -0,0 +1,144 @@
+#!/usr/bin/env python
+#
+# Copyright 2018 Peter Liljenberg <peter.liljenberg@gmail.com>
+#
+# Distributed under an MIT license, please see LICENSE in the top dir.
+
+"""Measure how long it takes to load all discs in a database.
+
+Creates a synthetic database with DISCS discs (no audio files) in a
+temporary directory, and then loads every disc info file serially
+and with Database.iterdiscs_parallel() at a few thread counts:
+
+    python tools/bench_db_scan.py [DISCS] [LATENCY_MS]
+
+If LATENCY_MS is given, each disc info file read is delayed that long
+to simulate slow storage such as an SD card or a network filesystem.
+The OS file cache makes the local disk case measure mostly parsing.
+
+The first serial scan loads the JSON disc info files.  The database
+is then reindexed, writing the binary .codp copies, which all the
+following scans load instead.
+"""
+
+import sys
+import os
+import time
+import shutil
+import tempfile
+import struct
+import base64
+import string
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'src'))
+
+from codplayer import db, model, serialize
+
+TRACKS = 12
+THREAD_COUNTS = (2, 4, 8, 16)
+
+
+def make_disc_id(i):
+    raw = struct.pack('>I', i) * 5
+    return base64.b64encode(raw).translate(string.maketrans('+/=', '._-'))
+
+
+def create_database(path, count):
+    db.Database.init_db(path)
+    database = db.Database(path)
+
+    for i in xrange(count):
+        disc = model.DbDisc()
+        disc.disc_id = make_disc_id(i)
+        disc.data_file_name = database.get_audio_file(database.disc_to_db_id(disc.disc_id))
+        disc.data_file_format = model.RAW_CD
+        disc.audio_format = model.PCM
+        disc.artist = u'Artist {0}'.format(i)
+        disc.title = u'Title {0}'.format(i)
+
+        for t in range(TRACKS):
+            track = model.DbTrack()
+            track.number = t + 1
+            track.file_offset = t * 44100 * 4 * 200
+            track.length = 44100 * 200
+            track.file_length = track.length
+            track.title = u'Track {0}'.format(t + 1)
+            disc.tracks.append(track)
+
+        db_id = database.disc_to_db_id(disc.disc_id)
+        os.makedirs(database.get_disc_dir(db_id))
+        serialize.save_json(disc, database.get_disc_info_path(db_id))
+
+    return database
+
+
+def throttle(latency):
+    load_json = serialize.load_json
+
+    def slow_load_json(cls, path):
+        time.sleep(latency)
+        return load_json(cls, path)
+
+    serialize.load_json = slow_load_json
+
+
+def run(name, func):
+    start = time.time()
+    count, errors = func()
+    elapsed = time.time() - start
+    print '{0:20s} {1:6d} discs {2:3d} errors {3:8.2f} s {4:8.0f} discs/s'.format(
+        name, count, errors, elapsed, count / elapsed)
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 10000
+    latency = float(sys.argv[2]) / 1000 if len(sys.argv) > 2 else 0
+
+    path = tempfile.mkdtemp(prefix = 'codplayer_bench_db_')
+    try:
+        print 'creating {0} discs in {1}'.format(count, path)
+        create_database(path, count)
+
+        if latency:
+            print 'simulating {0:.1f} ms latency per disc file'.format(latency * 1000)
+            throttle(latency)
+
+        def serial():
+            # A new Database each time, so the disc cache is empty
+            database = db.Database(path)
+            loaded = errors = 0
+            for db_id in database.iterdiscs_db_ids():
+                try:
+                    if database.get_disc_by_db_id(db_id):
+                        loaded += 1
+                except db.DatabaseError:
+                    errors += 1
+            return loaded, errors
+
+        run('serial, from JSON', serial)
+
+        database = db.Database(path)
+        database.reindex()
+        database.catalog.close()
+
+        run('serial, from packs', serial)
+
+        for threads in THREAD_COUNTS:
+            def parallel():
+                database = db.Database(path)
+                loaded = errors = 0
+                for db_id, disc, error in database.iterdiscs_parallel(threads):
+                    if error:
+                        errors += 1
+                    else:
+                        loaded += 1
+                return loaded, errors
+
+            run('{0} threads'.format(threads), parallel)
+
+    finally:
+        shutil.rmtree(path)
+
+
+if __name__ == '__main__':
+    main()
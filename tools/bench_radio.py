@@ -0,0 +1,98 @@
+#!/usr/bin/env python
+#
+# Copyright 2018 Peter Liljenberg <peter.liljenberg@gmail.com>
+#
+# Distributed under an MIT license, please see LICENSE in the top dir.
+
+"""Measure the throughput of the radio stream pipeline.
+
+Serves a captured MP3 stream from a local file over HTTP on localhost
+and decodes it as fast as possible with HttpMpegStream, reporting how
+many times faster than realtime the decoding and packet assembly runs:
+
+    python tools/bench_radio.py CAPTURED.mp3
+
+A stream can be captured with e.g.:
+
+    curl -s -m 60 http://direct.fipradio.fr/live/fip-midfi.mp3 > fip.mp3
+"""
+
+import sys
+import os
+import time
+import threading
+import BaseHTTPServer
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'src'))
+
+from codplayer.sources.radiostream import HttpMpegStream, StreamError
+
+
+class DummyPlayer(object):
+    def log(self, msg, *args, **kwargs):
+        sys.stderr.write(msg.format(*args, **kwargs) + '\n')
+
+    def debug(self, msg, *args, **kwargs):
+        pass
+
+
+def serve_file(path):
+    with open(path, 'rb') as f:
+        data = f.read()
+
+    class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+        def do_GET(self):
+            self.send_response(200)
+            self.send_header('Content-Type', 'audio/mpeg')
+            self.end_headers()
+            self.wfile.write(data)
+
+        def log_message(self, *args):
+            pass
+
+    server = BaseHTTPServer.HTTPServer(('127.0.0.1', 0), Handler)
+    t = threading.Thread(target = server.handle_request)
+    t.daemon = True
+    t.start()
+
+    return 'http://127.0.0.1:{0}/'.format(server.server_address[1])
+
+
+def main():
+    if len(sys.argv) != 2:
+        sys.exit('usage: {0} CAPTURED.mp3'.format(sys.argv[0]))
+
+    url = serve_file(sys.argv[1])
+
+    start = time.time()
+    cpu_start = time.clock()
+
+    stream = HttpMpegStream(DummyPlayer(), url)
+    fmt = stream.format
+    bytes_per_second = fmt.channels * fmt.bytes_per_sample * fmt.rate
+
+    total = 0
+    packets = 0
+    try:
+        for p in stream.iter_packets():
+            if p is not None:
+                total += len(p.data)
+                packets += 1
+    except StreamError as e:
+        # The server closes the connection at the end of the file
+        pass
+    finally:
+        stream.close()
+
+    elapsed = time.time() - start
+    cpu = time.clock() - cpu_start
+    audio_secs = float(total) / bytes_per_second
+
+    print '{0} packets, {1:.1f} s of audio at {2} Hz'.format(packets, audio_secs, fmt.rate)
+    print '{0:.2f} s elapsed, {1:.2f} s CPU'.format(elapsed, cpu)
+    print '{0:.1f}x realtime, {1:.2f} ms CPU per second of audio'.format(
+        audio_secs / elapsed, 1000 * cpu / audio_secs)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,128 @@
+#!/usr/bin/env python
+#
+# Copyright 2018 Peter Liljenberg <peter.liljenberg@gmail.com>
+#
+# Distributed under an MIT license, please see LICENSE in the top dir.
+
+"""Measure JSON round-trips of State, ExtDisc and DbDisc objects.
+
+Each round-trip loads an object from a JSON string and serializes it
+again.  It is timed with the MAPPING interpreted for every object and
+the whole object __dict__ encoded, as codplayer did before, and with
+the loaders and encoders compiled for each class:
+
+    python tools/bench_serialize.py [ROUNDS]
+
+It also prints the size of the messages published on the player
+state topic and broadcast by codrestd to SockJS clients, in both
+encodings.
+"""
+
+import sys
+import os
+import time
+import json
+import types
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'src'))
+
+from codplayer import model, serialize, state
+
+DISC_FILE = os.path.join(os.path.dirname(__file__), '..', 'src', 'codplayer',
+                         'test', 'data', 'sonicyouth-daydreamnation.cod')
+
+
+class DictEncoder(json.JSONEncoder):
+    # The old CodEncoder, encoding all object attributes
+    def default(self, obj):
+        if type(obj) is types.ClassType:
+            return obj.__name__
+        if isinstance(obj, serialize.Serializable):
+            return obj.__dict__
+        super(DictEncoder, self).default(obj)
+
+
+def interpreting_loader(cls):
+    # Pass a copy of the mapping, so populate_object() doesn't use
+    # the compiled loader
+    mapping = list(cls.MAPPING)
+    def load(src, dest):
+        serialize.populate_object(src, dest, mapping)
+        return dest
+    return load
+
+
+def interpreted_round_trip(cls, text):
+    return json.dumps(serialize.load_jsons(cls, text), cls = DictEncoder)
+
+
+def compiled_round_trip(cls, text):
+    return serialize.get_jsons(serialize.load_jsons(cls, text))
+
+
+def bench(func, cls, text, rounds):
+    start = time.clock()
+    for i in xrange(rounds):
+        func(cls, text)
+    return (time.clock() - start) / rounds
+
+
+def message_sizes(topic, obj):
+    # The player publishes the object, and codrestd loads it and
+    # broadcasts it as a dict to the SockJS clients
+    old = json.dumps(obj, cls = DictEncoder)
+    new = serialize.get_jsons(obj)
+
+    loaded = serialize.load_jsons(obj.__class__, new)
+    old_sockjs = json.dumps({ 'id': 'player', topic: json.loads(
+        json.dumps(loaded, cls = DictEncoder)) })
+    new_sockjs = json.dumps({ 'id': 'player', topic: json.loads(
+        serialize.get_jsons(loaded)) })
+
+    for name, old_size, new_size in (('topic', len(old), len(new)),
+                                     ('SockJS', len(old_sockjs), len(new_sockjs))):
+        print '{0:10s} {1:8s} {2:8d} B {3:8d} B {4:7.0f}%'.format(
+            topic, name, old_size, new_size, 100.0 * (new_size - old_size) / old_size)
+
+
+def main():
+    rounds = int(sys.argv[1]) if len(sys.argv) > 1 else 10000
+
+    db_disc = model.DbDisc.from_file(DISC_FILE)
+    st = state.State(state = state.State.PLAY, disc_id = db_disc.disc_id,
+                     track = 3, no_tracks = len(db_disc.tracks),
+                     index = 1, position = 117, length = 418)
+    ext_disc = model.ExtDisc(db_disc)
+
+    objects = (
+        ('State', state.State, serialize.get_jsons(st)),
+        ('ExtDisc', model.ExtDisc, serialize.get_jsons(ext_disc)),
+        ('DbDisc', model.DbDisc, serialize.get_jsons(db_disc)),
+        )
+
+    print '{0} round-trips per object'.format(rounds)
+    print '{0:10s} {1:>14s} {2:>14s} {3:>8s}'.format(
+        'object', 'interpreted', 'compiled', 'speedup')
+
+    for name, cls, text in objects:
+        get_loader = serialize.get_loader
+        serialize.get_loader = interpreting_loader
+        try:
+            interpreted = bench(interpreted_round_trip, cls, text, rounds)
+        finally:
+            serialize.get_loader = get_loader
+
+        compiled = bench(compiled_round_trip, cls, text, rounds)
+
+        print '{0:10s} {1:11.1f} us {2:11.1f} us {3:7.1f}x'.format(
+            name, 1e6 * interpreted, 1e6 * compiled, interpreted / compiled)
+
+    print
+    print '{0:10s} {1:8s} {2:>10s} {3:>10s} {4:>8s}'.format(
+        'message', '', 'old', 'new', 'change')
+    message_sizes('state', st)
+    message_sizes('disc', ext_disc)
+
+
+if __name__ == '__main__':
+    main()